@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the F-engines and X-engines used by superCorrelator.py with
+synthetic data across the available backends.
+"""
+
+# Python3 compatibility
+from __future__ import print_function, division, absolute_import
+import sys
+if sys.version_info > (3,):
+    xrange = range
+    
+import os
+import sys
+import json
+import time
+import numpy
+import socket
+import argparse
+from datetime import datetime
+
+from lsl.common import stations
+from lsl.misc import parser as aph
+
+
+# Sample rates and center frequencies for the synthetic data
+_SRATE = {'real': 128e6, 'complex': 19.6e6}
+_CFREQ = {'real': 64e6, 'complex': 60e6}
+
+
+def get_backends(names, gpu=0):
+    """
+    Given a list of backend names, return a dictionary of multirate-like
+    modules that provide fengine() and xengine_full() for each of the
+    backends that can be loaded.
+    """
+    
+    backends = {}
+    for name in names:
+        try:
+            if name == 'python':
+                import multirate as backend
+            elif name == 'jit':
+                from jit import multirate as backend
+            elif name == 'gpu':
+                from jit import xcupy
+                xcupy.select_gpu(gpu)
+                backend = xcupy
+            elif name == 'blas':
+                from jit import xblas as backend
+            elif name == 'int8':
+                from jit import xint8 as backend
+            else:
+                raise RuntimeError("Unknown backend: %s" % name)
+            backends[name] = backend
+        except ImportError as e:
+            print("WARNING: cannot load the '%s' backend: %s" % (name, str(e)))
+    return backends
+
+
+def get_synthetic_data(nStand, LFFT, nWin, dtype):
+    """
+    Return a set of antennas and synthetic Gaussian noise signals for the
+    specified number of stations, FFT length, and number of FFT windows.
+    """
+    
+    antennas = stations.lwa1.antennas[:2*nStand]
+    if dtype == 'real':
+        signals = numpy.random.randn(2*nStand, 2*LFFT*nWin)
+        signals = signals.astype(numpy.float32)
+    else:
+        signals = numpy.random.randn(2*nStand, LFFT*nWin) + 1j*numpy.random.randn(2*nStand, LFFT*nWin)
+        signals = signals.astype(numpy.complex64)
+    return antennas, signals
+
+
+def get_fengine_flops(nStand, LFFT, nWin, dtype, overlap=1, ntap=0):
+    """
+    Return the approximate number of floating point operations needed by the
+    F-engine.  If 'ntap' is greater than zero this includes the cost of
+    applying and summing the taps of a polyphase filter bank.
+    """
+    
+    nFFT = 2*nStand*nWin*overlap
+    if dtype == 'real':
+        ## Real-to-complex FFT of length 2*LFFT plus the delay phase rotation
+        flops = 2.5*(2*LFFT)*numpy.log2(2*LFFT) + 6*LFFT
+        flops += 2*(2*LFFT)*ntap
+    else:
+        ## Complex FFT of length LFFT plus the delay phase rotation
+        flops = 5.0*LFFT*numpy.log2(LFFT) + 6*LFFT
+        flops += 4*LFFT*ntap
+    return nFFT*flops
+
+
+def get_xengine_flops(nStand, nChan, nWin):
+    """
+    Return the approximate number of floating point operations needed by the
+    full polarization X-engine.
+    """
+    
+    nBL = nStand*(nStand+1)//2
+    return 4*nBL*nChan*nWin*8
+
+
+def get_max_error(output, reference):
+    """
+    Given two sets of X-engine outputs, return the largest difference between
+    them relative to the largest reference visibility amplitude.
+    """
+    
+    error, scale = 0.0, 0.0
+    for vis,ref in zip(output, reference):
+        error = max([error, numpy.abs(vis - ref).max()])
+        scale = max([scale, numpy.abs(ref).max()])
+    return error / scale
+
+
+def time_call(func, args, kwds, repeats):
+    """
+    Call a function once to warm up (JIT compilation, FFTW planning, etc.)
+    and then time the requested number of repeats.  Returns the median time
+    per call and the output of the warm up call.
+    """
+    
+    output = func(*args, **kwds)
+    times = []
+    for r in xrange(repeats):
+        t0 = time.time()
+        func(*args, **kwds)
+        times.append(time.time() - t0)
+    return numpy.median(times), output
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1):
+    """
+    Compare a set of benchmark results to a baseline set and return a list of
+    the keys for the cases that are slower than the baseline by more than the
+    tolerance (a fraction).
+    """
+    
+    regressions = []
+    for key in sorted(results.keys()):
+        try:
+            ref = baseline[key]
+        except KeyError:
+            continue
+        change = results[key]['time'] / ref['time'] - 1
+        status = ''
+        if change > tolerance:
+            status = ' <- regression'
+            regressions.append(key)
+        print("  %-48s %8.3f ms vs %8.3f ms (%+6.1f%%)%s" % (key, results[key]['time']*1e3, ref['time']*1e3, change*100, status))
+    return regressions
+
+
+def main(args):
+    # Load in the backends
+    backends = get_backends(args.backends, gpu=args.gpu)
+    if len(backends) == 0:
+        raise RuntimeError("No backends could be loaded")
+        
+    # Run the sweep
+    results = {}
+    for dtype in args.dtypes:
+        for nStand in args.stations:
+            for LFFT in args.fft_lengths:
+                for nWin in args.windows:
+                    antennas, signals = get_synthetic_data(nStand, LFFT, nWin, dtype)
+                    nSamps = signals.shape[0]*signals.shape[1]
+                    
+                    for overlap in args.overlaps:
+                        ## F-engine - the GPU, BLAS, and int8 backends only provide an 
+                        ## X-engine so use the outputs of the first CPU backend 
+                        ## for them
+                        fOutput = None
+                        for name in sorted(backends.keys()):
+                            backend = backends[name]
+                            if name in ('gpu', 'blas', 'int8'):
+                                continue
+                                
+                            key = 'fengine/%s/%s/%i/%i/%i/%i' % (name, dtype, nStand, LFFT, nWin, overlap)
+                            tRun, output = time_call(backend.fengine, (signals, antennas),
+                                                     {'LFFT': LFFT, 'overlap': overlap, 'sample_rate': _SRATE[dtype],
+                                                      'central_freq': _CFREQ[dtype], 'pol': '*'}, args.repeats)
+                            flops = get_fengine_flops(nStand, LFFT, nWin, dtype, overlap=overlap)
+                            results[key] = {'time': tRun, 'samples_per_s': nSamps/tRun, 'gflops': flops/tRun/1e9}
+                            print("%-48s %8.3f ms, %8.2f Msamples/s, %7.2f GFLOP/s" % (key, tRun*1e3, nSamps/tRun/1e6, flops/tRun/1e9))
+                            if fOutput is None:
+                                fOutput = output
+                                
+                            ### Polyphase filter bank F-engine and its cost relative
+                            ### to the FFT F-engine
+                            if args.pfb:
+                                tFFT = tRun
+                                pKwds = {'LFFT': LFFT, 'overlap': overlap, 'sample_rate': _SRATE[dtype],
+                                         'central_freq': _CFREQ[dtype], 'pol': '*'}
+                                nTap = 4
+                                if name == 'jit':
+                                    pKwds['ntap'] = nTap = args.pfb_taps
+                                    
+                                key = 'pfbengine/%s/%s/%i/%i/%i/%i' % (name, dtype, nStand, LFFT, nWin, overlap)
+                                tRun, output = time_call(backend.pfbengine, (signals, antennas), pKwds, args.repeats)
+                                flops = get_fengine_flops(nStand, LFFT, nWin, dtype, overlap=overlap, ntap=nTap)
+                                results[key] = {'time': tRun, 'samples_per_s': nSamps/tRun, 'gflops': flops/tRun/1e9,
+                                                'fft_ratio': tRun/tFFT}
+                                print("%-48s %8.3f ms, %8.2f Msamples/s, %7.2f GFLOP/s, %.2fx FFT" % (key, tRun*1e3, nSamps/tRun/1e6, flops/tRun/1e9, tRun/tFFT))
+                                
+                        if fOutput is None:
+                            continue
+                            
+                        ## X-engine
+                        freq, feo, veo, deo = fOutput
+                        feoX, feoY = feo[0::2,:,:].copy(), feo[1::2,:,:].copy()
+                        veoX, veoY = veo[0::2,:].copy(), veo[1::2,:].copy()
+                        xSamps = feoX.size + feoY.size
+                        xOutput = None
+                        for name in sorted(sorted(backends.keys()), key=lambda x: x != 'python'):
+                            backend = backends[name]
+                            
+                            key = 'xengine/%s/%s/%i/%i/%i/%i' % (name, dtype, nStand, LFFT, nWin, overlap)
+                            if name == 'int8':
+                                ### The int8 X-engine works on data quantized
+                                ### when they are sorted by polarization
+                                xArgs = (backend.quantize(feoX), veoX, backend.quantize(feoY), veoY)
+                            else:
+                                xArgs = (feoX, veoX, feoY, veoY)
+                            tRun, output = time_call(backend.xengine_full, xArgs, {}, args.repeats)
+                            flops = get_xengine_flops(nStand, feoX.shape[1], feoX.shape[2])
+                            results[key] = {'time': tRun, 'samples_per_s': xSamps/tRun, 'gflops': flops/tRun/1e9}
+                            
+                            ### Compare the visibilities to the reference, _core.XEngine3
+                            ### from the python backend, when it is available
+                            status = ''
+                            if name == 'python':
+                                xOutput = output
+                            elif xOutput is not None:
+                                error = get_max_error(output, xOutput)
+                                results[key]['max_error'] = error
+                                status = ', max. rel. error %.1e' % error
+                            print("%-48s %8.3f ms, %8.2f Msamples/s, %7.2f GFLOP/s%s" % (key, tRun*1e3, xSamps/tRun/1e6, flops/tRun/1e9, status))
+                            
+    # Save
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump({'host': socket.gethostname(),
+                       'date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+                       'python': sys.version.split(None, 1)[0],
+                       'numpy': numpy.__version__,
+                       'results': results}, fh, indent=2, sort_keys=True)
+        print("Saved results to '%s'" % args.output)
+        
+    # Compare
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)
+        print("Comparison with '%s' from %s on %s:" % (os.path.basename(args.baseline), baseline['date'], baseline['host']))
+        regressions = compare_to_baseline(results, baseline['results'], tolerance=args.tolerance)
+        if len(regressions):
+            print("Found %i regression(s) larger than %.0f%%" % (len(regressions), args.tolerance*100))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='benchmark the F- and X-engines with synthetic data',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    parser.add_argument('-b', '--backends', type=str, default='python,jit,blas,int8,gpu',
+                        help='comma separated list of backends to benchmark')
+    parser.add_argument('-s', '--stations', type=aph.csv_int_list, default='2,4,8,16',
+                        help='comma separated list of station counts')
+    parser.add_argument('-l', '--fft-lengths', type=aph.csv_int_list, default='64,256,1024',
+                        help='comma separated list of FFT lengths')
+    parser.add_argument('-w', '--windows', type=aph.csv_int_list, default='100',
+                        help='comma separated list of the number of FFT windows per call')
+    parser.add_argument('-d', '--dtypes', type=str, default='real,complex',
+                        help='comma separated list of data types; real = VDIF-like, complex = DRX-like')
+    parser.add_argument('-o', '--overlaps', type=aph.csv_int_list, default='1',
+                        help='comma separated list of F-engine window overlaps')
+    parser.add_argument('-p', '--pfb', action='store_true',
+                        help='also benchmark the polyphase filter bank F-engines against the FFT F-engines')
+    parser.add_argument('--pfb-taps', type=int, default=4,
+                        help='number of taps for the JIT polyphase filter bank F-engine')
+    parser.add_argument('-r', '--repeats', type=int, default=5,
+                        help='number of timed calls per case')
+    parser.add_argument('--gpu', type=int, default=0,
+                        help='GPU to use for the GPU backend')
+    parser.add_argument('-f', '--output', type=str,
+                        help='save the results to the specified JSON file')
+    parser.add_argument('-c', '--baseline', type=str,
+                        help='compare the results to a baseline JSON file saved with -f/--output')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1,
+                        help='fractional slowdown relative to the baseline that counts as a regression')
+    args = parser.parse_args()
+    args.backends = args.backends.split(',')
+    args.dtypes = args.dtypes.split(',')
+    main(args)
+    
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the full eLWA processing chain - configuration, correlation,
+FITS-IDI creation, flagging, and fringe searching - on either a synthetic
+or a provided dataset and report where the time, memory, and I/O go.
+"""
+
+# Python3 compatibility
+from __future__ import print_function, division, absolute_import
+import sys
+if sys.version_info > (3,):
+    xrange = range
+    
+import os
+import sys
+import glob
+import json
+import time
+import shlex
+import numpy
+import socket
+import argparse
+import subprocess
+from datetime import datetime
+
+
+# Location of the pipeline scripts
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_directory_state(path):
+    """
+    Return a dictionary of (size, modification time) tuples for all of the
+    files under the specified directory.
+    """
+    
+    state = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            filename = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            state[os.path.relpath(filename, path)] = (st.st_size, st.st_mtime)
+    return state
+
+
+def _read_proc_io(pid):
+    """
+    Read the bytes read and written by the specified process from /proc.
+    Returns None if this information is not available.
+    """
+    
+    try:
+        with open('/proc/%i/io' % pid, 'r') as fh:
+            fields = {}
+            for line in fh:
+                key, value = line.split(':', 1)
+                fields[key.strip()] = int(value, 10)
+        return fields['rchar'], fields['wchar']
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def run_stage(name, cmd, cwd, poll=0.1):
+    """
+    Run a single stage of the pipeline in the specified working directory
+    and return a dictionary of the runtime, CPU time, peak RSS, bytes read
+    and written, and the files created.  The output of the stage is saved to
+    '<name>.log' in the working directory.
+    """
+    
+    before = get_directory_state(cwd)
+    
+    print("Running stage '%s': %s" % (name, ' '.join(cmd)))
+    logname = os.path.join(cwd, '%s.log' % name)
+    with open(logname, 'w') as logfile:
+        t0 = time.time()
+        p = subprocess.Popen(cmd, cwd=cwd, stdout=logfile, stderr=subprocess.STDOUT)
+        
+        ## Poll the process I/O counters while it runs since these are gone
+        ## once the process has been reaped
+        io = None
+        while True:
+            pid, status, usage = os.wait4(p.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            io = _read_proc_io(p.pid) or io
+            time.sleep(poll)
+        tRun = time.time() - t0
+        p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        
+    after = get_directory_state(cwd)
+    created = sorted([f for f in after if f not in before and f != os.path.basename(logname)])
+    modified = sorted([f for f in after if f in before and after[f] != before[f] and f != os.path.basename(logname)])
+    
+    # Bytes read and written - fall back to the block counts from the
+    # resource usage if /proc is not available
+    if io is not None:
+        nRead, nWrite = io
+    else:
+        nRead, nWrite = usage.ru_inblock*512, usage.ru_oublock*512
+    nCreated = sum([after[f][0] for f in created])
+    nWrite = max([nWrite, nCreated])
+    
+    # Peak RSS - ru_maxrss is in kB on Linux but bytes on Mac
+    rss = usage.ru_maxrss
+    if sys.platform != 'darwin':
+        rss *= 1024
+        
+    return {'command': cmd,
+            'status': p.returncode,
+            'time': tRun,
+            'cpu_time': usage.ru_utime + usage.ru_stime,
+            'peak_rss': rss,
+            'bytes_read': nRead,
+            'bytes_written': nWrite,
+            'files_created': created,
+            'files_modified': modified,
+            'bytes_created': nCreated}
+
+
+def _get_script(name):
+    return [sys.executable, os.path.join(_SCRIPT_DIR, name)]
+
+
+def _split_args(value):
+    return shlex.split(value) if value else []
+
+
+def _format_bytes(value):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if abs(value) < 1024:
+            break
+        value /= 1024.0
+    return "%.1f %s" % (value, unit)
+
+
+def print_breakdown(stages):
+    """
+    Print a table showing the per-stage breakdown of the pipeline run.
+    """
+    
+    tTotal = sum([stage['time'] for name,stage in stages])
+    
+    print("%-10s %10s %6s %10s %10s %10s %10s %6s" % ('Stage', 'Time [s]', '%', 'CPU [s]', 'Peak RSS', 'Read', 'Written', 'Files'))
+    for name,stage in stages:
+        print("%-10s %10.2f %6.1f %10.2f %10s %10s %10s %6i" % (name, stage['time'], 100.0*stage['time']/tTotal, stage['cpu_time'],
+                                                                _format_bytes(stage['peak_rss']), _format_bytes(stage['bytes_read']),
+                                                                _format_bytes(stage['bytes_written']), len(stage['files_created'])))
+    print("%-10s %10.2f %6.1f %10.2f %10s" % ('Total', tTotal, 100.0, sum([stage['cpu_time'] for name,stage in stages]),
+                                              _format_bytes(max([stage['peak_rss'] for name,stage in stages]))))
+
+
+def compare_to_baseline(stages, baseline, tolerance=0.1):
+    """
+    Compare a set of pipeline stage results to a baseline set and return a
+    list of the stages that are slower than the baseline by more than the
+    tolerance (a fraction).
+    """
+    
+    regressions = []
+    for name,stage in stages:
+        try:
+            ref = baseline[name]
+        except KeyError:
+            continue
+        change = stage['time'] / ref['time'] - 1
+        rssChange = 1.0*stage['peak_rss'] / ref['peak_rss'] - 1
+        status = ''
+        if change > tolerance:
+            status = ' <- regression'
+            regressions.append(name)
+        print("  %-10s %8.2f s vs %8.2f s (%+6.1f%%), peak RSS %+6.1f%%%s" % (name, stage['time'], ref['time'], change*100, rssChange*100, status))
+    return regressions
+
+
+def main(args):
+    # Setup the working directory
+    workdir = os.path.abspath(args.directory)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    configname = '%s.config' % args.tag
+    
+    # Build up the list of stages to run
+    plan = []
+    if args.config is not None:
+        configname = os.path.abspath(args.config)
+    elif len(args.filename) == 0:
+        cmd = _get_script('createSyntheticData.py')
+        cmd.extend(['-v', str(args.vla), '-l', args.lwa, '-d', str(args.duration), '-o', configname])
+        if args.seed is not None:
+            cmd.extend(['--seed', str(args.seed)])
+        plan.append(('config', cmd))
+    else:
+        cmd = _get_script('createConfigFile.py')
+        cmd.extend(['-o', configname])
+        cmd.extend([os.path.abspath(filename) for filename in args.filename])
+        plan.append(('config', cmd))
+        
+    cmd = _get_script('superCorrelator.py')
+    cmd.extend(['-t', str(args.integration_time), '-l', str(args.fft_length), '-g', args.tag])
+    cmd.extend(_split_args(args.correlator_args))
+    cmd.append(configname)
+    plan.append(('correlate', cmd))
+    
+    ## These depend on the outputs of the earlier stages so they are built
+    ## just before they are run
+    plan.append(('build', None))
+    if not args.no_flag:
+        plan.append(('flag', None))
+        if args.dtv:
+            plan.append(('flagdtv', None))
+    if not args.no_fringe:
+        plan.append(('fringe', None))
+        
+    # Run
+    stages = []
+    idiname = 'buildIDI_%s.FITS_1' % args.tag
+    for name,cmd in plan:
+        if name == 'build':
+            files = sorted(glob.glob(os.path.join(workdir, '%s-vis2-*.npz' % args.tag)))
+            cmd = _get_script('buildIDI.py')
+            cmd.extend(['-f', '-t', args.tag])
+            cmd.extend([os.path.basename(filename) for filename in files])
+        elif name in ('flag', 'flagdtv'):
+            cmd = _get_script('flagIDI.py' if name == 'flag' else 'flagDTV.py')
+            cmd.extend(['-f', idiname])
+            idiname = '%s_flagged%s' % os.path.splitext(idiname)
+        elif name == 'fringe':
+            cmd = _get_script('fringeSearchIDI.py')
+            cmd.append(idiname)
+            
+        result = run_stage(name, cmd, workdir)
+        stages.append((name, result))
+        print("  -> %.2f s, peak RSS %s, %i file(s) created" % (result['time'], _format_bytes(result['peak_rss']), len(result['files_created'])))
+        if result['status'] != 0:
+            print("WARNING: stage '%s' failed with status %i, see '%s'" % (name, result['status'], os.path.join(workdir, '%s.log' % name)))
+            break
+            
+    # Report
+    print(" ")
+    print_breakdown(stages)
+    
+    # Save
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump({'host': socket.gethostname(),
+                       'date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+                       'python': sys.version.split(None, 1)[0],
+                       'numpy': numpy.__version__,
+                       'dataset': 'synthetic' if (args.config is None and len(args.filename) == 0) else 'provided',
+                       'stages': dict(stages),
+                       'order': [name for name,stage in stages]}, fh, indent=2, sort_keys=True)
+        print("Saved results to '%s'" % args.output)
+        
+    # Compare
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)
+        print("Comparison with '%s' from %s on %s:" % (os.path.basename(args.baseline), baseline['date'], baseline['host']))
+        regressions = compare_to_baseline(stages, baseline['stages'], tolerance=args.tolerance)
+        if len(regressions):
+            print("Found %i regression(s) larger than %.0f%%" % (len(regressions), args.tolerance*100))
+            sys.exit(1)
+            
+    if len(stages) and stages[-1][1]['status'] != 0:
+        sys.exit(stages[-1][1]['status'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='benchmark the full eLWA processing chain on a synthetic or provided dataset',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    parser.add_argument('filename', type=str, nargs='*',
+                        help='raw data files to build a configuration file for; a synthetic dataset is used if none are given')
+    parser.add_argument('-c', '--config', type=str,
+                        help='use an existing configuration file instead of creating one')
+    parser.add_argument('-w', '--directory', type=str, default='pipeline-benchmark',
+                        help='working directory for the pipeline outputs')
+    parser.add_argument('-g', '--tag', type=str, default='bench',
+                        help='tag to use for the pipeline outputs')
+    parser.add_argument('-v', '--vla', type=int, default=2,
+                        help='number of VLA antennas in the synthetic dataset')
+    parser.add_argument('-a', '--lwa', type=str, default='LWA1',
+                        help='comma separated list of LWA stations in the synthetic dataset')
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help='duration in seconds of the synthetic dataset')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='random number generator seed for the synthetic dataset')
+    parser.add_argument('-t', '--integration-time', type=float, default=1.0,
+                        help='correlator integration time in seconds')
+    parser.add_argument('-l', '--fft-length', type=int, default=256,
+                        help='correlator FFT length')
+    parser.add_argument('--correlator-args', type=str,
+                        help='additional arguments to pass to superCorrelator.py')
+    parser.add_argument('--dtv', action='store_true',
+                        help='also run flagDTV.py after flagIDI.py')
+    parser.add_argument('--no-flag', action='store_true',
+                        help='skip the flagging stage')
+    parser.add_argument('--no-fringe', action='store_true',
+                        help='skip the fringe search stage')
+    parser.add_argument('-f', '--output', type=str,
+                        help='save the results to the specified JSON file')
+    parser.add_argument('-b', '--baseline', type=str,
+                        help='compare the results to a baseline JSON file saved with -f/--output')
+    parser.add_argument('-e', '--tolerance', type=float, default=0.1,
+                        help='fractional slowdown relative to the baseline that counts as a regression')
+    args = parser.parse_args()
+    main(args)
+    
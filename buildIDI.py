@@ -38,7 +38,7 @@ from lsl.correlator import fx as fxc
 from lsl.correlator.uvutils import compute_uvw
 from lsl.common.mcs import datetime_to_mjdmpm
 
-from utils import read_correlator_configuration
+from utils import read_correlator_configuration, load_visibilities, get_bda_visibilities, add_profile_option, Profiler
 
 import fitsidi
 
@@ -165,7 +165,7 @@ def main(args):
     observer = site.get_observer()
     
     # Load in the file file to figure out what to do
-    dataDict = numpy.load(filenames[0])
+    dataDict = load_visibilities(filenames[0])
     tStart = dataDict['tStart'].item()
     tInt = dataDict['tInt']
     
@@ -189,10 +189,15 @@ def main(args):
     except (TypeError, KeyError):
         pass
         
-    visXX = dataDict['vis1XX'].astype(numpy.complex64)
-    visXY = dataDict['vis1XY'].astype(numpy.complex64)
-    visYX = dataDict['vis1YX'].astype(numpy.complex64)
-    visYY = dataDict['vis1YY'].astype(numpy.complex64)
+    # Zoom bands - each one is written out as a separate IF
+    nBand = 1
+    try:
+        if config['zoom'] is not None:
+            nBand = len(config['zoom'])
+            print("NOTE:  Writing %i zoom bands as separate IFs per user defined configuration" % nBand)
+    except (TypeError, KeyError):
+        pass
+        
     dataDict.close()
     
     # Build up the master list of antennas and report
@@ -201,7 +206,7 @@ def main(args):
     for filename in filenames:
         group = os.path.basename(filename).split('-vis2', 1)[0]
         if group not in obs_groups:
-            dataDict = numpy.load(filename)
+            dataDict = load_visibilities(filename)
             config, refSrc, junk1, junk2, junk3, junk4, antennas = read_correlator_configuration(dataDict)
             del dataDict
             
@@ -218,10 +223,13 @@ def main(args):
     for ant in master_antennas:
         print("  Antenna %i: Stand %i, Pol. %i" % (ant.id, ant.stand.id, ant.pol))
         
-    nchan = visXX.shape[1]
+    nchan = freq.size
     master_blList = uvutils.get_baselines([ant for ant in master_antennas if ant.pol == 0], include_auto=True)
     
     if args.decimate > 1:
+        if nBand > 1 and (freq.size//nBand) % args.decimate != 0:
+            raise RuntimeError("Decimation factor of %i does not evenly divide the %i channels in each zoom band" % (args.decimate, freq.size//nBand))
+            
         to_trim = (freq.size/args.decimate)*args.decimate
         to_drop = freq.size - to_trim
         if to_drop != 0:
@@ -257,10 +265,13 @@ def main(args):
         dirty = ''
         
     # Fill in the data
+    profiler = Profiler(args.profile, rate=args.profile_rate, 
+                        default='buildIDI-profile' if args.tag is None else 'buildIDI_%s-profile' % args.tag)
+    profiler.start()
     for i,filename in enumerate(filenames):
         ## Load in the integration
         group = os.path.basename(filename).split('-vis2', 1)[0]
-        dataDict = numpy.load(filename)
+        dataDict = load_visibilities(filename)
         junk0, refSrc, junk1, junk2, junk3, junk4, antennas = read_correlator_configuration(dataDict)
         try:
             refSrc.name = refSrc.name.upper()	# For AIPS
@@ -294,11 +305,26 @@ def main(args):
                 
         tStart = dataDict['tStart'].item()
         tInt = dataDict['tInt'].item()
-        visXX = dataDict['vis1XX'].astype(numpy.complex64)
-        visXY = dataDict['vis1XY'].astype(numpy.complex64)
-        visYX = dataDict['vis1YX'].astype(numpy.complex64)
-        visYY = dataDict['vis1YY'].astype(numpy.complex64)
-        
+        if 'bdaTime' in dataDict:
+            ## Baseline-dependent averaging - each group of baselines that
+            ## share an averaging time is written with its own time and
+            ## integration time.  Averaged channels are repeated to fill out
+            ## the UV_DATA rows.
+            bdaGroups, visXX, visXY, visYX, visYY, weights = get_bda_visibilities(dataDict)
+            blGroups = []
+            for timeFactor,rows,baselines in bdaGroups:
+                blGroups.append( (tStart - (timeFactor-1)*tInt/2.0, timeFactor*tInt, rows, [blList[b] for b in baselines]) )
+        else:
+            visXX = dataDict['vis1XX'].astype(numpy.complex64)
+            visXY = dataDict['vis1XY'].astype(numpy.complex64)
+            visYX = dataDict['vis1YX'].astype(numpy.complex64)
+            visYY = dataDict['vis1YY'].astype(numpy.complex64)
+            try:
+                weights = dataDict['weights1'].astype(numpy.float32)
+            except KeyError:
+                weights = None
+            blGroups = [(tStart, tInt, slice(None), blList),]
+            
         dataDict.close()
         
         if args.decimate > 1:
@@ -307,6 +333,15 @@ def main(args):
                 visXY = visXY[:,:to_trim]
                 visYX = visYX[:,:to_trim]
                 visYY = visYY[:,:to_trim]
+                if weights is not None:
+                    weights = weights[:,:to_trim]
+                    
+            if weights is not None:
+                ## Weighted average so that the flagged channels drop out
+                visXX = visXX*weights
+                visXY = visXY*weights
+                visYX = visYX*weights
+                visYY = visYY*weights
                 
             visXX.shape = (visXX.shape[0], visXX.shape[1]//args.decimate, args.decimate)
             visXX = visXX.mean(axis=2)
@@ -317,6 +352,15 @@ def main(args):
             visYY.shape = (visYY.shape[0], visYY.shape[1]//args.decimate, args.decimate)
             visYY = visYY.mean(axis=2)
             
+            if weights is not None:
+                weights.shape = (weights.shape[0], weights.shape[1]//args.decimate, args.decimate)
+                weights = weights.mean(axis=2)
+                norm = numpy.where(weights > 0, weights, 1.0)
+                visXX /= norm
+                visXY /= norm
+                visYX /= norm
+                visYY /= norm
+                
         if conjugateVis:
             visXX = visXX.conj()
             visXY = visXY.conj()
@@ -370,7 +414,8 @@ def main(args):
                 fits.set_stokes(['I', 'Q', 'U', 'V'])
             else:
                 fits.set_stokes(['XX', 'XY', 'YX', 'YY'])
-            fits.set_frequency(freq)
+            for bandFreq in numpy.split(freq, nBand):
+                fits.set_frequency(bandFreq)
             fits.set_geometry(stations.lwa1, [a for a in master_antennas if a.pol == 0])
             if config['context'] is not None:
                 mode = 'LSBI'
@@ -397,26 +442,29 @@ def main(args):
         refSrc.compute(observer)
         
         ## Convert the setTime to a MJD and save the visibilities to the FITS IDI file
-        obsTime = astro.unix_to_taimjd(tStart)
-        if args.circular:
-            fits.add_data_set(obsTime, tInt, blList, visRR, pol='RR', source=refSrc)
-            fits.add_data_set(obsTime, tInt, blList, visRL, pol='RL', source=refSrc)
-            fits.add_data_set(obsTime, tInt, blList, visLR, pol='LR', source=refSrc)
-            fits.add_data_set(obsTime, tInt, blList, visLL, pol='LL', source=refSrc)
-        elif args.stokes:
-            fits.add_data_set(obsTime, tInt, blList, visI, pol='I', source=refSrc)
-            fits.add_data_set(obsTime, tInt, blList, visQ, pol='Q', source=refSrc)
-            fits.add_data_set(obsTime, tInt, blList, visU, pol='U', source=refSrc)
-            fits.add_data_set(obsTime, tInt, blList, visV, pol='V', source=refSrc)
-        else:
-            fits.add_data_set(obsTime, tInt, blList, visXX, pol='XX', source=refSrc)
-            fits.add_data_set(obsTime, tInt, blList, visXY, pol='XY', source=refSrc)
-            fits.add_data_set(obsTime, tInt, blList, visYX, pol='YX', source=refSrc)
-            fits.add_data_set(obsTime, tInt, blList, visYY, pol='YY', source=refSrc)
-            
+        for gStart,gInt,gRows,gList in blGroups:
+            obsTime = astro.unix_to_taimjd(gStart)
+            gWeights = None if weights is None else weights[gRows,:]
+            if args.circular:
+                fits.add_data_set(obsTime, gInt, gList, visRR[gRows,:], weights=gWeights, pol='RR', source=refSrc)
+                fits.add_data_set(obsTime, gInt, gList, visRL[gRows,:], weights=gWeights, pol='RL', source=refSrc)
+                fits.add_data_set(obsTime, gInt, gList, visLR[gRows,:], weights=gWeights, pol='LR', source=refSrc)
+                fits.add_data_set(obsTime, gInt, gList, visLL[gRows,:], weights=gWeights, pol='LL', source=refSrc)
+            elif args.stokes:
+                fits.add_data_set(obsTime, gInt, gList, visI[gRows,:], weights=gWeights, pol='I', source=refSrc)
+                fits.add_data_set(obsTime, gInt, gList, visQ[gRows,:], weights=gWeights, pol='Q', source=refSrc)
+                fits.add_data_set(obsTime, gInt, gList, visU[gRows,:], weights=gWeights, pol='U', source=refSrc)
+                fits.add_data_set(obsTime, gInt, gList, visV[gRows,:], weights=gWeights, pol='V', source=refSrc)
+            else:
+                fits.add_data_set(obsTime, gInt, gList, visXX[gRows,:], weights=gWeights, pol='XX', source=refSrc)
+                fits.add_data_set(obsTime, gInt, gList, visXY[gRows,:], weights=gWeights, pol='XY', source=refSrc)
+                fits.add_data_set(obsTime, gInt, gList, visYX[gRows,:], weights=gWeights, pol='YX', source=refSrc)
+                fits.add_data_set(obsTime, gInt, gList, visYY[gRows,:], weights=gWeights, pol='YY', source=refSrc)
+                
     # Cleanup the last file
     fits.write()
     fits.close()
+    profiler.stop()
 
 
 if __name__ == "__main__":
@@ -447,6 +495,7 @@ if __name__ == "__main__":
                         help='optional tag to add to the filename')
     parser.add_argument('-f', '--force', action='store_true', 
                         help='force overwriting of existing FITS-IDI files')
+    add_profile_option(parser)
     args = parser.parse_args()
     main(args)
     
@@ -38,7 +38,7 @@ from lsl.correlator import fx as fxc
 from lsl.correlator.uvutils import compute_uvw
 from lsl.common.mcs import datetime_to_mjdmpm
 
-from utils import read_correlator_configuration
+from utils import read_correlator_configuration, load_visibilities
 
 import fitsidi
 
@@ -168,7 +168,7 @@ def main(args):
     observer = site.get_observer()
     
     # Load in the file file to figure out what to do
-    dataDict = numpy.load(lownames[0])
+    dataDict = load_visibilities(lownames[0])
     tStart = dataDict['tStart'].item()
     tInt = dataDict['tInt']
     
@@ -199,7 +199,7 @@ def main(args):
     visYY = dataDict['vis1YY'].astype(numpy.complex64)
     dataDict.close()
     
-    dataDict = numpy.load(highnames[0])
+    dataDict = load_visibilities(highnames[0])
     freqH = dataDict['freq1']
     dataDict.close()
     
@@ -218,7 +218,7 @@ def main(args):
     for filename in filenames:
         group = os.path.basename(filename).split('-vis2', 1)[0]
         if group not in obs_groups:
-            dataDict = numpy.load(filename)
+            dataDict = load_visibilities(filename)
             config, refSrc, junk1, junk2, junk3, junk4, antennas = read_correlator_configuration(dataDict)
             del dataDict
             
@@ -277,7 +277,7 @@ def main(args):
     for i,(lowname,highname) in enumerate(zip(lownames,highnames)):
         ## Load in the integration - lower band
         group = os.path.basename(filename).split('-vis2', 1)[0]
-        dataDict = numpy.load(lowname)
+        dataDict = load_visibilities(lowname)
         junk0, refSrc, junk1, junk2, junk3, junk4, antennas = read_correlator_configuration(dataDict)
         try:
             refSrc.name = refSrc.name.upper()	# For AIPS
@@ -320,7 +320,7 @@ def main(args):
         
         ## Load in the integration - upper band
         group = os.path.basename(filename).split('-vis2', 1)[0]
-        dataDict = numpy.load(highname)
+        dataDict = load_visibilities(highname)
         
         ## Make sure the frequencies are compatible - upper band
         cFreq = dataDict['freq1']
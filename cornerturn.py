@@ -0,0 +1,357 @@
+"""
+Module that provides a frequency-parallel X-engine.  The F-engine output for
+each sub-integration is corner turned into contiguous channel sub-bands that
+are cross-multiplied by separate worker processes and then gathered back
+into a single set of visibilities.  The arrays are moved between the stages
+by a Transport so that the same topology can be used with other transports
+in the future.
+"""
+
+# Python2 compatibility
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+import numpy
+import atexit
+import importlib
+import traceback
+import multiprocessing
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+__version__ = '0.1'
+__all__ = ['Transport', 'SharedMemoryTransport', 'get_subbands', 'CornerTurnXEngine']
+
+
+class Transport(object):
+    """
+    Base class for moving numpy arrays between the stages of a corner turn.
+    Arrays are created by the owner with empty() and described to the other
+    stages with get_handle().  The other stages turn that description back
+    into an array with attach().
+    """
+    
+    def empty(self, shape, dtype):
+        """
+        Return a new, uninitialized array with the specified shape and data
+        type that can be shared with the other stages.
+        """
+        
+        raise NotImplementedError
+        
+    def free(self, handle):
+        """
+        Release an array created with empty() given its handle.  There should
+        not be any references to the array left when this is called.
+        """
+        
+        raise NotImplementedError
+        
+    def get_handle(self, array):
+        """
+        Return a picklable description of an array created with empty().
+        """
+        
+        raise NotImplementedError
+        
+    def attach(self, handle):
+        """
+        Return the array described by the handle.
+        """
+        
+        raise NotImplementedError
+        
+    def detach(self, keep=()):
+        """
+        Release all attached arrays other than those with the handles in
+        'keep'.
+        """
+        
+        pass
+        
+    def close(self):
+        """
+        Release all of the arrays created with empty().
+        """
+        
+        pass
+
+
+class SharedMemoryTransport(Transport):
+    """
+    Transport that uses POSIX shared memory between processes on a single
+    node.  This requires Python 3.8 or later.
+    """
+    
+    def __init__(self):
+        if shared_memory is None:
+            raise RuntimeError("Shared memory transport requires Python 3.8 or later")
+            
+        self._owned = {}
+        self._attached = {}
+        
+    def __getstate__(self):
+        # Only the class itself is sent to the other stages
+        return {}
+        
+    def __setstate__(self, state):
+        self._owned = {}
+        self._attached = {}
+        
+    @staticmethod
+    def _release(segment, unlink=False):
+        try:
+            segment.close()
+        except BufferError:
+            # There are still arrays using this segment so leave it to the 
+            # garbage collector
+            pass
+        if unlink:
+            segment.unlink()
+            
+    def empty(self, shape, dtype):
+        dtype = numpy.dtype(dtype)
+        size = int(numpy.prod(shape))*dtype.itemsize
+        segment = shared_memory.SharedMemory(create=True, size=max([size, 1]))
+        array = numpy.ndarray(shape, dtype=dtype, buffer=segment.buf)
+        self._owned[segment.name] = (segment, array.__array_interface__['data'][0])
+        return array
+        
+    def free(self, handle):
+        segment, address = self._owned.pop(handle[0])
+        self._release(segment, unlink=True)
+        
+    def get_handle(self, array):
+        address = array.__array_interface__['data'][0]
+        for name in self._owned:
+            if self._owned[name][1] == address:
+                return (name, array.shape, array.dtype.str)
+        raise ValueError("Array was not created by this transport")
+        
+    def attach(self, handle):
+        name, shape, dtype = handle
+        try:
+            segment, array = self._attached[name]
+        except KeyError:
+            segment = shared_memory.SharedMemory(name=name)
+            array = numpy.ndarray(shape, dtype=dtype, buffer=segment.buf)
+            self._attached[name] = (segment, array)
+        return array
+        
+    def detach(self, keep=()):
+        keep = [handle[0] for handle in keep]
+        for name in list(self._attached.keys()):
+            if name not in keep:
+                segment, array = self._attached.pop(name)
+                del array
+                self._release(segment)
+                
+    def close(self):
+        self.detach()
+        for name in list(self._owned.keys()):
+            segment, address = self._owned.pop(name)
+            self._release(segment, unlink=True)
+
+
+def get_subbands(nChan, nSubband):
+    """
+    Split nChan channels into nSubband contiguous sub-bands that are as close
+    to the same size as possible.  Returns a list of two-element tuples of
+    the first and last+1 channel in each sub-band.
+    """
+    
+    nSubband = max([1, min([nSubband, nChan])])
+    edges = [nChan*i//nSubband for i in range(nSubband+1)]
+    return [(edges[i], edges[i+1]) for i in range(nSubband)]
+
+
+def _worker(engine, threads, cpus, transport, tasks, results):
+    """
+    Main loop for an X-engine worker process.  This receives the handles of
+    the F-engine output and the channel range to work on, cross-multiplies
+    that sub-band, and writes the visibilities into the shared output array.
+    """
+    
+    # Setup the threading and the CPU affinity before anything starts up
+    # OpenMP
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    if cpus is not None:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (AttributeError, OSError):
+            pass
+            
+    try:
+        xengine_full = importlib.import_module(engine).xengine_full
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+        return
+    results.put(('ready', None))
+    
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+            
+        hX, hvX, hY, hvY, hOut, c0, c1 = task
+        try:
+            transport.detach(keep=(hX, hvX, hY, hvY, hOut))
+            feoX, veoX = transport.attach(hX), transport.attach(hvX)
+            feoY, veoY = transport.attach(hY), transport.attach(hvY)
+            output = transport.attach(hOut)
+            
+            ## Corner turn - pull out this sub-band so that it is contiguous
+            sfeoX = numpy.ascontiguousarray(feoX[:,c0:c1,...])
+            sfeoY = numpy.ascontiguousarray(feoY[:,c0:c1,...])
+            
+            vis = xengine_full(sfeoX, veoX, sfeoY, veoY)
+            for k in range(4):
+                output[k,:,c0:c1] = vis[k]
+            results.put(('done', None))
+        except Exception:
+            results.put(('error', traceback.format_exc()))
+            
+        ## Drop the references to the shared arrays so that they can be
+        ## detached
+        feoX = veoX = feoY = veoY = output = None
+    transport.detach()
+
+
+class CornerTurnXEngine(object):
+    """
+    Frequency-parallel X-engine that splits the channels into contiguous
+    sub-bands and correlates each one in a separate worker process.  The
+    xengine_full() method is a drop-in replacement for the one provided by
+    the multirate modules.
+    
+    The worker processes use the xengine_full() function from the module
+    named by 'engine', e.g., 'multirate' or 'jit.multirate'.  By default the
+    available CPUs are divided evenly between the workers with each worker
+    pinned to its share so that a large job can use all of the sockets in a
+    machine.
+    """
+    
+    def __init__(self, nWorker, engine='multirate', threads=None, transport=None, pin=True):
+        self.nWorker = int(nWorker)
+        self.engine = engine
+        self.transport = transport if transport is not None else SharedMemoryTransport()
+        
+        # Divide up the CPUs
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = list(range(multiprocessing.cpu_count()))
+        if threads is None:
+            threads = max([1, len(cpus)//self.nWorker])
+        self.threads = threads
+        
+        # Start the workers - these are spawned rather than forked so that
+        # each one gets a fresh OpenMP runtime
+        try:
+            ctx = multiprocessing.get_context('spawn')
+        except AttributeError:
+            ctx = multiprocessing
+        self._results = ctx.Queue()
+        self._tasks = []
+        self._workers = []
+        for i in range(self.nWorker):
+            ## CPUs for this worker, sharing them if there are more workers
+            ## than CPUs
+            group = cpus[len(cpus)*i//self.nWorker:len(cpus)*(i+1)//self.nWorker]
+            if len(group) == 0:
+                group = [cpus[i % len(cpus)],]
+                
+            tasks = ctx.Queue()
+            worker = ctx.Process(target=_worker, args=(engine, threads, group if pin else None,
+                                                       self.transport, tasks, self._results))
+            worker.daemon = True
+            worker.start()
+            self._tasks.append(tasks)
+            self._workers.append(worker)
+        self._wait(len(self._workers))
+        
+        # Shared buffers for the F-engine output and the visibilities
+        self._buffers = {}
+        
+        atexit.register(self.close)
+        
+    def _wait(self, count):
+        """
+        Wait for the specified number of workers to report back and raise a
+        RuntimeError if any of them failed.
+        """
+        
+        errors = []
+        for i in range(count):
+            status, message = self._results.get()
+            if status == 'error':
+                errors.append(message)
+        if len(errors):
+            raise RuntimeError("X-engine worker failed:\n%s" % errors[0])
+            
+    def _get_buffer(self, name, shape, dtype):
+        """
+        Return a shared buffer with the specified name, shape, and data type,
+        replacing any existing buffer of that name that does not match.
+        """
+        
+        try:
+            buffer = self._buffers[name]
+            if buffer.shape != shape or buffer.dtype != dtype:
+                handle = self.transport.get_handle(buffer)
+                del buffer
+                del self._buffers[name]
+                self.transport.free(handle)
+                raise KeyError
+        except KeyError:
+            buffer = self.transport.empty(shape, dtype)
+            self._buffers[name] = buffer
+        return buffer
+        
+    def xengine_full(self, signalsFX, validFX, signalsFY, validFY):
+        """
+        X-engine for the outputs of fengine().
+        """
+        
+        nStand, nChan = signalsFX.shape[:2]
+        nBL = nStand*(nStand+1) // 2
+        
+        # Publish the F-engine output
+        handles = []
+        for name,data in (('feoX', signalsFX), ('veoX', validFX), ('feoY', signalsFY), ('veoY', validFY)):
+            buffer = self._get_buffer(name, data.shape, data.dtype)
+            buffer[...] = data
+            handles.append(self.transport.get_handle(buffer))
+        output = self._get_buffer('vis', (4,nBL,nChan), numpy.complex64)
+        handles.append(self.transport.get_handle(output))
+        
+        # Farm out the sub-bands and gather the results
+        subbands = get_subbands(nChan, self.nWorker)
+        for tasks,(c0,c1) in zip(self._tasks, subbands):
+            tasks.put(tuple(handles)+(c0, c1))
+        self._wait(min([len(self._tasks), len(subbands)]))
+        
+        output = output.copy()
+        return output[0,:,:], output[1,:,:], output[2,:,:], output[3,:,:]
+        
+    def close(self):
+        """
+        Stop the worker processes and release the shared buffers.
+        """
+        
+        for tasks,worker in zip(self._tasks, self._workers):
+            if worker.is_alive():
+                tasks.put(None)
+        for worker in self._workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        self._tasks = []
+        self._workers = []
+        
+        self._buffers = {}
+        self.transport.close()
@@ -55,6 +55,7 @@ LWASV_ROT = numpy.array([[ numpy.sin(LWASV_LAT)*numpy.cos(LWASV_LON), numpy.sin(
 CORR_CHANNELS = re.compile('corrchannels:(?P<channels>\d+)')
 CORR_INTTIME = re.compile('corrinttime:(?P<inttime>\d+(.\d*)?)')
 CORR_BASIS = re.compile('corrbasis:(?P<basis>(linear)|(circular)|(stokes))')
+CORR_ZOOM = re.compile('corrzoom:(?P<start>\d+(.\d*)?)-(?P<stop>\d+(.\d*)?)')
 
 
 ## Alternate phase center regexs
@@ -125,8 +126,11 @@ def main(args):
                     else:
                         sys.stderr.write("WARNING: No output correlation polarization basis defined, assuming 'linear'.\n")
                         corr_basis = 'linear'
+                    corr_zoom = [(float(mtch.group('start')), float(mtch.group('stop'))) for mtch in CORR_ZOOM.finditer(comments)]
+                    if len(corr_zoom) == 0:
+                        corr_zoom = None
                     if corr_channels is not None and corr_inttime is not None:
-                        setup = {'channels': corr_channels, 'inttime': corr_inttime, 'basis': corr_basis}
+                        setup = {'channels': corr_channels, 'inttime': corr_inttime, 'basis': corr_basis, 'zoom': corr_zoom}
                     else:
                         sys.stderr.write("WARNING: No or incomplete correlation configuration defined, setting to be defined at correlation time.\n")
                         
@@ -562,6 +566,9 @@ def main(args):
             fh.write("  Channels     %i\n" % corrConfig['setup']['channels'])
             fh.write("  IntTime      %.3f\n" % corrConfig['setup']['inttime'])
             fh.write("  PolBasis     %s\n" % corrConfig['setup']['basis'])
+            if corrConfig['setup'].get('zoom', None) is not None:
+                for start,stop in corrConfig['setup']['zoom']:
+                    fh.write("  ZoomBand     %.6f, %.6f\n" % (start, stop))
             fh.write("EndConfiguration\n")
             fh.write("\n")
         ## Source
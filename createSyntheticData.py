@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Create a synthetic eLWA observation of a point source, VDIF files for the VLA
+and DRX files for LWA stations, along with a matching superCorrelator.py
+configuration file.
+"""
+
+# Python3 compatibility
+from __future__ import print_function, division, absolute_import
+import sys
+if sys.version_info > (3,):
+    xrange = range
+    
+import os
+import sys
+import time
+import numpy
+import argparse
+import calendar
+from datetime import datetime
+
+from synthetic import *
+
+
+def main(args):
+    # Start time
+    if args.start is None:
+        tStart = int(time.time())
+    else:
+        tStart = datetime.strptime(args.start, "%Y/%m/%d %H:%M:%S")
+        tStart = calendar.timegm(tStart.timetuple())
+        
+    # Source - default to something transiting at the start of the observation
+    source = get_transiting_source(tStart, args.dec, name=args.source_name)
+    if args.ra is not None:
+        source._ra = args.ra
+        
+    # Build up the inputs
+    rng = numpy.random.RandomState(args.seed)
+    inputs = []
+    for name in args.lwa:
+        inputs.append( get_lwa_station(name, clock_offset=rng.randn()*args.clock_scatter*1e-6) )
+    inputs.extend( get_vla_layout(args.vla, clock_offsets=rng.randn(args.vla)*args.clock_scatter*1e-6) )
+    if len(inputs) < 2:
+        raise RuntimeError("At least two stations are needed for a synthetic observation")
+    for inp in inputs:
+        inp.filename = os.path.join(args.directory, inp.filename)
+    if not os.path.exists(args.directory):
+        os.makedirs(args.directory)
+        
+    # Report
+    print("Synthetic observation of %s at %s, %s" % (source.name, source._ra, source._dec))
+    print("  Start: %s" % datetime.utcfromtimestamp(tStart))
+    print("  Duration: %.3f s" % args.duration)
+    print("  Stations:")
+    for inp in inputs:
+        print("    %-6s %4s, clock offset %+.3f us -> %s" % (inp.name, inp.type.upper(), inp.clock_offset*1e6, inp.filename))
+        
+    # Generate the data and the configuration file
+    simulate_observation(inputs, source, tStart, args.duration,
+                         vdif_freq=args.vdif_freq*1e6, vdif_rate=2*args.vdif_bandwidth*1e6,
+                         drx_freqs=(args.drx_freqs[0]*1e6, args.drx_freqs[1]*1e6), drx_rate=args.drx_rate*1e6,
+                         snr=args.snr, seed=args.seed)
+    write_configuration(os.path.join(args.directory, args.output), inputs, source, args.duration,
+                        write_clock_offsets=not args.hide_clock_offsets)
+    print("Wrote configuration to '%s'" % os.path.join(args.directory, args.output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='create a synthetic eLWA observation and correlator configuration file',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    parser.add_argument('-v', '--vla', type=int, default=2,
+                        help='number of VLA antennas')
+    parser.add_argument('-l', '--lwa', type=str, default='LWA1',
+                        help='comma separated list of LWA stations; "none" for no LWA stations')
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help='duration of the observation in seconds')
+    parser.add_argument('-s', '--start', type=str,
+                        help='start time of the observation as "YYYY/MM/DD HH:MM:SS"; default is now')
+    parser.add_argument('-n', '--source-name', type=str, default='Synthetic',
+                        help='name of the source')
+    parser.add_argument('-r', '--ra', type=str,
+                        help='J2000 right ascension of the source; default is the LST at the start')
+    parser.add_argument('-e', '--dec', type=str, default='+34:00:00',
+                        help='J2000 declination of the source')
+    parser.add_argument('--vdif-freq', type=float, default=60.0,
+                        help='VDIF center frequency in MHz')
+    parser.add_argument('--vdif-bandwidth', type=float, default=16.0,
+                        help='VDIF bandwidth in MHz')
+    parser.add_argument('--drx-freqs', type=str, default='60.0,74.0',
+                        help='comma separated list of the two DRX tuning frequencies in MHz')
+    parser.add_argument('--drx-rate', type=float, default=19.6,
+                        help='DRX sample rate in MHz')
+    parser.add_argument('--snr', type=float, default=0.1,
+                        help='source-to-noise power ratio')
+    parser.add_argument('-c', '--clock-scatter', type=float, default=1.0,
+                        help='standard deviation in us of the random station clock offsets')
+    parser.add_argument('--hide-clock-offsets', action='store_true',
+                        help='write zero clock offsets to the configuration file so that they need to be found')
+    parser.add_argument('--seed', type=int,
+                        help='random number generator seed')
+    parser.add_argument('-w', '--directory', type=str, default='.',
+                        help='directory to write the data and configuration file to')
+    parser.add_argument('-o', '--output', type=str, default='synthetic.config',
+                        help='name of the configuration file to write')
+    args = parser.parse_args()
+    args.lwa = [name for name in args.lwa.split(',') if name.lower() != 'none']
+    args.drx_freqs = [float(v) for v in args.drx_freqs.split(',')]
+    main(args)
+    
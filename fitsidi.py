@@ -1069,11 +1069,14 @@ class Idi(WriterBase):
             except IndexError:
                 break
                 
-            # Sort the data by packed baseline
+            # Sort the data by packed baseline - the baselines can change
+            # between data sets with baseline-dependent averaging
             try:
-                if len(dataSet.visibilities) != len(order):
+                if dataSet.baselines is not orderBaselines \
+                   and (len(dataSet.baselines) != len(orderBaselines) or dataSet.baselines != orderBaselines):
                     raise NameError
             except NameError:
+                orderBaselines = dataSet.baselines
                 order = dataSet.argsort(mapper=mapper, shift=self._PACKING_BIT_SHIFT)
                 try:
                     del baselineMapped
@@ -24,12 +24,15 @@ from lsl.astro import utcjd_to_unix
 from lsl.writer.fitsidi import NUMERIC_STOKES
 
 from flagger import *
+from utils import add_profile_option, Profiler
 
 
 def main(args):
     # Parse the command line
     filenames = args.filename
     
+    profiler = Profiler(args.profile, rate=args.profile_rate, default='flagIDI-profile')
+    profiler.start()
     for filename in filenames:
         t0 = time.time()
         print("Working on '%s'" % os.path.basename(filename))
@@ -344,6 +347,7 @@ def main(args):
         hdulist.close()
         print("  -> Flagged FITS IDI file is '%s'" % outname)
         print("  Finished in %.3f s" % (time.time()-t0,))
+    profiler.stop()
 
 
 if __name__ == "__main__":
@@ -364,6 +368,7 @@ if __name__ == "__main__":
                         help='drop all existing FLAG tables')
     parser.add_argument('-f', '--force', action='store_true', 
                         help='force overwriting of existing FITS-IDI files')
+    add_profile_option(parser)
     args = parser.parse_args()
     if args.freq_range is not None:
         sections = args.freq_range.split(',')
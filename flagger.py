@@ -165,6 +165,66 @@ def flag_bandpass_time(times, data, width=30.0, clip=3.0, time_range=None):
     return drift, bad
 
 
+def get_spectral_kurtosis(signalsF, validF):
+    """
+    Given a 3-D (inputs by channels by windows) array of F-engine output and
+    the 2-D (inputs by windows) validity mask, return a two-element tuple of
+    the 2-D (inputs by channels) spectral kurtosis estimator computed over 
+    the valid windows and the number of valid windows for each input.  The
+    estimator is one for Gaussian noise with a standard deviation of about
+    sqrt(4/M) for M windows.
+    """
+    
+    valid = (validF != 0)
+    power = signalsF.real**2 + signalsF.imag**2
+    power *= valid[:,numpy.newaxis,:]
+    
+    M = valid.sum(axis=1).astype(numpy.float64)[:,numpy.newaxis]
+    S1 = power.sum(axis=2, dtype=numpy.float64)
+    S2 = (power**2).sum(axis=2, dtype=numpy.float64)
+    
+    sk = numpy.ones(S1.shape, dtype=numpy.float64)
+    good = (S1 > 0) & (M > 1)
+    Mb = numpy.broadcast_to(M, S1.shape)[good]
+    sk[good] = (Mb+1)/(Mb-1) * (Mb*S2[good]/S1[good]**2 - 1)
+    return sk, M[:,0]
+
+
+def flag_fengine(signalsF, validF, clip=5.0):
+    """
+    Given a 3-D (inputs by channels by windows) array of F-engine output and
+    the 2-D (inputs by windows) validity mask, flag RFI in place before the 
+    X-engine.  Windows with an excess of total power are marked as invalid 
+    and zeroed, since the X-engines sum over all windows, and then channels
+    with a spectral kurtosis that deviates from one by more than 'clip' sigma
+    over the remaining windows are zeroed.  Returns a 2-D (inputs by 
+    channels) boolean array that is True for the channels that were kept.
+    """
+    
+    # Power excess - impulsive RFI that shows up across the band
+    power = (signalsF.real**2 + signalsF.imag**2).sum(axis=1)
+    for i in range(power.shape[0]):
+        valid = numpy.where(validF[i,:] != 0)[0]
+        if valid.size < 2:
+            continue
+        pm = numpy.median(power[i,valid])
+        ps = 1.4826*numpy.median(numpy.abs(power[i,valid] - pm))
+        if ps == 0:
+            continue
+        bad = valid[numpy.where(power[i,valid] - pm > clip*ps)[0]]
+        validF[i,bad] = 0
+        signalsF[i,:,bad] = 0.0
+        
+    # Spectral kurtosis - narrow band and intermittent RFI
+    sk, M = get_spectral_kurtosis(signalsF, validF)
+    skStd = numpy.sqrt(4.0/numpy.maximum(M, 1))[:,numpy.newaxis]
+    good = numpy.abs(sk - 1) <= clip*skStd
+    signalsF[~good,:] = 0.0
+    
+    # Done
+    return good
+
+
 def mask_bandpass(antennas, times, freq, data, width_time=30.0, width_freq=250e3, clip=3.0, grow=True, freq_range=None, time_range=None, verbose=False):
     """
     Given a list of antennas, an array of times, and array of frequencies, 
@@ -9,34 +9,80 @@ import os
 import imp
 import sys
 import glob
+import json
 import time
+import errno
+import shlex
+import fcntl
 import numpy
 import shutil
-import importlib
+import hashlib
+import importlib.machinery
+import multiprocessing
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 import platform
 import warnings
+import sysconfig
 import subprocess
 from tempfile import mkdtemp
-from setuptools import Extension
-from distutils import log
-from distutils.dist import Distribution
 
 from jinja2 import Environment, FileSystemLoader, Template
 
 from lsl.correlator.fx import null_window
 
 
-__version__ = '0.3'
-__all__ = ['JustInTimeOptimizer',]
+__version__ = '0.4'
+__all__ = ['PFB_WINDOWS', 'CacheLock', 'JustInTimeOptimizer', 'warmup']
 
 
 # Setup
 _CACHE_DIR = os.path.dirname( os.path.abspath(__file__) )
 
+## Shared module cache location and size limit in MB
+_MODULE_CACHE_DIR = os.getenv('ELWA_JIT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'elwa-jit'))
+_MODULE_CACHE_SIZE = float(os.getenv('ELWA_JIT_CACHE_SIZE', 512))
+
+## Placeholder module name used while computing the content hash
+_MODULE_PLACEHOLDER = 'JIT_MODULE_NAME_PLACEHOLDER'
+
+## Name of the file in the module cache that stores the compiler probe results
+_PROBE_FILE = 'compiler.json'
+
+## Name of the file in the module cache that stores the measured variants
+_MEASURE_FILE = 'measure.json'
+
+## Whether or not to measure the function variants by default
+_MEASURE = os.getenv('ELWA_JIT_MEASURE', '0').lower() in ('1', 'true', 'yes')
+
+## Default FFTW planning rigor and the valid values
+_FFTW_RIGOR = os.getenv('ELWA_JIT_FFTW_RIGOR', 'measure').lower()
+_FFTW_RIGORS = ('estimate', 'measure', 'patient', 'exhaustive')
+
+## Stand block size and the minimum number of stands for the tiled X-engine
+_XENGINE_TILE = 4
+_XENGINE_TILE_THRESHOLD = 16
+
+## Windows available for the polyphase filter bank
+PFB_WINDOWS = ('hanning', 'hamming', 'blackman')
+
+## Instruction set levels for the modules, best first, as (name, CPU features
+## needed, extra compiler flags) tuples.  The CPU feature names are those used
+## by both /proc/cpuinfo and __builtin_cpu_supports().
+_ISA_LEVELS = [('avx512', ('avx512f', 'avx512dq', 'avx512bw', 'avx512vl', 'avx2', 'fma', 'f16c'),
+                ('-mavx512f', '-mavx512dq', '-mavx512bw', '-mavx512vl', '-mavx2', '-mfma', '-mf16c',
+                 '-mprefer-vector-width=512', '-fcx-limited-range')),
+               ('avx2', ('avx2', 'fma', 'f16c'), ('-mavx2', '-mfma', '-mf16c', '-fcx-limited-range')),
+               ('generic', (), ())]
+
+## Instruction set level to use instead of the best one supported by the host
+_ISA = os.getenv('ELWA_JIT_ISA', None)
+
+## OpenMP schedule kinds, as used by omp_set_schedule()
+_OMP_SCHEDULES = {'static': 1, 'dynamic': 2, 'guided': 3}
+
 try:
     _EXTENSION_SUFFIXES = importlib.machinery.EXTENSION_SUFFIXES
 except AttributeError:
@@ -63,6 +109,107 @@ class TempBuildDir(object):
             pass
 
 
+def _get_variant_name(variant):
+    """
+    Return a string name for a (function name, OpenMP schedule) tuple.
+    """
+    
+    if variant[1] is None:
+        return variant[0]
+    return '%s/%s,%i' % (variant[0], variant[1][0], variant[1][1])
+
+
+def _get_cpu_model():
+    """
+    Return the model name of the host CPU.
+    """
+    
+    cpu = platform.processor() or platform.machine()
+    try:
+        with open('/proc/cpuinfo', 'r') as fh:
+            for line in fh:
+                if line.startswith('model name'):
+                    cpu = line.split(':', 1)[1].strip()
+                    break
+    except (IOError, OSError):
+        pass
+    return cpu
+
+
+def _get_cpu_features():
+    """
+    Return a set of the instruction set features supported by the host CPU.
+    """
+    
+    features = set()
+    try:
+        with open('/proc/cpuinfo', 'r') as fh:
+            for line in fh:
+                if line.startswith('flags'):
+                    features.update(line.split(':', 1)[1].split())
+                    break
+    except (IOError, OSError):
+        pass
+    return features
+
+
+class CacheLock(object):
+    """
+    Class to provide an advisory, file-based lock on an entry in the JIT module
+    cache so that concurrent processes wait on a single build of a module rather
+    than all building it.
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self.fh = open("%s.lock" % self.name, 'w+')
+        self.locked = False
+        
+    def __del__(self):
+        self.unlock()
+        self.fh.close()
+        
+    def __enter__(self):
+        self.lock()
+        return self
+        
+    def __exit__(self, type, value, tb):
+        self.unlock()
+        
+    def lock(self, block=True):
+        if not self.locked:
+            flags = fcntl.LOCK_EX
+            if not block:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(self.fh, flags)
+                self.locked = True
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                    
+        return self.locked
+        
+    def unlock(self):
+        if not self.locked:
+            return False
+            
+        fcntl.flock(self.fh, fcntl.LOCK_UN)
+        self.locked = False
+        return True
+        
+    def remove(self):
+        """
+        Delete the lock file.  This should only be called while the lock is 
+        held and after the cache entry that it guards has been removed.
+        """
+        
+        try:
+            os.unlink(self.fh.name)
+        except OSError:
+            pass
+
+
 class JustInTimeOptimizer(object):
     # Mappings
     ## Real or complex
@@ -93,7 +240,7 @@ class JustInTimeOptimizer(object):
                       'complex64': 'float complex', 
                       'complex128': 'double complex'}
                      
-    def __init__(self, cache_dir=None, verbose=True):
+    def __init__(self, cache_dir=None, cache_size=None, measure=None, rigor=None, verbose=True):
         # Setup the Python version tag
         self._tag = "py%i%i" % (sys.version_info.major, sys.version_info.minor)
         try:
@@ -101,76 +248,297 @@ class JustInTimeOptimizer(object):
         except AttributeError:
             pass
             
-        # Setup the module cache and fill it
+        # Setup the module cache
         if cache_dir is None:
-            cache_dir = os.path.dirname(__file__)
-        self.cache_dir = os.path.abspath(cache_dir)
+            cache_dir = _MODULE_CACHE_DIR
+        if cache_size is None:
+            cache_size = _MODULE_CACHE_SIZE
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.cache_size = int(cache_size*1024**2)
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
         self._cache = {}
-        self._load_cache_dir(verbose=verbose)
+        self.verbose = verbose
+        if verbose:
+            print("JIT cache directory: %s" % self.cache_dir)
+            
+        # Setup the measured function variant cache
+        if measure is None:
+            measure = _MEASURE
+        self.measure = measure
+        self._choices = {}
+        self._cpu = self._get_cpu_key()
+        
+        # Setup the FFTW planning rigor and the wisdom file for this CPU
+        if rigor is None:
+            rigor = _FFTW_RIGOR
+        if rigor not in _FFTW_RIGORS:
+            raise RuntimeError("Unknown FFTW rigor: %s" % rigor)
+        self.rigor = rigor
+        cpu = hashlib.sha256(_get_cpu_model().encode()).hexdigest()[:12]
+        self.wisdom_file = os.path.join(self.cache_dir, 'fftwf_wisdom_%s.txt' % cpu)
         
         # Setup the compiler
-        cflags, ldflags = self.get_flags()
+        cflags, ldflags, isas = self._load_flags()
         self.cflags = cflags
         self.ldflags = ldflags
+        self._isas = [level for level in _ISA_LEVELS if level[0] in isas]
         
         # Setup the template cache and fill it
         self._templates = {}
         self._load_templates()
         
-    def _load_cache_dir(self, verbose=False):
+        # Setup the instruction set and the digest of the headers that the 
+        # modules depend on
+        self._set_isa(self._get_host_isa())
+        if verbose:
+            print("JIT instruction set: %s" % self.isa)
+        
+    def _get_cpu_key(self):
         """
-        Populate the cache with with valid .so modules that have been found.
+        Return a string that identifies the host CPU and the number of threads
+        that will be used for the measured function variants.
         """
         
-        if verbose:
-            print("JIT cache directory: %s" % self.cache_dir)
+        cpu = _get_cpu_model()
+        nThread = os.getenv('OMP_NUM_THREADS', str(multiprocessing.cpu_count()))
+        return '%s/%s' % (cpu, nThread)
+        
+    def _get_host_isa(self):
+        """
+        Return the name of the best instruction set level that is supported by
+        both the compiler and the host CPU, or the one set by ELWA_JIT_ISA.
+        """
+        
+        if _ISA is not None:
+            if _ISA in [level[0] for level in self._isas]:
+                return _ISA
+            warnings.warn("Unknown or unsupported JIT instruction set '%s', ignoring" % _ISA, RuntimeWarning)
             
-        # # Make sure the cache directory is in the path as well
-        # if self.cache_dir not in sys.path:
-        #     sys.path.append(self.cache_dir)
+        features = _get_cpu_features()
+        for name,needed,flags in self._isas:
+            if all([feature in features for feature in needed]):
+                return name
+        return 'generic'
+        
+    def _set_isa(self, isa):
+        """
+        Set the instruction set level that new modules are built for.
+        """
+        
+        for name,needed,flags in _ISA_LEVELS:
+            if name == isa:
+                break
+        self.isa = name
+        self.isa_features = list(needed)
+        self.isa_flags = list(flags)
+        self._header_digest = self._get_header_digest()
+        
+    def _get_fallback_isa(self):
+        """
+        Return the name of the next instruction set level below the current one
+        that is supported by the compiler.
+        """
+        
+        names = [level[0] for level in self._isas]
+        try:
+            return names[names.index(self.isa)+1]
+        except (ValueError, IndexError):
+            return 'generic'
             
-        # Come up with a 'reference time' that we can use to see what may be outdated
-        refFiles = glob.glob(os.path.join(os.path.dirname(__file__), '*.tmpl'))
-        refFiles.append(__file__)
-        refTime = max([os.stat(refFile)[8] for refFile in refFiles])
+    def _get_header_digest(self):
+        """
+        Return a hashlib object seeded with everything outside of the rendered
+        source that determines what a module compiles to:  the local headers,
+        the compiler flags, the NumPy version, and the Python version tag.
+        """
+        
+        digest = hashlib.sha256()
+        for header in sorted(glob.glob(os.path.join(_CACHE_DIR, '*.h'))):
+            with open(header, 'rb') as fh:
+                digest.update(fh.read())
+        for flags in (self.cflags, self.isa_flags, self.ldflags):
+            digest.update(' '.join(flags).encode())
+        digest.update(numpy.__version__.encode())
+        digest.update(self._tag.encode())
+        return digest
+        
+    def _get_module_name(self, source):
+        """
+        Given rendered C source that uses the module name placeholder, return
+        the content-hashed name of the module.
+        """
+        
+        digest = self._header_digest.copy()
+        digest.update(source.encode())
+        return 'jit_%s_%s_%s' % (digest.hexdigest()[:24], self.isa, self._tag)
+        
+    def _find_module(self, module):
+        """
+        Return the filename of the compiled version of the specified module in
+        the cache or None if it has not been built.
+        """
         
-        # Find the modules and load the valid ones
-        any_purged = False
         for soExt in _EXTENSION_SUFFIXES:
-            for soFile in glob.glob(os.path.join(self.cache_dir, '*%s' % soExt)):
-                soTime = os.stat(soFile)[8]
-                module = os.path.splitext(os.path.basename(soFile))[0]
-                module = module.split('.', 1)[0]
-                if module.find(self._tag) == -1:
-                    continue
-                if soTime < refTime:
-                    ## This file is too old, clean it out
-                    any_purged = True
-                    if verbose:
-                        print(" -> Purged %s as outdated" % module)
-                    for ext in ('.c', soExt):
-                        try:
-                            os.unlink(os.path.join(self.cache_dir, '%s%s' % (module, ext)))
-                        except OSError as e:
-                            pass
-                            
+            soFile = os.path.join(self.cache_dir, '%s%s' % (module, soExt))
+            if os.path.exists(soFile):
+                return soFile
+        return None
+        
+    def _load_module(self, module, soFile):
+        """
+        Load a compiled module from the cache and mark it as recently used.
+        """
+        
+        try:
+            os.utime(soFile, None)
+        except OSError:
+            pass
+        info = imp.find_module(module, [self.cache_dir,])
+        loadedModule = imp.load_module('jit.'+module, *info)
+        info[0].close()
+        return loadedModule
+        
+    def _evict_cache(self):
+        """
+        Remove the least recently used modules from the cache until it is below
+        the size limit.  Modules that are loaded in this process or are locked
+        by another process are skipped.
+        """
+        
+        # Find the modules and their sizes
+        loaded = [os.path.basename(mod.__file__) for mod in self._cache.values()]
+        entries = []
+        total = 0
+        for soExt in _EXTENSION_SUFFIXES:
+            for soFile in glob.glob(os.path.join(self.cache_dir, 'jit_*%s' % soExt)):
+                module = os.path.basename(soFile)[:-len(soExt)]
+                try:
+                    size = os.path.getsize(soFile)
+                    srcname = os.path.join(self.cache_dir, '%s.c' % module)
+                    if os.path.exists(srcname):
+                        size += os.path.getsize(srcname)
+                    entries.append((os.path.getmtime(soFile), module, soFile, size))
+                    total += size
+                except OSError:
+                    pass
+                    
+        # Evict, oldest first
+        entries.sort()
+        for mtime,module,soFile,size in entries:
+            if total <= self.cache_size:
+                break
+            if os.path.basename(soFile) in loaded:
+                continue
+                
+            lock = CacheLock(os.path.join(self.cache_dir, module))
+            if lock.lock(block=False):
+                for filename in (soFile, os.path.join(self.cache_dir, '%s.c' % module)):
+                    try:
+                        os.unlink(filename)
+                    except OSError:
+                        pass
+                lock.remove()
+                lock.unlock()
+                total -= size
+                if self.verbose:
+                    print(" -> Evicted %s from the JIT cache" % module)
+                    
+        # Clean up any lock files that have been left behind by modules that
+        # are no longer in the cache
+        for lockFile in glob.glob(os.path.join(self.cache_dir, 'jit_*.lock')):
+            module = os.path.basename(lockFile)[:-5]
+            if self._find_module(module) is not None:
+                continue
+                
+            lock = CacheLock(os.path.join(self.cache_dir, module))
+            if lock.lock(block=False):
+                if self._find_module(module) is None:
+                    lock.remove()
+                lock.unlock()
+                    
+    def _get_compiler_key(self):
+        """
+        Return a two-element tuple of the compiler command used for JIT builds
+        and a key that identifies it, its version, and the environment that the
+        flags are probed in.
+        """
+        
+        cc = os.getenv('CC', sysconfig.get_config_var('CC') or 'cc')
+        try:
+            version = subprocess.check_output(shlex.split(cc)+['--version'], stderr=subprocess.STDOUT)
+            try:
+                version = version.decode()
+            except AttributeError:
+                # Python2 catch
+                pass
+        except (OSError, subprocess.CalledProcessError):
+            version = 'unknown'
+            
+        key = hashlib.sha256()
+        for value in (cc, version, os.getenv('CFLAGS', ''), os.getenv('PKG_CONFIG_PATH', '')):
+            key.update(value.encode())
+        return cc, key.hexdigest()[:16]
+        
+    def _load_flags(self):
+        """
+        Return a three-element tuple of CFLAGS, LDFLAGS, and the names of the 
+        instruction set levels supported by the compiler, using the results 
+        saved in the cache directory for this compiler if they are available 
+        and probing (and saving) them if not.  Probes that could not find FFTW
+        through pkg-config or OpenMP are not saved so that they are re-run the 
+        next time.
+        """
+        
+        probename = os.path.join(self.cache_dir, _PROBE_FILE)
+        cc, key = self._get_compiler_key()
+        
+        # Hold the lock for the whole read-modify-write so that concurrent 
+        # first runs wait on a single probe and do not drop each other's 
+        # entries
+        with CacheLock(probename):
+            try:
+                with open(probename, 'r') as fh:
+                    probes = json.load(fh)
+            except (IOError, OSError, ValueError):
+                probes = {}
+                
+            try:
+                cflags, ldflags = probes[key]['cflags'], probes[key]['ldflags']
+                isas = probes[key]['isas']
+            except (KeyError, TypeError):
+                cflags, ldflags, missing = self.get_flags(return_missing=True)
+                isas = self.get_isas(cflags)
+                
+                if missing:
+                    if self.verbose:
+                        print("JIT compiler probe did not find %s, not saving the results" % ' or '.join(missing))
                 else:
-                    ## This file is OK, load it and cache it
-                    if module not in self._cache:
-                        if verbose:
-                            print(" -> Loaded %s" % module)
-                        info = imp.find_module(module, [self.cache_dir,])
-                        loadedModule = imp.load_module('jit.'+module, *info)
-                        info[0].close()
-                        self._cache[module] = loadedModule
+                    ## Save with a rename so that readers never see a partial file
+                    probes[key] = {'compiler': cc, 'cflags': cflags, 'ldflags': ldflags, 'isas': isas}
+                    partial = '%s.%i.tmp' % (probename, os.getpid())
+                    try:
+                        with open(partial, 'w') as fh:
+                            json.dump(probes, fh, indent=2, sort_keys=True)
+                        os.rename(partial, probename)
+                    except (IOError, OSError) as e:
+                        warnings.warn("Cannot save the compiler probe results: %s" % str(e), RuntimeWarning)
                         
-    def get_flags(self, cc=None):
+        return cflags, ldflags, isas
+        
+    def get_flags(self, cc=None, return_missing=False):
         """
         Return a two-element tuple of CFLAGS and LDFLAGS for the compiler to use for
-        JIT code generation.
+        JIT code generation.  If return_missing is True, a third element is 
+        returned that lists the names of the probes that failed and fell back to 
+        defaults, 'fftw3f' and/or 'openmp'.
         """
         
-        cflags, ldflags = [], []
+        cflags, ldflags, missing = [], [], []
         
         # NumPy
         cflags.append( '-DNPY_NO_DEPRECATED_API=NPY_1_7_API_VERSION' )
@@ -192,9 +560,10 @@ class JustInTimeOptimizer(object):
                 # Python2 catch
                 pass
             ldflags.extend( flags.split() )
-        except subprocess.CalledProcessError:
+        except (OSError, subprocess.CalledProcessError):
             cflags.extend( [] )
             ldflags.extend( ['-lfftw3f', '-lm'] )
+            missing.append( 'fftw3f' )
             
         # OpenMP
         from distutils import sysconfig
@@ -224,12 +593,61 @@ return 0;
                 ldflags.append( '-lgomp' )
                 os.unlink('openmp_test')
             except subprocess.CalledProcessError:
-                pass
+                missing.append( 'openmp' )
                 
         # Other
         cflags.append( '-O2' )
         
-        return cflags, ldflags
+        if return_missing:
+            return cflags, ldflags, missing
+        else:
+            return cflags, ldflags
+        
+    def get_isas(self, cflags):
+        """
+        Given a list of CFLAGS, return a list of the names of the instruction set
+        levels that the compiler can build for.
+        """
+        
+        from distutils import sysconfig
+        from distutils import ccompiler
+        compiler = ccompiler.new_compiler()
+        sysconfig.get_config_vars()
+        sysconfig.customize_compiler(compiler)
+        cc = compiler.compiler
+        
+        isas = []
+        with TempBuildDir():
+            with open('isa_test.c', 'w') as fh:
+                fh.write(r"""#include <complex.h>
+int main(void) {
+float complex a[16], b[16];
+int i;
+for(i=0; i<16; i++) {
+a[i] = i;
+b[i] = a[i]*conjf(a[i]);
+}
+__builtin_cpu_init();
+return __builtin_cpu_supports("sse2") ? (int) crealf(b[1]) : 0;
+}
+            """)
+            for name,needed,flags in _ISA_LEVELS:
+                if len(flags) == 0:
+                    isas.append(name)
+                    continue
+                try:
+                    call = []
+                    call.extend(cc)
+                    call.extend(cflags)
+                    call.extend(flags)
+                    call.extend(['isa_test.c', '-o', 'isa_test'])
+                    output = subprocess.check_output(call, stderr=subprocess.STDOUT)
+                    isas.append(name)
+                    os.unlink('isa_test')
+                except (OSError, subprocess.CalledProcessError):
+                    pass
+                    
+        return isas
         
     def _load_templates(self):
         """
@@ -244,18 +662,26 @@ return 0;
             base = os.path.splitext(os.path.basename(tmplFile))[0]
             self._templates[base] = env.get_template(os.path.basename(tmplFile))
             
-    def _build_module(self, srcName, module, verbose=True):
+    def _build_module(self, source, module, verbose=True):
         """
-        Simple function to build an extension.
+        Simple function to build an extension from the provided source and 
+        atomically move it into the cache.
         """
         
+        from setuptools import Extension
+        from distutils import log
+        from distutils.dist import Distribution
+        
         # Setup
         with TempBuildDir():
             if verbose:
                 log.set_verbosity(log.INFO)
+            srcName = '%s.c' % module
+            with open(srcName, 'w') as fh:
+                fh.write(source)
             ext = Extension(module, [srcName,],
                             include_dirs=[os.path.abspath(_CACHE_DIR), numpy.get_include()], libraries=['m'],
-                            extra_compile_args=self.cflags, extra_link_args=self.ldflags)
+                            extra_compile_args=self.cflags+self.isa_flags, extra_link_args=self.ldflags)
             dist = Distribution(attrs={'name': "dummy_package_%s" % module,
                                        'version': '0.0',
                                        'description': 'This is a dummy package to help build the JIT extensions',
@@ -265,19 +691,32 @@ return 0;
             # Build
             dist.run_command('build_ext')
             
-            # "Install"
+            # "Install" - copy to a temporary name in the cache directory so 
+            # that the final rename is atomic
             modules = glob.glob(os.path.join('.', 'build', 'lib*', '*'))
+            modules.append(srcName)
             for modname in modules:
-                shutil.copy(modname, os.path.join(self.cache_dir, os.path.basename(modname)))
+                final = os.path.join(self.cache_dir, os.path.basename(modname))
+                partial = '%s.%i.tmp' % (final, os.getpid())
+                shutil.copy(modname, partial)
+                os.rename(partial, final)
                 
         return True
         
-    def get_module(self, dtype, nStand, nSamps, nChan, nOverlap, ClipLevel, window=null_window):
+    def get_module(self, dtype, nStand, nSamps, nChan, nOverlap, ClipLevel, window=null_window, nTap=4, pfbWindow='hanning'):
         """
         Generate an optimized version of the various time-domain functions 
         for the given parameters, update the cache, and return the module.
+        The number of taps and the window used by the polyphase filter bank
+        are set by 'nTap' and 'pfbWindow'.
         """
         
+        # Validate the polyphase filter bank setup
+        if nTap < 1:
+            raise ValueError("Invalid number of PFB taps: %i" % nTap)
+        if pfbWindow not in PFB_WINDOWS:
+            raise ValueError("Unknown PFB window: %s" % pfbWindow)
+            
         # Figure out if we are in window mode or not
         useWindow = False
         if window is not null_window:
@@ -291,14 +730,13 @@ return 0;
         except KeyError:
             raise RuntimeError("Unknown data type: %s" % dtype)
             
-        # Build up the file names we need
-        module = '%s_%i_%i_%i_%i_%i_%s' % (dtype, nStand, nSamps, nChan, nOverlap, ClipLevel, self._tag)
-        srcname = os.path.join(self.cache_dir, '%s.c' % module)
+        # Build up the name we need for the in-memory cache
+        name = '%s_%i_%i_%i_%i_%i_%i_%s_%s_%s' % (dtype, nStand, nSamps, nChan, nOverlap, ClipLevel, nTap, pfbWindow, self.isa, self._tag)
         
         # Is it cached?
         loadedModule = None
         try:
-            loadedModule = self._cache[module]
+            loadedModule = self._cache[name]
             ## Yes!
         except KeyError:
             ## No, additional work is needed
@@ -309,27 +747,174 @@ return 0;
                 nFFT = nSamps // (nChan//nOverlap) - nChan//(nChan//nOverlap) + 1
             nBL = nStand*(nStand+1)//2
             
-            ### Generate the code
-            config = {'module':module, 'dtype':dtype, 'dtypeN':dtypeN, 'dtypeC':dtypeC, 
+            ### Generate the code and find its content-hashed module name
+            config = {'module':_MODULE_PLACEHOLDER, 'dtype':dtype, 'dtypeN':dtypeN, 'dtypeC':dtypeC, 
                       'nStand':'%iL'%nStand, 'nSamps':'%iL'%nSamps, 'nChan':'%iL'%nChan, 'nOverlap':'%iL'%nOverlap, 
-                      'nFFT':'%iL'%nFFT, 'nBL':'%iL'%nBL, 'ClipLevel':ClipLevel, 'useWindow':useWindow}
-            with open(srcname, 'w') as fh:
-                fh.write( self._templates['head'].render(**config) )
-                fh.write( self._templates[funcTemplate].render(**config) )
-                fh.write( self._templates['post'].render(**config) )
+                      'nFFT':'%iL'%nFFT, 'nBL':'%iL'%nBL, 'nTile':'%iL'%_XENGINE_TILE, 'ClipLevel':ClipLevel, 'useWindow':useWindow,
+                      'nTap':nTap, 'pfbWindow':pfbWindow,
+                      'isa':self.isa, 'isaFeatures':self.isa_features}
+            source = self._templates['head'].render(**config)
+            source += self._templates[funcTemplate].render(**config)
+            source += self._templates['post'].render(**config)
+            module = self._get_module_name(source)
+            source = source.replace(_MODULE_PLACEHOLDER, module)
+            
+            ### Build, if needed, while holding the lock for this module so 
+            ### that other processes wait for us rather than duplicate the work
+            try:
+                with CacheLock(os.path.join(self.cache_dir, module)):
+                    soFile = self._find_module(module)
+                    if soFile is None:
+                        self._build_module(source, module, verbose=self.verbose)
+                        soFile = self._find_module(module)
+                        
+                    ## Load and cache
+                    loadedModule = self._load_module(module, soFile)
+            except ImportError as e:
+                ## The module checks the CPU features when it is loaded so a 
+                ## failure here means that we need to drop down a level
+                if self.isa == 'generic':
+                    raise
+                warnings.warn("Cannot load the '%s' JIT module, falling back to '%s': %s" % (self.isa, self._get_fallback_isa(), str(e)), RuntimeWarning)
+                self._set_isa(self._get_fallback_isa())
+                return self.get_module(dtype, nStand, nSamps, nChan, nOverlap, ClipLevel, window=window, nTap=nTap, pfbWindow=pfbWindow)
                 
-            ### Build
-            self._build_module(srcname, module)
+            ## Setup the FFTW planning - the plans themselves are kept by the
+            ## module so they only need to be created once
+            loadedModule.set_fftw(self.rigor, self.wisdom_file)
+            self._cache[name] = loadedModule
             
-            ## Load and cache
-            info = imp.find_module(module, [self.cache_dir,])
-            loadedModule = imp.load_module('jit.'+module, *info)
-            info[0].close()
-            self._cache[module] = loadedModule
+            ## Keep the cache under its size limit
+            self._evict_cache()
             
         # Done
         return loadedModule
         
+    def _get_variants(self, ftype, nStand):
+        """
+        Return a list of (function name, OpenMP schedule) tuples for the variants
+        of a function that can be measured.  The first entry is the one to use
+        if no measurements are available.
+        """
+        
+        if ftype == 'spec':
+            ## Heuristics for the default
+            if nStand <= 2:
+                order = ['specF', 'specL', 'specS']
+            elif nStand <= 5:
+                order = ['specL', 'specF', 'specS']
+            else:
+                order = ['specS', 'specF', 'specL']
+            return [(name, None) for name in order]
+        elif ftype in ('FEngine', 'FEngineFused'):
+            return [(ftype, ('static', 0)), (ftype, ('dynamic', 1)), (ftype, ('guided', 0))]
+        elif ftype == 'XEngine3':
+            ## Use the tiled version by default for large arrays
+            if nStand >= _XENGINE_TILE_THRESHOLD:
+                order = ['XEngine3T', 'XEngine3', 'XEngine3C']
+            else:
+                order = ['XEngine3', 'XEngine3C', 'XEngine3T']
+            return [(name, None) for name in order]
+        else:
+            return [(ftype, None)]
+            
+    def _get_choice_key(self, mod, ftype):
+        return '%s|%s|%s' % (mod.__name__.split('.')[-1], ftype, self._cpu)
+        
+    def _load_choice(self, mod, ftype):
+        """
+        Return the measured (function name, OpenMP schedule) variant for the 
+        specified module and function or None if it has not been measured.
+        """
+        
+        key = self._get_choice_key(mod, ftype)
+        try:
+            return self._choices[key]
+        except KeyError:
+            pass
+            
+        ## Remember misses as well so that the file is only read once per 
+        ## module and function
+        choice = None
+        try:
+            with open(os.path.join(self.cache_dir, _MEASURE_FILE), 'r') as fh:
+                entry = json.load(fh)[key]
+            choice = (entry['func'], tuple(entry['schedule']) if entry['schedule'] else None)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        self._choices[key] = choice
+        return choice
+        
+    def _save_choice(self, mod, ftype, choice, times):
+        """
+        Save a measured variant to the cache directory.
+        """
+        
+        key = self._get_choice_key(mod, ftype)
+        self._choices[key] = choice
+        
+        measurename = os.path.join(self.cache_dir, _MEASURE_FILE)
+        with CacheLock(measurename):
+            try:
+                with open(measurename, 'r') as fh:
+                    measured = json.load(fh)
+            except (IOError, OSError, ValueError):
+                measured = {}
+            measured[key] = {'func': choice[0], 'schedule': choice[1], 'times': times,
+                             'date': time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())}
+                             
+            partial = '%s.%i.tmp' % (measurename, os.getpid())
+            try:
+                with open(partial, 'w') as fh:
+                    json.dump(measured, fh, indent=2, sort_keys=True)
+                os.rename(partial, measurename)
+            except (IOError, OSError) as e:
+                warnings.warn("Cannot save the measured JIT variants: %s" % str(e), RuntimeWarning)
+                
+    def _get_callable(self, mod, choice):
+        """
+        Return a callable for a (function name, OpenMP schedule) variant.
+        """
+        
+        func = getattr(mod, choice[0])
+        if choice[1] is None:
+            return func
+            
+        ## Set the schedule before each call since it is shared by all modules
+        kind, chunk = _OMP_SCHEDULES[choice[1][0]], choice[1][1]
+        set_schedule = mod.set_schedule
+        def scheduled(*args, **kwds):
+            set_schedule(kind, chunk)
+            return func(*args, **kwds)
+        return scheduled
+        
+    def _measure(self, mod, ftype, variants, args, kwds, repeats=None):
+        """
+        Time each of the variants of a function with the provided arguments, 
+        save the fastest, and return it.
+        """
+        
+        if repeats is None:
+            repeats = 10 if ftype == 'spec' else 3
+            
+        times = {}
+        for variant in variants:
+            func = self._get_callable(mod, variant)
+            func(*args, **kwds)
+            
+            tBest = 1e9
+            for i in range(repeats):
+                t0 = time.time()
+                func(*args, **kwds)
+                tBest = min([tBest, time.time()-t0])
+            times[_get_variant_name(variant)] = tBest
+            
+        best = min(variants, key=lambda x: times[_get_variant_name(x)])
+        if self.verbose:
+            print("JIT measured %s for %s: %s" % (ftype, mod.__name__.split('.')[-1], _get_variant_name(best)))
+        self._save_choice(mod, ftype, best, times)
+        return best
+        
     def get_function(self, func, *args, **kwds):
         """
         Given a base LSL function and a call signature, return optimzed version of the function for that call.
@@ -342,10 +927,16 @@ return 0;
             ftype = func
         if ftype[:4] == 'FPSD':
             ftype = 'spec'
+        elif ftype[:12] == 'FEngineFused':
+            ftype = 'FEngineFused'
         elif ftype[:7] == 'FEngine':
             ftype = 'FEngine'
         elif ftype[:9] == 'PFBEngine':
             ftype = 'PFBEngine'
+        elif ftype[:10] == 'XEngine3I8':
+            ftype = 'XEngine3I8'
+        elif ftype[:9] == 'XEngine3H':
+            ftype = 'XEngine3H'
         elif ftype[:8] == 'XEngine2':
             ftype == 'XEngine2'
         elif ftype[:8] == 'XEngine3':
@@ -356,7 +947,21 @@ return 0;
             
         # Figure out how to optimize it
         dtype = args[0].dtype.type.__name__
-        if ftype in ('XEngine2', 'XEngine3'):
+        if ftype == 'XEngine3H':
+            ## Half precision data are (stands by channels by windows by 
+            ## real/imaginary) and use the complex64 module
+            dtype = 'complex64'
+            nStand = args[0].shape[0]
+            nSamps = args[0].shape[1]*args[0].shape[2]
+            nChan = args[0].shape[1]
+        elif ftype == 'XEngine3I8':
+            ## Packed int8 data are (stands by channels by scale+windows by 
+            ## real/imaginary) and use the complex64 module
+            dtype = 'complex64'
+            nStand = args[0].shape[0]
+            nSamps = args[0].shape[1]*(args[0].shape[2]-2)
+            nChan = args[0].shape[1]
+        elif ftype in ('XEngine2', 'XEngine3'):
             if len(args[0].shape) == 3:
                 nStand = args[0].shape[0]
                 nSamps = args[0].shape[1]*args[0].shape[2]
@@ -381,50 +986,87 @@ return 0;
             window = kwds['window']
         except KeyError:
             window = null_window
+        try:
+            nTap = kwds['ntap']
+        except KeyError:
+            nTap = 4
+        try:
+            pfbWindow = kwds['pfb_window']
+        except KeyError:
+            pfbWindow = 'hanning'
             
         # Get the optimized module
-        mod = self.get_module(dtype, nStand, nSamps, nChan, nOverlap, ClipLevel, window)
+        mod = self.get_module(dtype, nStand, nSamps, nChan, nOverlap, ClipLevel, window, nTap=nTap, pfbWindow=pfbWindow)
         
-        # Do we need to measure it?
-        try:
-            doMeasure = kwds['measure']
-        except KeyError:
-            doMeasure = False
-        if doMeasure:
-            ## Yes
-            if ftype == 'spec':
-                t0 = time.time()
-                for i in range(10):
-                    getattr(mod, 'specS')(*args)
-                tS = time.time()-t0
-                
-                t0 = time.time()
-                for i in range(10):
-                    getattr(mod, 'specF')(*args)
-                tF = time.time()-t0
-                
-                t0 = time.time()
-                for i in range(10):
-                    getattr(mod, 'specL')(*args)
-                tL = time.time()-t0
+        # Find the variants of this function to choose between, the first 
+        # one being the default
+        variants = self._get_variants(ftype, nStand)
+        
+        # Has a variant already been measured for this module on this host?
+        choice = self._load_choice(mod, ftype)
+        if choice is None and len(variants) > 1:
+            ## No, do we need to measure it?
+            try:
+                doMeasure = kwds['measure']
+            except KeyError:
+                doMeasure = self.measure
+            if doMeasure:
+                ## Yes
+                callKwds = {}
+                if ftype in ('FEngine', 'FEngineFused'):
+                    for key in ('sample_rate', 'fringe_rate', 'fringe_time'):
+                        if key in kwds:
+                            callKwds[key] = kwds[key]
+                choice = self._measure(mod, ftype, variants, args, callKwds)
                 
-                tBest = min([tS, tF, tL])
-                if tS == tBest:
-                    ftype = 'specS'
-                elif tF == tBest:
-                    ftype = 'specF'
-                else:
-                    ftype = 'specL'
-                    
-        else:
-            ## No, use heuristics
-            if ftype == 'spec':
-                if nStand <= 2:
-                    ftype = 'specF'
-                elif nStand <= 5:
-                    ftype = 'specL'
-                else:
-                    ftype = 'specS'
-                    
+        if choice is None:
+            ## No, use the default
+            choice = variants[0]
+            
         # Return the call
-        return getattr(mod, ftype)
+        return self._get_callable(mod, choice)
+
+
+_WARMUP_OPT = None
+
+
+def _warmup_init(cache_dir):
+    """
+    Setup the JustInTimeOptimizer used by a warmup worker process.
+    """
+    
+    global _WARMUP_OPT
+    _WARMUP_OPT = JustInTimeOptimizer(cache_dir=cache_dir, verbose=False)
+
+
+def _warmup_module(params):
+    """
+    Build (or find) a single module for warmup() and return the parameters,
+    the module filename, and the time it took.
+    """
+    
+    t0 = time.time()
+    mod = _WARMUP_OPT.get_module(*params)
+    return params, os.path.basename(mod.__file__), time.time()-t0
+
+
+def warmup(modules, processes=None, cache_dir=None, verbose=True):
+    """
+    Given a list of (dtype, nStand, nSamps, nChan, nOverlap, ClipLevel) tuples 
+    as passed to JustInTimeOptimizer.get_module(), build any of the modules
+    that are not already in the cache using a pool of processes.  Returns a 
+    list of (parameters, module filename, time) tuples.
+    """
+    
+    results = []
+    pool = multiprocessing.Pool(processes=processes, initializer=_warmup_init, initargs=(cache_dir,))
+    try:
+        for params,filename,tBuild in pool.imap_unordered(_warmup_module, modules):
+            if verbose:
+                print("%-9s %3i stands, %8i samples, %5i channels -> %s in %.1f s" % (params[0], params[1], params[2], params[3], filename, tBuild))
+            results.append( (params, filename, tBuild) )
+    finally:
+        pool.close()
+        pool.join()
+        
+    return results
@@ -16,16 +16,31 @@ from lsl.common import dp as dp_common
 from lsl.correlator import _core
 from lsl.correlator.fx import pol_to_pols, null_window
 
+from jones import apply_matrix
+
 from .jit import JustInTimeOptimizer
 
 __version__ = '0.3'
-__all__ = ['get_optimal_delay_padding', 'fengine', 'pfbengine', 'xengine', 'xengine_full']
+__all__ = ['get_optimizer', 'get_optimal_delay_padding', 'fengine', 'pfbengine', 'spectrometer', 'to_half', 
+           'from_half', 'xengine', 'xengine_full']
 
 
 vLight = vLight.to('m/s').value
 
 
-JIT_OPT = JustInTimeOptimizer()
+JIT_OPT = None
+
+
+def get_optimizer():
+    """
+    Return the JustInTimeOptimizer instance used by this module, creating it
+    the first time it is needed so that importing the module is quick.
+    """
+    
+    global JIT_OPT
+    if JIT_OPT is None:
+        JIT_OPT = JustInTimeOptimizer()
+    return JIT_OPT
 
 
 def get_optimal_delay_padding(antennaSet1, antennaSet2, LFFT=64, sample_rate=None, central_freq=0.0, pol='XX', phase_center='z'):
@@ -87,9 +102,14 @@ def get_optimal_delay_padding(antennaSet1, antennaSet2, LFFT=64, sample_rate=Non
     return -minDelay
 
 
-def fengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=False, window=null_window, sample_rate=None, central_freq=0.0, pol='XX', gain_correct=False, return_baselines=False, clip_level=0, phase_center='z', delayPadding=40e-6):
+def fengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=False, window=null_window, sample_rate=None, central_freq=0.0, pol='XX', gain_correct=False, return_baselines=False, clip_level=0, phase_center='z', delayPadding=40e-6, jones=None, gains=None, fringe_rate=0.0, fringe_time=0.0):
     """
     Multi-rate F engine based on the lsl.correlator.fx.FXMaster() function.
+    
+    The optional 'gains' (one per input) and 'jones' (a 2x2 matrix applied to
+    each X/Y pair of inputs after the gains) are applied to the time series
+    and the 'fringe_rate' in Hz, relative to 'fringe_time' in seconds at the
+    first sample, is applied to each FFT window.  These require pol='*'.
     """
     
     # Decode the polarization product into something that we can use to figure 
@@ -106,6 +126,10 @@ def fengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=F
     
     nStands = len(antennas1)
     
+    fused = (jones is not None or gains is not None or fringe_rate != 0.0)
+    if fused and pol != '*':
+        raise RuntimeError("Gains, Jones matrices, and fringe rotation require pol='*'")
+        
     # Figure out if we are working with complex (I/Q) data or only real.  This
     # will determine how the FFTs are done since the real data mirrors the pos-
     # itive and negative Fourier frequencies.
@@ -159,11 +183,26 @@ def fengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=F
     if minDelay < 0:
         raise RuntimeError('Minimum data stream delay is negative: %.3f us' % (minDelay*1e6,))
         
+    # Fused gains, Jones matrix, and fringe rotation
+    if fused:
+        if signals.dtype.kind != 'c':
+            raise RuntimeError("Gains, Jones matrices, and fringe rotation are only supported for complex data")
+        if jones is None:
+            jones = numpy.identity(2)
+        if gains is None:
+            gains = numpy.ones(nStands)
+        jones = numpy.asarray(jones, dtype=numpy.complex64)
+        gains = numpy.asarray(gains, dtype=numpy.float64)
+        
+        FEngine = get_optimizer().get_function('FEngineFused', signals, freq, delays1, jones, gains, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level, fringe_rate=fringe_rate, fringe_time=fringe_time)
+        signalsF1, validF1 = FEngine(signals, freq, delays1, jones, gains, sample_rate=sample_rate, fringe_rate=fringe_rate, fringe_time=fringe_time)
+        return freq, signalsF1, validF1, delays1
+        
     # Optimize
     if len(signalsIndex1) != signals.shape[0]:
-        FEngine = JIT_OPT.get_function('FEngine', signals[signalsIndex1,:], freq, delays1, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level)
+        FEngine = get_optimizer().get_function('FEngine', signals[signalsIndex1,:], freq, delays1, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level)
     else:
-        FEngine = JIT_OPT.get_function('FEngine', signals, freq, delays1, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level)
+        FEngine = get_optimizer().get_function('FEngine', signals, freq, delays1, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level)
     
     # F - defaults to running parallel in C via OpenMP
     if len(signalsIndex1) != signals.shape[0]:
@@ -174,9 +213,14 @@ def fengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=F
     return freq, signalsF1, validF1, delays1
 
 
-def pfbengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=False, window=null_window, sample_rate=None, central_freq=0.0, pol='XX', gain_correct=False, return_baselines=False, clip_level=0, phase_center='z', delayPadding=40e-6):
+def pfbengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=False, window=null_window, sample_rate=None, central_freq=0.0, pol='XX', gain_correct=False, return_baselines=False, clip_level=0, phase_center='z', delayPadding=40e-6, ntap=4, pfb_window='hanning', jones=None, gains=None, fringe_rate=0.0, fringe_time=0.0):
     """
     Multi-rate PFB-based F engine based on the lsl.correlator.fx.FXMaster() function.
+    
+    The filter bank uses 'ntap' taps with a 'pfb_window' window, one of 
+    'hanning', 'hamming', or 'blackman'.  The optional 'gains', 'jones', and 
+    'fringe_rate' are the same as for fengine() but are applied as separate 
+    passes over the data.
     """
     
     # Decode the polarization product into something that we can use to figure 
@@ -246,28 +290,99 @@ def pfbengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose
     if minDelay < 0:
         raise RuntimeError('Minimum data stream delay is negative: %.3f us' % (minDelay*1e6,))
         
+    # Gains and Jones matrix
+    if (jones is not None or gains is not None or fringe_rate != 0.0) and pol != '*':
+        raise RuntimeError("Gains, Jones matrices, and fringe rotation require pol='*'")
+    if gains is not None:
+        signals = signals * numpy.asarray(gains, dtype=signals.real.dtype)[:,numpy.newaxis]
+    if jones is not None:
+        signals = apply_matrix(signals.copy() if gains is None else signals, numpy.asarray(jones))
+        
     # Optimize
     if len(signalsIndex1) != signals.shape[0]:
-        FEngine = JIT_OPT.get_function('PFBEngine', signals[signalsIndex1,:], freq, delays1, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level)
+        FEngine = get_optimizer().get_function('PFBEngine', signals[signalsIndex1,:], freq, delays1, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level, ntap=ntap, pfb_window=pfb_window)
     else:
-        FEngine = JIT_OPT.get_function('PFBEngine', signals, freq, delays1, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level)
+        FEngine = get_optimizer().get_function('PFBEngine', signals, freq, delays1, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level, ntap=ntap, pfb_window=pfb_window)
         
     # F - defaults to running parallel in C via OpenMP
     if len(signalsIndex1) != signals.shape[0]:
         signalsF1, validF1 = FEngine(signals[signalsIndex1,:], freq, delays1, sample_rate=sample_rate)
     else:
         signalsF1, validF1 = FEngine(signals, freq, delays1, sample_rate=sample_rate)
-    
+        
+    # Fringe rotation
+    if fringe_rate != 0.0:
+        for w in range(signalsF1.shape[2]):
+            signalsF1[:,:,w] *= numpy.exp(-2j*numpy.pi*fringe_rate*(fringe_time + w*LFFT/sample_rate))
+            
     return freq, signalsF1, validF1, delays1
 
 
+def spectrometer(signals, LFFT=64, overlap=1, window=null_window, sample_rate=None, central_freq=0.0, clip_level=0):
+    """
+    Spectrometer for the autocorrelation-only mode.  Given a 2-D (inputs by 
+    samples) array of data, return a two-element tuple of the channel 
+    frequencies and a 2-D (inputs by channels) array of the power spectra. 
+    The channel frequencies follow the same convention as fengine().
+    """
+    
+    if signals.dtype.kind == 'c':
+        lFactor = 1
+        doFFTShift = True
+        central_freq = float(central_freq)
+    else:
+        lFactor = 2
+        doFFTShift = False
+        
+    if sample_rate is None:
+        sample_rate = dp_common.fS
+    freq = numpy.fft.fftfreq(lFactor*LFFT, d=1.0/sample_rate) + central_freq
+    if doFFTShift:
+        freq = numpy.fft.fftshift(freq)
+    freq = freq[:LFFT]
+    
+    # Optimize
+    FPSD = get_optimizer().get_function('FPSD', signals, LFFT=LFFT, overlap=overlap, clip_level=clip_level, window=window)
+    
+    psd = FPSD(signals)
+    return freq, psd
+
+
+def to_half(signals, out=None):
+    """
+    Convert a complex F-engine output array to half precision.  Returns a
+    numpy.float16 array with an extra trailing axis for the real/imaginary 
+    parts.  If 'out' is provided the values are written to it instead.
+    """
+    
+    if out is None:
+        out = numpy.empty(signals.shape+(2,), dtype=numpy.float16)
+    out[...,0] = signals.real
+    out[...,1] = signals.imag
+    return out
+
+
+def from_half(signals):
+    """
+    Inverse of to_half() that returns a numpy.complex64 array.
+    """
+    
+    output = signals.astype(numpy.float32).view(numpy.complex64)
+    return output.reshape(output.shape[:-1])
+
+
 def xengine(signalsF1, validF1, signalsF2, validF2):
     """
     X-engine for the outputs of fengine().
     """
     
+    # Half precision data
+    if signalsF1.dtype == numpy.float16:
+        signalsF1 = from_half(signalsF1)
+        signalsF2 = from_half(signalsF2)
+        
     # Optimize
-    #XEngine = JIT_OPT.get_function('XEngine2', signalsF1, signalsF2, validF1, validF2)
+    #XEngine = get_optimizer().get_function('XEngine2', signalsF1, signalsF2, validF1, validF2)
     XEngine = _core.XEngine2
 
     output = XEngine(signalsF1, signalsF2, validF1, validF2)
@@ -280,7 +395,11 @@ def xengine_full(signalsFX, validFX, signalsFY, validFY):
     """
     
     # Optimize
-    XEngine = JIT_OPT.get_function('XEngine3', signalsFX, signalsFY, validFX, validFY)
+    if signalsFX.dtype == numpy.float16:
+        ## Half precision data
+        XEngine = get_optimizer().get_function('XEngine3H', signalsFX, signalsFY, validFX, validFY)
+    else:
+        XEngine = get_optimizer().get_function('XEngine3', signalsFX, signalsFY, validFX, validFY)
     
     output = XEngine(signalsFX, signalsFY, validFX, validFY)
     return output[0,:,:], output[1,:,:], output[2,:,:], output[3,:,:]
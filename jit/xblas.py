@@ -0,0 +1,126 @@
+"""
+Module that provides CPU-based X-engines that work as a Hermitian rank-k
+update per channel using BLAS.
+"""
+
+# Python2 compatibility
+from __future__ import print_function, division
+
+import numpy
+
+try:
+    from scipy.linalg.blas import cherk as _cherk
+    HAS_CHERK = True
+except ImportError:
+    _cherk = None
+    HAS_CHERK = False
+
+__version__ = '0.1'
+__all__ = ['HAS_CHERK', 'xengine', 'xengine_full']
+
+
+# Packing buffer cache
+_CACHE = {}
+
+
+def _get_buffer(shape, dtype):
+    """
+    Return a cached, uninitialized array with the specified shape and data type.
+    """
+    
+    try:
+        buffer = _CACHE[(shape, dtype)]
+    except KeyError:
+        buffer = numpy.empty(shape, dtype=dtype)
+        _CACHE[(shape, dtype)] = buffer
+    return buffer
+
+
+def _pack(signals, valid, out):
+    """
+    Given a 3-D (stands by channels by windows) array of F-engine output and
+    the 2-D (stands by windows) validity mask, weight the data by the mask
+    and write it into a 3-D (channels by stands by windows) output array.
+    """
+    
+    numpy.multiply(signals.transpose(1,0,2), valid[numpy.newaxis,:,:], out=out)
+
+
+def _gram(signals):
+    """
+    Given a 3-D (channels by inputs by windows) array, return a 3-D (channels
+    by inputs by inputs) array of signals*signals^H for each channel.  Only
+    the upper triangle is valid when cherk from SciPy is used.
+    """
+    
+    nChan, nInput, nWin = signals.shape
+    
+    if HAS_CHERK:
+        ## cherk wants Fortran-ordered arrays so work with the transpose, 
+        ## S^T, which gives (S^T)^H S^T = conj(S S^H) in the upper triangle
+        output = _get_buffer((nChan,nInput,nInput), numpy.complex64)
+        for c in range(nChan):
+            output[c,:,:] = _cherk(1.0, signals[c,:,:].T, trans=2)
+        numpy.conjugate(output, out=output)
+    else:
+        ## numpy.matmul calls cgemm for each channel
+        output = numpy.matmul(signals, signals.conj().transpose(0,2,1))
+    return output
+
+
+def xengine(signalsF1, validF1, signalsF2, validF2):
+    """
+    X-engine for the outputs of fengine().
+    """
+    
+    # Half precision data
+    if signalsF1.dtype == numpy.float16:
+        signalsF1 = signalsF1.astype(numpy.float32).view(numpy.complex64)[...,0]
+        signalsF2 = signalsF2.astype(numpy.float32).view(numpy.complex64)[...,0]
+        
+    nStand, nChan, nWin = signalsF1.shape
+    s1, s2 = numpy.triu_indices(nStand)
+    
+    # Pack and cross-multiply
+    combined = _get_buffer((nChan,2*nStand,nWin), numpy.complex64)
+    _pack(signalsF1, validF1, combined[:,:nStand,:])
+    _pack(signalsF2, validF2, combined[:,nStand:,:])
+    gram = _gram(combined)
+    
+    # Normalize by the number of valid windows and reorder
+    count = numpy.dot(validF1.astype(numpy.float32), validF2.T.astype(numpy.float32))
+    output = gram[:,s1,nStand+s2].T / count[s1,s2][:,numpy.newaxis]
+    return output
+
+
+def xengine_full(signalsFX, validFX, signalsFY, validFY):
+    """
+    X-engine for the outputs of fengine().
+    """
+    
+    # Half precision data
+    if signalsFX.dtype == numpy.float16:
+        signalsFX = signalsFX.astype(numpy.float32).view(numpy.complex64)[...,0]
+        signalsFY = signalsFY.astype(numpy.float32).view(numpy.complex64)[...,0]
+        
+    nStand, nChan, nWin = signalsFX.shape
+    s1, s2 = numpy.triu_indices(nStand)
+    
+    # Pack with the X polarization in the first half of the inputs and Y in
+    # the second half, and cross-multiply
+    combined = _get_buffer((nChan,2*nStand,nWin), numpy.complex64)
+    _pack(signalsFX, validFX, combined[:,:nStand,:])
+    _pack(signalsFY, validFY, combined[:,nStand:,:])
+    gram = _gram(combined)
+    
+    # Normalize by the number of valid windows and reorder into the
+    # (baseline by channel) layout.  YX is in the lower triangle of the full
+    # matrix so it comes from the conjugate of the XY block.
+    valid = numpy.concatenate([validFX, validFY], axis=0).astype(numpy.float32)
+    count = numpy.dot(valid, valid.T)
+    
+    visXX = gram[:,s1,s2].T / count[s1,s2][:,numpy.newaxis]
+    visXY = gram[:,s1,nStand+s2].T / count[s1,nStand+s2][:,numpy.newaxis]
+    visYX = gram[:,s2,nStand+s1].T.conj() / count[nStand+s1,s2][:,numpy.newaxis]
+    visYY = gram[:,nStand+s1,nStand+s2].T / count[nStand+s1,nStand+s2][:,numpy.newaxis]
+    return visXX, visXY, visYX, visYY
@@ -300,12 +300,22 @@ def set_memory_usage_limit(size_bytes):
     _CACHE.set_limit(size_bytes)
 
 
+def _from_half(signals):
+    """
+    Expand a half precision F-engine output array on the device to the
+    numpy.complex64 layout used by the kernels.
+    """
+    
+    output = signals.astype(numpy.float32).view(numpy.complex64)
+    return output.reshape(output.shape[:-1])
+
+
 def xengine(signalsF1, validF1, signalsF2, validF2, blockDim=(4,16)):
     """
     X-engine for the outputs of fengine().
     """
     
-    nStand, nChan, nWin = signalsF1.shape
+    nStand, nChan, nWin = signalsF1.shape[:3]
     nBL = nStand*(nStand+1) // 2
     
     with cupy.cuda.Stream():
@@ -321,6 +331,11 @@ def xengine(signalsF1, validF1, signalsF2, validF2, blockDim=(4,16)):
             validF1 = cupy.asarray(validF1)
             validF2 = cupy.asarray(validF2)
             
+        ## Half precision data are sent as is and expanded on the device
+        if signalsF1.dtype == numpy.float16:
+            signalsF1 = _from_half(signalsF1)
+            signalsF2 = _from_half(signalsF2)
+            
         try:
             output = _CACHE[(1,nBL,nChan,numpy.complex64)]
         except KeyError:
@@ -345,7 +360,7 @@ def xengine_full(signalsFX, validFX, signalsFY, validFY, blockDim=(4,16)):
     X-engine for the outputs of fengine().
     """
     
-    nStand, nChan, nWin = signalsFX.shape
+    nStand, nChan, nWin = signalsFX.shape[:3]
     nBL = nStand*(nStand+1) // 2
     
     with cupy.cuda.Stream():
@@ -361,6 +376,11 @@ def xengine_full(signalsFX, validFX, signalsFY, validFY, blockDim=(4,16)):
             validFX = cupy.asarray(validFX)
             validFY = cupy.asarray(validFY)
             
+        ## Half precision data are sent as is and expanded on the device
+        if signalsFX.dtype == numpy.float16:
+            signalsFX = _from_half(signalsFX)
+            signalsFY = _from_half(signalsFY)
+            
         try:
             combined = _CACHE[(2*nStand,nChan,nWin,numpy.complex64)]
             valid = _CACHE[(2*nStand,nWin,numpy.uint8)]
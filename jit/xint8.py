@@ -0,0 +1,119 @@
+"""
+Module that provides a reduced precision CPU-based X-engine that requantizes
+the F-engine output to 8-bit complex integers and accumulates the products
+as 32-bit integers.  The quantized data are packed into numpy.int8 arrays of
+(stands by channels by windows+2 by real/imaginary) where the first four
+bytes of each stand and channel hold its numpy.float32 scale factor.
+"""
+
+# Python2 compatibility
+from __future__ import print_function, division, absolute_import
+
+import numpy
+
+from . import multirate
+
+__version__ = '0.1'
+__all__ = ['quantize', 'dequantize', 'xengine', 'xengine_full', 'get_accuracy', 'print_accuracy']
+
+
+def quantize(signals, out=None):
+    """
+    Quantize a complex F-engine output array, or a half precision one from
+    multirate.to_half(), to packed 8-bit complex integers with a scale factor
+    for each stand and channel so that the largest real or imaginary value 
+    maps to 127.  If 'out' is provided the values are written to it instead.
+    """
+    
+    if signals.dtype == numpy.float16:
+        signals = multirate.from_half(signals)
+        
+    if out is None:
+        out = numpy.empty(signals.shape[:-1]+(signals.shape[-1]+2, 2), dtype=numpy.int8)
+        
+    scale = numpy.maximum(numpy.abs(signals.real).max(axis=-1), 
+                          numpy.abs(signals.imag).max(axis=-1))
+    scale = numpy.where(scale > 0, scale / 127.0, 1.0).astype(numpy.float32)
+    inv = (1.0 / scale)[...,numpy.newaxis]
+    
+    out[...,:2,:] = scale[...,numpy.newaxis].view(numpy.int8).reshape(scale.shape+(2,2))
+    numpy.rint(signals.real*inv, out=out[...,2:,0], casting='unsafe')
+    numpy.rint(signals.imag*inv, out=out[...,2:,1], casting='unsafe')
+    return out
+
+
+def dequantize(signals):
+    """
+    Inverse of quantize() that returns a numpy.complex64 array.
+    """
+    
+    scale = numpy.ascontiguousarray(signals[...,:2,:]).reshape(signals.shape[:-2]+(4,))
+    scale = scale.view(numpy.float32)
+    output = signals[...,2:,:].astype(numpy.float32).view(numpy.complex64)
+    return output.reshape(output.shape[:-1]) * scale
+
+
+def xengine(signalsF1, validF1, signalsF2, validF2):
+    """
+    X-engine for the outputs of fengine().  This is the same as the XY
+    product from xengine_full() with the two sets of signals.
+    """
+    
+    return xengine_full(signalsF1, validF1, signalsF2, validF2)[1]
+
+
+def xengine_full(signalsFX, validFX, signalsFY, validFY):
+    """
+    X-engine for the outputs of fengine().  The F-engine output can either
+    be packed int8 data from quantize() or floating point data that are
+    quantized here.
+    """
+    
+    # Floating point data
+    if signalsFX.dtype != numpy.int8:
+        signalsFX = quantize(signalsFX)
+        signalsFY = quantize(signalsFY)
+        
+    # Optimize
+    XEngine = multirate.get_optimizer().get_function('XEngine3I8', signalsFX, signalsFY, validFX, validFY)
+    
+    output = XEngine(signalsFX, signalsFY, validFX, validFY)
+    return output[0,:,:], output[1,:,:], output[2,:,:], output[3,:,:]
+
+
+def get_accuracy(signalsFX, validFX, signalsFY, validFY, reference=None):
+    """
+    Compare the output of xengine_full() for floating point F-engine output
+    to the floating point X-engine from the JIT multirate module and return a dictionary, keyed by product, of
+    two-element tuples of the maximum and RMS errors relative to the largest
+    visibility amplitude in each baseline.  The reference visibilities can
+    also be provided as a four-element tuple of XX, XY, YX, and YY.
+    """
+    
+    if signalsFX.dtype == numpy.float16:
+        signalsFX = multirate.from_half(signalsFX)
+        signalsFY = multirate.from_half(signalsFY)
+    if reference is None:
+        ## Go straight to the floating point JIT X-engine in case 
+        ## multirate.xengine_full() has been replaced with the one here
+        XEngine = multirate.get_optimizer().get_function('XEngine3', signalsFX, signalsFY, validFX, validFY)
+        reference = XEngine(signalsFX, signalsFY, validFX, validFY)
+    output = xengine_full(signalsFX, validFX, signalsFY, validFY)
+    
+    accuracy = {}
+    for name,o,r in zip(('XX', 'XY', 'YX', 'YY'), output, reference):
+        scale = numpy.abs(r).max(axis=1)[:,numpy.newaxis]
+        scale[scale == 0] = 1.0
+        error = numpy.abs(o - r) / scale
+        accuracy[name] = (error.max(), numpy.sqrt((error**2).mean()))
+    return accuracy
+
+
+def print_accuracy(accuracy):
+    """
+    Print a report of the accuracy dictionary returned by get_accuracy().
+    """
+    
+    print("int8 X-engine accuracy relative to the floating point X-engine:")
+    for name in ('XX', 'XY', 'YX', 'YY'):
+        print("  %s: max. rel. error %.2e, RMS rel. error %.2e" % (name, accuracy[name][0], accuracy[name][1]))
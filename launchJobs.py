@@ -216,6 +216,10 @@ def job(node, socket, configfile, options='-l 256 -t 1 -j', softwareDir=None, re
         outname += 'H'
     logfile = outname+".log"
     code += run_command('%s ./%s %s -g %s %s > %s 2>&1' % (sys.executable, corr_mode, options, outname, configfile, logfile), node=node, socket=socket, cwd=cwd)
+    if code != 0 and not isPulsar:
+        ## Try once more, picking up from the last checkpoint
+        print("WARNING: correlator failed on %s - %s, resuming from checkpoint" % (node, os.path.basename(configfile)))
+        code = run_command('%s ./%s %s --resume -g %s %s >> %s 2>&1' % (sys.executable, corr_mode, options, outname, configfile, logfile), node=node, socket=socket, cwd=cwd)
     if code != 0:
         print("WARNING: failed to run correlator on %s - %s" % (node, os.path.basename(configfile)))
         returnQueue.put(False)
@@ -226,6 +230,8 @@ def job(node, socket, configfile, options='-l 256 -t 1 -j', softwareDir=None, re
         resultsDir = os.path.dirname(__file__)
     code += run_command('rsync -e ssh -avH %s:%s/*.npz %s' % (node, cwd, resultsDir), quiet=True)
     code += run_command('rsync -e ssh -avH %s:%s/*.log %s' % (node, cwd, resultsDir), quiet=True)
+    if not isPulsar:
+        code += run_command('rsync -e ssh -avH %s:%s/*-metrics.jsonl %s' % (node, cwd, resultsDir), quiet=True)
     if code != 0:
         print("WARNING: failed to sync results on %s - %s" % (node, os.path.basename(configfile)))
         returnQueue.put(False)
@@ -293,6 +299,73 @@ def remove_lock_file(node):
     return True
 
 
+def get_warmup_options(options):
+    """
+    Given a set of correlator options, return the options to pass to 
+    warmupJIT.py or None if the JIT is not being used.
+    """
+    
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-j', '--jit', action='store_true')
+    parser.add_argument('-l', '--fft-length', type=str)
+    parser.add_argument('-u', '--subint-time', type=str)
+    parser.add_argument('--read-time', type=str)
+    parser.add_argument('--ignore-tuning', action='store_true')
+    known, unknown = parser.parse_known_args(shlex.split(options))
+    if not known.jit:
+        return None
+        
+    woptions = []
+    if known.fft_length is not None:
+        woptions.extend(['-l', known.fft_length])
+    if known.subint_time is not None:
+        woptions.extend(['-u', known.subint_time])
+    if known.read_time is not None:
+        woptions.extend(['--read-time', known.read_time])
+    if known.ignore_tuning:
+        woptions.append('--ignore-tuning')
+    return ' '.join(woptions)
+
+
+def warmup(node, configfiles, options, softwareDir=None):
+    """
+    Build the JIT modules needed for a collection of configuration files on a
+    node ahead of running the correlator there.
+    """
+    
+    code = 0
+    
+    # Create a temporary directory to use
+    cwd = tempfile.mkdtemp(prefix='warmup-')
+    os.rmdir(cwd)
+    code += run_command('mkdir %s' % cwd, node=node, quiet=True)
+    if code != 0:
+        print("WARNING: failed to create warmup directory on %s" % node)
+        return False
+        
+    # Copy the software and configurations over
+    if softwareDir is None:
+        softwareDir = os.path.dirname(__file__)
+    for filename in ['utils.py', 'warmupJIT.py', 'jit']:
+        filename = os.path.join(softwareDir, filename)
+        code += run_command('rsync -e ssh -avH %s %s:%s/' % (filename, node, cwd), quiet=True)
+    for filename in configfiles:
+        code += run_command('rsync -e ssh -avH %s %s:%s/' % (filename, node, cwd), quiet=True)
+    if code != 0:
+        print("WARNING: failed to sync warmup files on %s" % node)
+        return False
+        
+    # Build
+    configfiles = ' '.join([os.path.basename(filename) for filename in configfiles])
+    code += run_command('%s ./warmupJIT.py %s %s > warmup.log 2>&1' % (sys.executable, options, configfiles), node=node, cwd=cwd)
+    if code != 0:
+        print("WARNING: failed to warm up the JIT on %s" % node)
+        
+    # Cleanup
+    run_command('rm -rf %s' % cwd, node=node, quiet=True)
+    return True if code == 0 else False
+
+
 def main(args):
     # Setup
     ## Time mark
@@ -323,6 +396,28 @@ def main(args):
             jobs.append( (configfile, args.options, args.results_dir, is_pulsar) )
     nJobs = len(jobs)
     
+    # Warm up the JIT on each node so that the first jobs do not pay for 
+    # building the modules
+    if not args.no_warmup:
+        wjobs = OrderedDict()
+        for configfile, coptions, resultsdir, is_pulsar in jobs:
+            woptions = get_warmup_options(coptions)
+            if woptions is None or is_pulsar:
+                continue
+            try:
+                wjobs[woptions].append(configfile)
+            except KeyError:
+                wjobs[woptions] = [configfile,]
+        for woptions in wjobs:
+            wthreads = []
+            for node in args.nodes:
+                wthreads.append( threading.Thread(name=node, target=warmup, args=(node, wjobs[woptions], woptions)) )
+                wthreads[-1].daemon = True
+                wthreads[-1].start()
+            print("Warming up the JIT on %i node(s) for %i configuration file(s)" % (len(args.nodes), len(wjobs[woptions])))
+            for wthread in wthreads:
+                wthread.join()
+                
     # Start
     for slot in sorted(threads.keys()):
         node, socket = slot.split('-', 1)
@@ -421,6 +516,8 @@ if __name__ == "__main__":
                         help='for LWA-only configuration files, process both tunings')
     parser.add_argument('-r', '--results-dir', type=str, default="./results",
                         help='directory to put the results in')
+    parser.add_argument('--no-warmup', action='store_true',
+                        help='do not build the JIT modules on each node before starting the jobs')
     args = parser.parse_args()
     if args.gpu:
         args.options += " --gpu"
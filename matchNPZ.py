@@ -6,10 +6,12 @@ import numpy
 import argparse
 import warnings
 
+from utils import load_visibilities, save_visibilities
+
 
 def main(args):
     # Load in the template .npz file and figure out its frequency range
-    template = numpy.load(args.template)
+    template = load_visibilities(args.template)
     freqT = template['freq1'][...]
     template.close()
     print(f"Loaded template '{os.path.basename(args.template)}' with {freqT.size} channels of width {(freqT[1]-freqT[0])/1e3:.3f} kHz")
@@ -30,16 +32,22 @@ def main(args):
         tag = tag.split('-', 1)[0]
         
         ## Load in the .npz file and get its frequency range
-        data = numpy.load(filename)
+        data = load_visibilities(filename)
         freq = data['freq1'][...]
+        if 'bdaTime' in data:
+            warnings.warn(f"'{os.path.basename(filename)}' uses baseline-dependent averaging, skipping")
+            data.close()
+            continue
         
         ## Find the overlap with the template's frequency range and validate
         good = numpy.where((freq>=freqT[0]) & (freq<=freqT[-1]))[0]
         if len(good) != freqT.size:
             warnings.warn(f"Incompatible overlapping channel count: {len(good)} != {freqT.size}, skipping")
+            data.close()
             continue
         elif freq[good[0]] != freqT[0] and freq[good[-1]] != freqT[-1]:
             warnings.warn(f"Incompatible overlapping frequencies: {freq[good[0]]/1e6:.3f} MHz != {freqT[0]/1e6:.3f} MHz or {freq[good[-1]]/1e6:.3f} MHz != {freqT[-1]/1e6:.3f} MHz, skipping")
+            data.close()
             continue
         
         ## Report
@@ -57,13 +65,14 @@ def main(args):
         keys = {}
         for entry in data.files:
             keys[entry] = data[entry][...]
-            if entry.startswith('freq') or entry.startswith('vis'):
+            if entry.startswith('freq') or entry.startswith('vis') or entry.startswith('weights'):
                 keys[entry] = keys[entry][...,good]
                 
-        ## Save
+        ## Save with the same visibility precision and compression as the input
         outname = filename.replace('vis2', 'vis2T')
         outname = os.path.basename(outname)
-        numpy.savez(outname, **keys)
+        save_visibilities(outname, precision=data.precision, compression=data.compression, **keys)
+        data.close()
 
 
 if __name__ == "__main__":
@@ -13,6 +13,7 @@ if sys.version_info > (3,):
 import os
 import re
 import sys
+import json
 import time
 import shlex
 import argparse
@@ -123,6 +124,24 @@ def get_logfile_speed(node, logname):
     return speed, remain, done
 
 
+def get_metrics_bottleneck(node, metricsname):
+    status, record, error = run_command('tail -n1 %s' % metricsname, node=node)
+    bottleneck = '---'
+    if status == 0:
+        try:
+            record = record.decode(encoding='ascii', errors='ignore')
+        except AttributeError:
+            pass
+        try:
+            stages = json.loads(record)['stages']
+            total = sum([stages[stage]['total'] for stage in stages])
+            stage = max(stages, key=lambda x: stages[x]['total'])
+            bottleneck = '%s (%.0f%%)' % (stage, 100.0*stages[stage]['total']/total)
+        except (ValueError, KeyError, ZeroDivisionError):
+            pass
+    return bottleneck
+
+
 def main(args):
     while True:
         try:
@@ -144,6 +163,7 @@ def main(args):
                                 'altconfig':{},
                                 'speed'    :{},
                                 'remaining':{},
+                                'bottleneck':{},
                                 'complete': {}}
                 status[node]['dirnames'] = dirnames
                 
@@ -172,6 +192,7 @@ def main(args):
                     ### file
                     nNPZ = 0
                     logname = None
+                    metricsname = None
                     configname = None
                     for filename in filenames:
                         filename = filename.strip().rstrip()
@@ -185,6 +206,8 @@ def main(args):
                                 nNPZ += 1
                         elif ext == '.log':
                             logname = filename
+                        elif ext == '.jsonl' and filename.endswith('-metrics.jsonl'):
+                            metricsname = filename
                         elif ext[:7] == '.config':
                             configname = os.path.basename(filename)
                             
@@ -194,11 +217,18 @@ def main(args):
                     else:
                         cspeed, cremain, cdone = '---', '---', False
                         
+                    ### Parse the stage timing metrics, if we have them
+                    if metricsname is not None:
+                        cbottle = get_metrics_bottleneck(node, metricsname)
+                    else:
+                        cbottle = '---'
+                        
                     ### Save
                     status[node]['progress'][dirname] = nNPZ
                     status[node]['altconfig'][dirname] = configname
                     status[node]['speed'][dirname] = cspeed
                     status[node]['remaining'][dirname] = cremain
+                    status[node]['bottleneck'][dirname] = cbottle
                     status[node]['complete'][dirname] = cdone
             t1 = time.time()
             
@@ -214,6 +244,7 @@ def main(args):
                         configfile = entry['active'][dirname]
                         speed = entry['speed'][dirname]
                         remaining = entry['remaining'][dirname]
+                        bottleneck = entry['bottleneck'][dirname]
                         done = entry['complete'][dirname]
                         
                         active = 'active'
@@ -227,7 +258,7 @@ def main(args):
                                     if active.find('pulsar') == -1:
                                         active += ' - pulsar'
                                         
-                        info = '%s @ %i; %s per integration, %s remaining' % (configfile, pid, speed, remaining)
+                        info = '%s @ %i; %s per integration, %s remaining, %s bottleneck' % (configfile, pid, speed, remaining, bottleneck)
                         
                     else:
                         try:
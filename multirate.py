@@ -16,11 +16,14 @@ from astropy.constants import c as vLight
 from astropy.coordinates import AltAz as AstroAltAz
 
 from lsl.common import dp as dp_common
-from lsl.correlator import _core
+from lsl.correlator import _core, _spec
 from lsl.correlator.fx import pol_to_pols, null_window
 
+from jones import apply_matrix
+
 __version__ = '0.3'
-__all__ = ['get_optimal_delay_padding', 'fengine', 'pfbengine', 'xengine', 'xengine_full']
+__all__ = ['get_optimal_delay_padding', 'fengine', 'pfbengine', 'spectrometer', 'to_half', 'from_half', 
+           'xengine', 'xengine_full']
 
 
 vLight = vLight.to('m/s').value
@@ -85,9 +88,14 @@ def get_optimal_delay_padding(antennaSet1, antennaSet2, LFFT=64, sample_rate=Non
     return -minDelay
 
 
-def fengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=False, window=null_window, sample_rate=None, central_freq=0.0, pol='XX', gain_correct=False, return_baselines=False, clip_level=0, phase_center='z', delayPadding=40e-6):
+def fengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=False, window=null_window, sample_rate=None, central_freq=0.0, pol='XX', gain_correct=False, return_baselines=False, clip_level=0, phase_center='z', delayPadding=40e-6, jones=None, gains=None, fringe_rate=0.0, fringe_time=0.0):
     """
     Multi-rate F engine based on the lsl.correlator.fx.FXMaster() function.
+    
+    The optional 'gains' (one per input) and 'jones' (a 2x2 matrix applied to
+    each X/Y pair of inputs after the gains) are applied to the time series
+    and the 'fringe_rate' in Hz, relative to 'fringe_time' in seconds at the
+    first sample, is applied to each FFT window.  These require pol='*'.
     """
     
     # Decode the polarization product into something that we can use to figure 
@@ -104,6 +112,10 @@ def fengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=F
     
     nStands = len(antennas1)
     
+    fused = (jones is not None or gains is not None or fringe_rate != 0.0)
+    if fused and pol != '*':
+        raise RuntimeError("Gains, Jones matrices, and fringe rotation require pol='*'")
+        
     # Figure out if we are working with complex (I/Q) data or only real.  This
     # will determine how the FFTs are done since the real data mirrors the pos-
     # itive and negative Fourier frequencies.
@@ -157,12 +169,23 @@ def fengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose=F
     if minDelay < 0:
         raise RuntimeError('Minimum data stream delay is negative: %.3f us' % (minDelay*1e6,))
         
+    # Gains and Jones matrix
+    if gains is not None:
+        signals = signals * numpy.asarray(gains, dtype=signals.real.dtype)[:,numpy.newaxis]
+    if jones is not None:
+        signals = apply_matrix(signals.copy() if gains is None else signals, numpy.asarray(jones))
+        
     # F - defaults to running parallel in C via OpenMP
     if len(signalsIndex1) != signals.shape[0]:
         signalsF1, validF1 = _core.FEngine(signals[signalsIndex1,:], freq, delays1, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level, window=window)
     else:
         signalsF1, validF1 = _core.FEngine(signals, freq, delays1, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=clip_level, window=window)
         
+    # Fringe rotation
+    if fringe_rate != 0.0:
+        for w in range(signalsF1.shape[2]):
+            signalsF1[:,:,w] *= numpy.exp(-2j*numpy.pi*fringe_rate*(fringe_time + w*LFFT/sample_rate))
+            
     return freq, signalsF1, validF1, delays1
 
 
@@ -247,11 +270,68 @@ def pfbengine(signals, antennas, LFFT=64, overlap=1, include_auto=False, verbose
     return freq, signalsF1, validF1, delays1
 
 
+def spectrometer(signals, LFFT=64, overlap=1, window=null_window, sample_rate=None, central_freq=0.0, clip_level=0):
+    """
+    Spectrometer for the autocorrelation-only mode.  Given a 2-D (inputs by 
+    samples) array of data, return a two-element tuple of the channel 
+    frequencies and a 2-D (inputs by channels) array of the power spectra. 
+    The channel frequencies follow the same convention as fengine().
+    """
+    
+    if signals.dtype.kind == 'c':
+        lFactor = 1
+        doFFTShift = True
+        central_freq = float(central_freq)
+    else:
+        lFactor = 2
+        doFFTShift = False
+        
+    if sample_rate is None:
+        sample_rate = dp_common.fS
+    freq = numpy.fft.fftfreq(lFactor*LFFT, d=1.0/sample_rate) + central_freq
+    if doFFTShift:
+        freq = numpy.fft.fftshift(freq)
+    freq = freq[:LFFT]
+    
+    # PSD - defaults to running parallel in C via OpenMP
+    psd = _spec.FPSD(signals, LFFT=LFFT, overlap=overlap, clip_level=clip_level, window=window)
+    
+    return freq, psd
+
+
+def to_half(signals, out=None):
+    """
+    Convert a complex F-engine output array to half precision.  Returns a
+    numpy.float16 array with an extra trailing axis for the real/imaginary 
+    parts.  If 'out' is provided the values are written to it instead.
+    """
+    
+    if out is None:
+        out = numpy.empty(signals.shape+(2,), dtype=numpy.float16)
+    out[...,0] = signals.real
+    out[...,1] = signals.imag
+    return out
+
+
+def from_half(signals):
+    """
+    Inverse of to_half() that returns a numpy.complex64 array.
+    """
+    
+    output = signals.astype(numpy.float32).view(numpy.complex64)
+    return output.reshape(output.shape[:-1])
+
+
 def xengine(signalsF1, validF1, signalsF2, validF2):
     """
     X-engine for the outputs of fengine().
     """
     
+    # Half precision data
+    if signalsF1.dtype == numpy.float16:
+        signalsF1 = from_half(signalsF1)
+        signalsF2 = from_half(signalsF2)
+        
     output = _core.XEngine2(signalsF1, signalsF2, validF1, validF2)
     return output
 
@@ -261,5 +341,10 @@ def xengine_full(signalsFX, validFX, signalsFY, validFY):
     X-engine for the outputs of fengine().
     """
     
+    # Half precision data
+    if signalsFX.dtype == numpy.float16:
+        signalsFX = from_half(signalsFX)
+        signalsFY = from_half(signalsFY)
+        
     output = _core.XEngine3(signalsFX, signalsFY, validFX, validFY)
     return output[0,:,:], output[1,:,:], output[2,:,:], output[3,:,:]
@@ -25,7 +25,7 @@ from lsl.statistics import robust
 from lsl.misc.mathutils import to_dB
 from lsl.misc import parser as aph
 
-from utils import read_correlator_configuration
+from utils import read_correlator_configuration, load_visibilities
 
 from matplotlib import pyplot as plt
 
@@ -60,7 +60,7 @@ def main(args):
         
     nInt = len(filenames)
     
-    dataDict = numpy.load(filenames[0])
+    dataDict = load_visibilities(filenames[0])
     tInt = dataDict['tInt']
     nBL, nchan = dataDict['vis1XX'].shape
     freq = dataDict['freq1']
@@ -113,7 +113,7 @@ def main(args):
     visToMask = numpy.zeros((nInt,nBL,nchan), dtype=numpy.bool)
     
     for i,filename in enumerate(filenames):
-        dataDict = numpy.load(filename)
+        dataDict = load_visibilities(filename)
         
         tStart = dataDict['tStart']
         
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+Given a collection of .npz files created by superCorrelator.py in the
+autocorrelation-only mode (--autos-only), plot the spectra and the power
+over time for each station.
+"""
+
+# Python3 compatibility
+from __future__ import print_function, division, absolute_import
+import sys
+if sys.version_info > (3,):
+    xrange = range
+    
+import os
+import sys
+import numpy
+import argparse
+from datetime import datetime
+
+from lsl.misc.mathutils import to_dB
+
+from utils import read_correlator_configuration
+
+from matplotlib import pyplot as plt
+
+
+def main(args):
+    # Parse the command line
+    filenames = args.filename
+    filenames.sort()
+    if args.limit != -1:
+        filenames = filenames[:args.limit]
+        
+    nInt = len(filenames)
+    
+    dataDict = numpy.load(filenames[0])
+    nStand, nPol, nchan = dataDict['spec1'].shape
+    freq = dataDict['freq1']
+    junk0, refSrc, junk1, junk2, junk3, junk4, antennas = read_correlator_configuration(dataDict)
+    dataDict.close()
+    
+    stands = [ant.stand.id for ant in antennas if ant.pol == 0]
+    
+    if args.decimate > 1:
+        if nchan % args.decimate != 0:
+            raise RuntimeError("Invalid frequency decimation factor:  %i %% %i = %i" % (nchan, args.decimate, nchan%args.decimate))
+            
+        nchan //= args.decimate
+        freq.shape = (freq.size//args.decimate, args.decimate)
+        freq = freq.mean(axis=1)
+        
+    times = numpy.zeros(nInt, dtype=numpy.float64)
+    specToPlot = numpy.zeros((nInt,nStand,nPol,nchan), dtype=numpy.float32)
+    
+    for i,filename in enumerate(filenames):
+        dataDict = numpy.load(filename)
+        
+        cspec = dataDict['spec1']
+        if args.decimate > 1:
+            cspec = cspec.reshape(nStand, nPol, nchan, args.decimate)
+            cspec = cspec.mean(axis=3)
+        specToPlot[i,:,:,:] = cspec
+        times[i] = dataDict['tStart']
+        
+        dataDict.close()
+        
+    print("Got %i files from %s to %s (%.1f s)" % (len(filenames), datetime.utcfromtimestamp(times[0]).strftime("%Y/%m/%d %H:%M:%S"), datetime.utcfromtimestamp(times[-1]).strftime("%Y/%m/%d %H:%M:%S"), (times[-1]-times[0])))
+    print("Number of frequency channels: %i (~%.1f Hz/channel)" % (len(freq), freq[1]-freq[0]))
+    
+    dTimes = times - times[0]
+    
+    fig1 = plt.figure()
+    fig2 = plt.figure()
+    
+    nRow = int(numpy.sqrt( nStand ))
+    nCol = int(numpy.ceil(nStand*1.0/nRow))
+    for s in xrange(nStand):
+        ax = fig1.add_subplot(nRow, nCol, s+1)
+        for p,name in enumerate(('X', 'Y')):
+            ax.plot(freq/1e6, to_dB(specToPlot[:,s,p,:].mean(axis=0)), label=name)
+        ax.set_xlabel('Frequency [MHz]')
+        ax.set_ylabel('PSD [arb. dB]')
+        ax.set_title("%i" % stands[s])
+        ax.set_xlim((freq[0]/1e6, freq[-1]/1e6))
+        ax.legend(loc=0)
+        
+        ax = fig2.add_subplot(nRow, nCol, s+1)
+        for p,name in enumerate(('X', 'Y')):
+            ax.plot(dTimes, to_dB(specToPlot[:,s,p,:].mean(axis=1)), label=name)
+        ax.set_xlabel('Elapsed Time [s]')
+        ax.set_ylabel('Total Power [arb. dB]')
+        ax.set_title("%i" % stands[s])
+        ax.legend(loc=0)
+        
+    for f in (fig1, fig2):
+        f.suptitle("%s to %s UTC" % (datetime.utcfromtimestamp(times[0]).strftime("%Y/%m/%d %H:%M"), datetime.utcfromtimestamp(times[-1]).strftime("%Y/%m/%d %H:%M")))
+        
+    plt.show()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='given a collection of .npz files generated by "the next generation of correlator" with --autos-only, create plots of the spectra',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, nargs='+',
+                        help='filename to process')
+    parser.add_argument('-l', '--limit', type=int, default=-1,
+                        help='limit the data loaded to the first N files, -1 = load all')
+    parser.add_argument('-d', '--decimate', type=int, default=1,
+                        help='frequency decimation factor')
+    args = parser.parse_args()
+    main(args)
+
@@ -28,7 +28,7 @@ def main(args):
     observer = site.get_observer()
     
     # Load in the file file to figure out what to do
-    dataDict = numpy.load(args.filename[0])
+    dataDict = load_visibilities(args.filename[0])
     tStart = dataDict['tStart'].item()
     tInt = dataDict['tInt']
     freq = dataDict['freq1']
@@ -46,7 +46,7 @@ def main(args):
     uvw = []
     for filename in args.filename:
         ## Load in the integration
-        dataDict = numpy.load(filename)
+        dataDict = load_visibilities(filename)
         
         tStart = dataDict['tStart'].item()
         tInt = dataDict['tInt'].item()
@@ -17,8 +17,13 @@ import math
 import time
 import ephem
 import numpy
+import shutil
 import getpass
 import argparse
+import tempfile
+import functools
+import subprocess
+import multiprocessing
 from datetime import datetime
 
 from astropy.constants import c as vLight
@@ -37,6 +42,7 @@ from lsl.reader.buffer import DRXFrameBuffer, VDIFFrameBuffer
 
 import jones
 from utils import *
+from flagger import flag_fengine
 
 
 def bestFreqUnits(freq):
@@ -74,13 +80,78 @@ def bestFreqUnits(freq):
     return (newFreq, units)
 
 
-def main(args):
-    # Select the multirate module to use
-    if args.jit:
-        from jit import multirate
-    else:
-        import multirate
+def autotune(args, nInput, nReads=4):
+    """
+    Run a series of short correlator trials on the configuration file to find
+    the fastest combination of data read time, sub-integration time, OpenMP 
+    thread count, and F-/X-engine for this host.  The parameters are tuned one
+    at a time and the results are saved with utils.save_tuning.
+    """
+    
+    script = os.path.abspath(__file__)
+    filename = os.path.abspath(args.filename)
+    
+    def _trial(params):
+        cmd = [sys.executable, '-u', script, '-q', '--ignore-tuning',
+               '-l', str(args.fft_length), '-s', str(args.skip), '-t', str(args.dump_time),
+               '-u', str(params['subint_time']), '--read-time', str(params['read_time']),
+               '-d', str(nReads*params['read_time']), '-w', str(args.which), '-g', 'autotune']
+        if params['jit']:
+            cmd.append('-j')
+        if args.pfb:
+            cmd.extend(['--pfb', '--pfb-taps', str(args.pfb_taps), '--pfb-window', args.pfb_window])
+        if args.gpu is not None:
+            cmd.append('--gpu=%i' % args.gpu)
+        cmd.extend(['--xengine', args.xengine, '--fengine-precision', args.fengine_precision,
+                    '--xengine-workers', str(args.xengine_workers)])
+        cmd.append(filename)
+        
+        env = os.environ.copy()
+        env['OMP_NUM_THREADS'] = str(params['threads'])
+        
+        ## Time stamp the end of each data read so that we can skip over the 
+        ## first one, which includes any setup and JIT compilation
+        stamps = []
+        cwd = tempfile.mkdtemp(prefix='autotune-')
+        try:
+            p = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in iter(p.stdout.readline, b''):
+                if line.startswith(b'RR - '):
+                    stamps.append(time.time())
+            status = p.wait()
+        finally:
+            shutil.rmtree(cwd, ignore_errors=True)
+        if status != 0 or len(stamps) < 3:
+            return numpy.inf
+        return numpy.median(numpy.diff(stamps)[1:]) / params['read_time']
         
+    nCPU = multiprocessing.cpu_count()
+    candidates = [('jit', [True,] if args.pfb else [False, True]),
+                  ('threads', sorted(set([2**i for i in xrange(int(math.log(nCPU, 2))+1)] + [nCPU,]))),
+                  ('read_time', [0.5, 1.0, 2.0]),
+                  ('subint_time', sorted(set([t for t in (0.005, 0.010, 0.020, 0.050) if t <= args.subint_time] + [args.subint_time,])))]
+                  
+    best = {'jit': args.jit, 'threads': nCPU, 'read_time': args.read_time, 'subint_time': args.subint_time}
+    for name,values in candidates:
+        results = []
+        for value in values:
+            params = best.copy()
+            params[name] = value
+            tRun = _trial(params)
+            ### AT = autotune
+            print("AT - %s = %s: %.3f s per s of data" % (name, value, tRun))
+            results.append((tRun, value))
+        tRun, value = min(results, key=lambda x: x[0])
+        if not numpy.isfinite(tRun):
+            raise RuntimeError("All autotuning trials failed for %s" % name)
+        best[name] = value
+        
+    save_tuning(nInput, best)
+    print("AT - saved tuning for %i inputs: %s" % (nInput, ', '.join(['%s = %s' % (k,best[k]) for k in sorted(best.keys())])))
+    return best
+
+
+def main(args):
     # Build up the station
     site = stations.lwa1
     ## Updated 2018/3/8 with solutions from the 2018 Feb 28 eLWA
@@ -102,6 +173,45 @@ def main(args):
         args.duration = refSrc.duration
     args.duration = min([args.duration, refSrc.duration])
     
+    # Autotune or apply any saved tuning for this host and array size
+    if args.autotune:
+        autotune(args, len(filenames))
+        return
+    if not args.ignore_tuning:
+        tuning = load_tuning(len(filenames))
+        if tuning is not None:
+            ## The OpenMP thread count is fixed when the runtime loads so 
+            ## restart with it set in the environment
+            if 'OMP_NUM_THREADS' not in os.environ:
+                os.environ['OMP_NUM_THREADS'] = str(tuning['threads'])
+                sys.stdout.flush()
+                os.execv(sys.executable, [sys.executable,]+sys.argv)
+            ## Only override values that were left at their defaults
+            if args.read_time == 1.0:
+                args.read_time = tuning['read_time']
+            if args.subint_time == 0.010:
+                args.subint_time = tuning['subint_time']
+            args.jit |= tuning['jit']
+            print("NOTE: Applied saved tuning of %.3f s reads, %.3f s sub-integrations, and %s threads%s" % (args.read_time, args.subint_time, os.environ['OMP_NUM_THREADS'], ' with JIT' if args.jit else ''))
+            
+    # Select the multirate module to use - the PFB F-engine is only available
+    # with the JIT optimizations
+    if args.pfb and not args.jit:
+        print("NOTE: Enabling the JIT optimizations for the PFB F-engine")
+        args.jit = True
+    if args.jit:
+        if args.fftw_rigor is not None:
+            os.environ['ELWA_JIT_FFTW_RIGOR'] = args.fftw_rigor
+        from jit import multirate
+    else:
+        import multirate
+        
+    # Select the F-engine to use
+    if args.pfb:
+        fengine = functools.partial(multirate.pfbengine, ntap=args.pfb_taps, pfb_window=args.pfb_window)
+    else:
+        fengine = multirate.fengine
+        
     # Length of the FFT
     LFFT = args.fft_length
     
@@ -259,7 +369,7 @@ def main(args):
         print("Shifted beam %i data by %i frames (%.4f s)" % (beams[i], j, jTime))
         
     # Set integration time
-    tRead = 1.0
+    tRead = args.read_time
     nFrames = int(round(tRead*srate[-1]/readers[-1].DATA_LENGTH))
     tRead = nFrames*readers[-1].DATA_LENGTH/srate[-1]
     
@@ -377,6 +487,26 @@ def main(args):
     print("Integration (dump) time is: %.3f s" % tDump)
     print(" ")
     
+    if args.xengine == 'blas':
+        from jit import xblas
+        multirate.xengine = xblas.xengine
+        multirate.xengine_full = xblas.xengine_full
+        print("Loaded BLAS X-engine support%s" % (' using cherk' if xblas.HAS_CHERK else ''))
+    elif args.xengine == 'int8':
+        from jit import xint8
+        multirate.xengine = xint8.xengine
+        multirate.xengine_full = xint8.xengine_full
+        print("Loaded int8 X-engine support")
+    int8Report = (args.xengine == 'int8')
+    int8Data = (args.xengine == 'int8')
+    
+    if args.xengine_workers > 0 and not args.autos_only:
+        from cornerturn import CornerTurnXEngine
+        xengineModule = {'blas': 'jit.xblas', 'int8': 'jit.xint8'}.get(args.xengine, multirate.__name__)
+        xct = CornerTurnXEngine(args.xengine_workers, engine=xengineModule)
+        multirate.xengine_full = xct.xengine_full
+        print("Started %i X-engine worker processes with %i threads each" % (args.xengine_workers, xct.threads))
+        
     if args.gpu is not None:
         try:
             from jit import xcupy
@@ -384,19 +514,73 @@ def main(args):
             xcupy.set_memory_usage_limit(1.5*1024**3)
             multirate.xengine = xcupy.xengine
             multirate.xengine_full = xcupy.xengine_full
+            int8Data = False
             print("Loaded GPU X-engine support on GPU #%i with %.2f GB of device memory" % (args.gpu, xcupy.get_memory_usage_limit()/1024.0**3))
         except ImportError as e:
             pass
             
     subIntTimes = []
     subIntCount = 0
+    bda = None
     fileCount   = 0
     wallStart = time.time()
     done = False
     oldStartRel = [0 for i in xrange(nVDIFInputs+nDRXInputs)]
     username = getpass.getuser()
-    for i in xrange(nChunks):
+    
+    # Checkpointing
+    checkname = "%s%s.checkpoint" % (outbase, '-spec' if args.autos_only else '')
+    checkSetup = {'filename': os.path.basename(args.filename), 'skip': args.skip,
+                  'vdifLFFT': vdifLFFT, 'drxLFFT': drxLFFT, 'tSub': tSub, 'tDump': tDump,
+                  'vdifPivot': vdifPivot,
+                  'fengine': 'pfb-%i-%s' % (args.pfb_taps, args.pfb_window) if args.pfb else 'fft'}
+    firstChunk = 0
+    fileStart = 0
+    if args.resume:
+        checkpoint = load_checkpoint(checkname)
+        if checkpoint is None:
+            print("CP - no checkpoint found at '%s', starting from the beginning" % checkname)
+        else:
+            for key in checkSetup:
+                if checkpoint['setup'].get(key, None) != checkSetup[key]:
+                    raise RuntimeError("Checkpoint '%s' is incompatible with the current setup: %s is %s, expected %s" % (checkname, key, checkpoint['setup'].get(key, None), checkSetup[key]))
+                    
+            ## File positions
+            for f,offset in zip(fh, checkpoint['offsets']):
+                f.seek(offset, 0)
+                
+            ## Clock offset tracking
+            oldStartRel = checkpoint['oldStartRel']
+            for ant,offset in zip(antennas, checkpoint['clockOffsets']):
+                ant.cable.clock_offset = offset
+                
+            ## Channel and antenna selection
+            if checkpoint['goodV'] is not None:
+                goodV = numpy.array(checkpoint['goodV'], dtype=numpy.int64)
+                aXV = [k for (k,a) in enumerate(antennas[:2*nVDIFInputs]) if a.pol == 0]
+                aYV = [k for (k,a) in enumerate(antennas[:2*nVDIFInputs]) if a.pol == 1]
+            if checkpoint['goodD'] is not None:
+                goodD = numpy.array(checkpoint['goodD'], dtype=numpy.int64)
+                aXD = [k for (k,a) in enumerate(antennas[2*nVDIFInputs:]) if a.pol == 0]
+                aYD = [k for (k,a) in enumerate(antennas[2*nVDIFInputs:]) if a.pol == 1]
+                
+            ## Output numbering
+            firstChunk = checkpoint['chunk']
+            fileCount = checkpoint['fileCount']
+            fileStart = fileCount
+            ### CP = checkpoint
+            print("CP - resuming at data read %i of %i after integration %i" % (firstChunk+1, nChunks, fileCount))
+            
+    # Profiling
+    profiler = Profiler(args.profile, rate=args.profile_rate, default="%s-profile" % outbase)
+    
+    # Stage timing
+    timer = StageTimer("%s-metrics.jsonl" % outbase, interval=args.metrics_interval)
+    
+    profiler.start()
+    for i in xrange(firstChunk, nChunks):
         wallTime = time.time()
+        timer.reset()
         
         tStart = []
         tStartB = []
@@ -500,6 +684,7 @@ def main(args):
                                 break
                                 
         print('RR - Read finished in %.3f s for %.3fs of data' % (time.time()-wallTime, tRead))
+        timer.mark('read', nbytes=dataV.nbytes+dataD.nbytes, nsamples=dataV.size+dataD.size)
         
         # Figure out which DRX tuning corresponds to the VDIF data
         if nDRXInputs > 0:
@@ -557,6 +742,7 @@ def main(args):
             antennas[2*k+0].cable.clock_offset -= tStartRel[k] - oldStartRel[k]
             antennas[2*k+1].cable.clock_offset -= tStartRel[k] - oldStartRel[k]
         oldStartRel = tStartRel
+        timer.mark('alignment')
         
         # Setup everything we need to loop through the sub-integrations
         nSub = int(tRead/tSub)
@@ -586,61 +772,139 @@ def main(args):
                 if tDSub.size == 0:
                     continue
                     
+            ## Autocorrelation-only spectrometer mode - the delays, Jones 
+            ## matrices, and fringe rotation do not change the power spectra 
+            ## so go straight from the raw data to the spectra
+            if args.autos_only:
+                if nVDIFInputs > 0:
+                    freqV, psdV = multirate.spectrometer(dataVSub, LFFT=vdifLFFT, sample_rate=srate[0],
+                                                         central_freq=cFreqs[0][0]-srate[0]/4)
+                if nDRXInputs > 0:
+                    freqD, psdD = multirate.spectrometer(dataDSub, LFFT=drxLFFT, sample_rate=srate[-1],
+                                                         central_freq=cFreqs[-1][vdifPivot-1])
+                timer.mark('fengine', nbytes=dataVSub.nbytes+dataDSub.nbytes, nsamples=dataVSub.size+dataDSub.size)
+                
+                ### Channels and antennas (X vs. Y) - when there are both VDIF
+                ### and DRX inputs use the nearest DRX channel to each VDIF
+                ### channel in the overlap
+                try:
+                    spsd[...] = 0.0
+                except NameError:
+                    if nVDIFInputs > 0:
+                        specV = numpy.arange(freqV.size)
+                        aXV = [k for (k,a) in enumerate(antennas[:2*nVDIFInputs]) if a.pol == 0]
+                        aYV = [k for (k,a) in enumerate(antennas[:2*nVDIFInputs]) if a.pol == 1]
+                    if nDRXInputs > 0:
+                        specD = numpy.arange(freqD.size)
+                        aXD = [k for (k,a) in enumerate(antennas[2*nVDIFInputs:]) if a.pol == 0]
+                        aYD = [k for (k,a) in enumerate(antennas[2*nVDIFInputs:]) if a.pol == 1]
+                    if nVDIFInputs*nDRXInputs != 0:
+                        specV = numpy.where( (freqV >= freqD.min()) & (freqV <= freqD.max()) )[0]
+                        specD = numpy.array([numpy.argmin(numpy.abs(freqD - f)) for f in freqV[specV]])
+                        
+                    sfreq = freqV[specV] if nVDIFInputs > 0 else freqD[specD]
+                    spsd = numpy.zeros((nVDIFInputs+nDRXInputs, 2, sfreq.size), dtype=numpy.float32)
+                    
+                    ### AO = autocorrelations only
+                    print("AO - Found %i channels spanning %.3f MHz to %.3f MHz" % (sfreq.size, sfreq[0]/1e6, sfreq[-1]/1e6))
+                    
+                ### Sort it all out by station and polarization
+                for k in xrange(nVDIFInputs):
+                    spsd[k,0,:] = psdV[aXV[k],specV]
+                    spsd[k,1,:] = psdV[aYV[k],specV]
+                for k in xrange(nDRXInputs):
+                    spsd[k+nVDIFInputs,0,:] = psdD[aXD[k],specD]
+                    spsd[k+nVDIFInputs,1,:] = psdD[aYD[k],specD]
+                timer.mark('polsort')
+                
+                ### Accumulate
+                if subIntCount == 0:
+                    subIntTimes = [tSubInt,]
+                    psd = spsd / nDump
+                else:
+                    subIntTimes.append( tSubInt )
+                    psd += spsd / nDump
+                subIntCount += 1
+                timer.mark('accumulate')
+                
+                ### Save
+                if subIntCount == nDump:
+                    subIntCount = 0
+                    fileCount += 1
+                    
+                    #### CD = correlator dump
+                    outfile = "%s-spec-%05i.npz" % (outbase, fileCount)
+                    numpy.savez(outfile, config=rawConfig, srate=srate[0]/2.0, freq1=sfreq, spec1=psd, 
+                                tStart=numpy.mean(numpy.array(subIntTimes, dtype=numpy.float64)), tInt=tDump)
+                    print("CD - writing spectra %i to disk, timestamp is %.3f s" % (fileCount, numpy.mean(numpy.array(subIntTimes, dtype=numpy.float64))))
+                    timer.mark('write', nbytes=os.path.getsize(outfile))
+                    timer.report(chunk=i+1, integrations=fileCount)
+                continue
+                
             ## Update the observation
             observer.date = astro.unix_to_utcjd(tSubInt) - astro.DJD_OFFSET
             refSrc.compute(observer)
             
-            ## Correct for the LWA dipole power pattern
+            ## Correct for the LWA dipole power pattern - this, the Jones
+            ## matrix, and the fringe rotation are all applied by the F-engine
+            drxGains, drxJones, drxFringeRate = None, None, 0.0
             if nDRXInputs > 0:
                 dipoleX, dipoleY = jones.get_lwa_antenna_gain(observer, refSrc, freq=cFreqs[-1][vdifPivot-1])
-                dataDSub[0::2,:] /= numpy.sqrt(dipoleX)
-                dataDSub[1::2,:] /= numpy.sqrt(dipoleY)
+                drxGains = numpy.ones(dataDSub.shape[0])
+                drxGains[0::2] /= numpy.sqrt(dipoleX)
+                drxGains[1::2] /= numpy.sqrt(dipoleY)
                 
-            ## Get the Jones matrices and apply
+            ## Get the Jones matrices
             ## NOTE: This moves the LWA into the frame of the VLA
             if nVDIFInputs*nDRXInputs > 0:
                 lwaToSky = jones.get_matrix_lwa(observer, refSrc)
                 skyToVLA = jones.get_matrix_vla(observer, refSrc, inverse=True)
-                dataDSub = jones.apply_matrix(dataDSub, numpy.matrix(skyToVLA)*numpy.matrix(lwaToSky))
+                drxJones = numpy.asarray(numpy.matrix(skyToVLA)*numpy.matrix(lwaToSky))
                 
+                ## Rotate the phase in time to deal with frequency offset between the VLA and LWA
+                drxFringeRate = (cFreqs[0][0]-cFreqs[-1][vdifPivot-1]) % (srate[-1]/drxLFFT)
+            timer.mark('jones')
+            
             ## Correlate
             delayPadding = multirate.get_optimal_delay_padding(antennas[:2*nVDIFInputs], antennas[2*nVDIFInputs:],
                                                                LFFT=drxLFFT, sample_rate=srate[-1], 
                                                                central_freq=cFreqs[-1][vdifPivot-1], 
                                                                pol='*', phase_center=refSrc)
             if nVDIFInputs > 0:
-                freqV, feoV, veoV, deoV = multirate.fengine(dataVSub, antennas[:2*nVDIFInputs], LFFT=vdifLFFT,
-                                                            sample_rate=srate[0], central_freq=cFreqs[0][0]-srate[0]/4,
-                                                            pol='*', phase_center=refSrc, 
-                                                            delayPadding=delayPadding)
+                freqV, feoV, veoV, deoV = fengine(dataVSub, antennas[:2*nVDIFInputs], LFFT=vdifLFFT,
+                                                  sample_rate=srate[0], central_freq=cFreqs[0][0]-srate[0]/4,
+                                                  pol='*', phase_center=refSrc, 
+                                                  delayPadding=delayPadding)
                 
             if nDRXInputs > 0:
-                freqD, feoD, veoD, deoD = multirate.fengine(dataDSub, antennas[2*nVDIFInputs:], LFFT=drxLFFT,
-                                                            sample_rate=srate[-1], central_freq=cFreqs[-1][vdifPivot-1], 
-                                                            pol='*', phase_center=refSrc, 
-                                                            delayPadding=delayPadding)
-                
-            ## Rotate the phase in time to deal with frequency offset between the VLA and LWA
+                freqD, feoD, veoD, deoD = fengine(dataDSub, antennas[2*nVDIFInputs:], LFFT=drxLFFT,
+                                                  sample_rate=srate[-1], central_freq=cFreqs[-1][vdifPivot-1], 
+                                                  pol='*', phase_center=refSrc, 
+                                                  delayPadding=delayPadding,
+                                                  gains=drxGains, jones=drxJones,
+                                                  fringe_rate=drxFringeRate, fringe_time=tDSub[0])
+            timer.mark('fengine', nbytes=dataVSub.nbytes+dataDSub.nbytes, nsamples=dataVSub.size+dataDSub.size)
+            
+            ## Account for the fringe rotation applied in the F-engine
             if nDRXInputs*nVDIFInputs > 0:
-                subChanFreqOffset = (cFreqs[0][0]-cFreqs[-1][vdifPivot-1]) % (freqD[1]-freqD[0])
+                subChanFreqOffset = drxFringeRate
                 
                 if i == 0 and j == 0:
                     ## FC = frequency correction
                     tv,tu = bestFreqUnits(subChanFreqOffset)
-                    print("FC - Applying fringe rotation rate of %.3f %s to the DRX data" % (tv,tu))
+                    print("FC - Applied fringe rotation rate of %.3f %s to the DRX data" % (tv,tu))
                     
                 freqD += subChanFreqOffset
-                for w in xrange(feoD.shape[2]):
-                    feoD[:,:,w] *= numpy.exp(-2j*numpy.pi*subChanFreqOffset*tDSub[w*drxLFFT])
-                    
+            timer.mark('fringe')
+            
             ## Sort out what goes where (channels and antennas) if we don't already know
             try:
                 if nVDIFInputs > 0:
                     freqV = freqV[goodV]
-                    feoV = numpy.roll(feoV, -goodV[0], axis=1)[:,:len(goodV),:]
+                    feoV = feoV[:,goodV,:]
                 if nDRXInputs > 0:
                     freqD = freqD[goodD]
-                    feoD = numpy.roll(feoD, -goodD[0], axis=1)[:,:len(goodD),:]
+                    feoD = feoD[:,goodD,:]
                     
             except NameError:
                 ### Frequency overlap
@@ -698,13 +962,29 @@ def main(args):
                     except AssertionError:
                         raise RuntimeError("Cannot find a common frequency set between the input data: offsets range between %.3f Hz and %.3f Hz, expected %.3f Hz" % (fd.min(), fd.max(), subChanFreqOffset))
                         
+                ### Zoom bands
+                if config.get('zoom', None) is not None:
+                    ## The VDIF and DRX selections are already aligned so
+                    ## the same channels can be used for both
+                    if nVDIFInputs > 0:
+                        zoom = get_zoom_channels(freqV[goodV], config['zoom'])
+                    else:
+                        zoom = get_zoom_channels(freqD[goodD], config['zoom'])
+                    if nVDIFInputs > 0:
+                        goodV = goodV[zoom]
+                    if nDRXInputs > 0:
+                        goodD = goodD[zoom]
+                        
+                    ## ZB = zoom bands
+                    print("ZB - Correlating %i channels in %i zoom band(s)" % (len(zoom), len(config['zoom'])))
+                    
                 ### Apply
                 if nVDIFInputs > 0:
                     freqV = freqV[goodV]
-                    feoV = numpy.roll(feoV, -goodV[0], axis=1)[:,:len(goodV),:]
+                    feoV = feoV[:,goodV,:]
                 if nDRXInputs > 0:
                     freqD = freqD[goodD]
-                    feoD = numpy.roll(feoD, -goodD[0], axis=1)[:,:len(goodD),:]
+                    feoD = feoD[:,goodD,:]
             try:
                 nchan = freqV.size
                 fdt = feoV.dtype
@@ -725,10 +1005,20 @@ def main(args):
                 
             ### Initialize the intermediate arrays
             try:
-                assert(feoX.shape[2] == nWin)
+                assert(veoX.shape[1] == nWin)
             except (NameError, AssertionError):
-                feoX = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
-                feoY = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
+                if int8Data:
+                    feoX = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin+2, 2), dtype=numpy.int8)
+                    feoY = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin+2, 2), dtype=numpy.int8)
+                elif args.fengine_precision == 'cfloat16':
+                    feoX = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin, 2), dtype=numpy.float16)
+                    feoY = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin, 2), dtype=numpy.float16)
+                else:
+                    feoX = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
+                    feoY = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
+                if args.validate_precision or int8Report:
+                    feoXF = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
+                    feoYF = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
                 veoX = numpy.zeros((nVDIFInputs+nDRXInputs, nWin), dtype=vdt)
                 veoY = numpy.zeros((nVDIFInputs+nDRXInputs, nWin), dtype=vdt)
                 
@@ -740,18 +1030,56 @@ def main(args):
                 feoD = feoD[:,:,:nWin]
                 veoD = veoD[:,:nWin]
                 
+            ### RFI flagging - a station channel is only kept if it is good in 
+            ### both polarizations and a baseline channel is only kept if it
+            ### is good for both stations
+            if args.rfi_clip > 0:
+                keep = numpy.ones((nVDIFInputs+nDRXInputs, nchan), dtype=bool)
+                if nVDIFInputs > 0:
+                    keepV = flag_fengine(feoV, veoV, clip=args.rfi_clip)
+                    for k in xrange(nVDIFInputs):
+                        keep[k,:] &= keepV[aXV[k],:] & keepV[aYV[k],:]
+                if nDRXInputs > 0:
+                    keepD = flag_fengine(feoD, veoD, clip=args.rfi_clip)
+                    for k in xrange(nDRXInputs):
+                        keep[k+nVDIFInputs,:] &= keepD[aXD[k],:] & keepD[aYD[k],:]
+                s1, s2 = numpy.triu_indices(nVDIFInputs+nDRXInputs)
+                sweights = (keep[s1,:] & keep[s2,:]).astype(numpy.float32)
+                timer.mark('flag')
+                
             ## Sort it all out by polarization
             for k in xrange(nVDIFInputs):
-                feoX[k,:,:] = feoV[aXV[k],:,:]
-                feoY[k,:,:] = feoV[aYV[k],:,:]
+                if int8Data:
+                    xint8.quantize(feoV[aXV[k],:,:], out=feoX[k,:,:,:])
+                    xint8.quantize(feoV[aYV[k],:,:], out=feoY[k,:,:,:])
+                elif args.fengine_precision == 'cfloat16':
+                    multirate.to_half(feoV[aXV[k],:,:], out=feoX[k,:,:,:])
+                    multirate.to_half(feoV[aYV[k],:,:], out=feoY[k,:,:,:])
+                else:
+                    feoX[k,:,:] = feoV[aXV[k],:,:]
+                    feoY[k,:,:] = feoV[aYV[k],:,:]
+                if args.validate_precision or int8Report:
+                    feoXF[k,:,:] = feoV[aXV[k],:,:]
+                    feoYF[k,:,:] = feoV[aYV[k],:,:]
                 veoX[k,:] = veoV[aXV[k],:]
                 veoY[k,:] = veoV[aYV[k],:]
             for k in xrange(nDRXInputs):
-                feoX[k+nVDIFInputs,:,:] = feoD[aXD[k],:,:]
-                feoY[k+nVDIFInputs,:,:] = feoD[aYD[k],:,:]
+                if int8Data:
+                    xint8.quantize(feoD[aXD[k],:,:], out=feoX[k+nVDIFInputs,:,:,:])
+                    xint8.quantize(feoD[aYD[k],:,:], out=feoY[k+nVDIFInputs,:,:,:])
+                elif args.fengine_precision == 'cfloat16':
+                    multirate.to_half(feoD[aXD[k],:,:], out=feoX[k+nVDIFInputs,:,:,:])
+                    multirate.to_half(feoD[aYD[k],:,:], out=feoY[k+nVDIFInputs,:,:,:])
+                else:
+                    feoX[k+nVDIFInputs,:,:] = feoD[aXD[k],:,:]
+                    feoY[k+nVDIFInputs,:,:] = feoD[aYD[k],:,:]
+                if args.validate_precision or int8Report:
+                    feoXF[k+nVDIFInputs,:,:] = feoD[aXD[k],:,:]
+                    feoYF[k+nVDIFInputs,:,:] = feoD[aYD[k],:,:]
                 veoX[k+nVDIFInputs,:] = veoD[aXD[k],:]
                 veoY[k+nVDIFInputs,:] = veoD[aYD[k],:]
-                
+            timer.mark('polsort')
+            
             ## Cross multiply
             try:
                 sfreqXX = freqV
@@ -760,6 +1088,33 @@ def main(args):
                 sfreqXX = freqD
                 sfreqYY = freqD
             svisXX, svisXY, svisYX, svisYY = multirate.xengine_full(feoX, veoX, feoY, veoY)
+            timer.mark('xengine', nbytes=feoX.nbytes+feoY.nbytes, nsamples=2*veoX.size*nchan)
+            
+            ### Baselines that have been completely flagged have no valid 
+            ### windows to normalize by so zero them and give them no weight
+            if args.rfi_clip > 0:
+                nValid = numpy.min([(veoX[s1,:]*veoX[s2,:]).sum(axis=1),
+                                    (veoX[s1,:]*veoY[s2,:]).sum(axis=1),
+                                    (veoY[s1,:]*veoX[s2,:]).sum(axis=1),
+                                    (veoY[s1,:]*veoY[s2,:]).sum(axis=1)], axis=0)
+                empty = numpy.where(nValid == 0)[0]
+                if empty.size > 0:
+                    for svis in (svisXX, svisXY, svisYX, svisYY):
+                        svis[empty,:] = 0.0
+                    sweights[empty,:] = 0.0
+            
+            ### Report on the accuracy of the int8 X-engine for the first 
+            ### sub-integration using the full precision F-engine output
+            if int8Report:
+                xint8.print_accuracy(xint8.get_accuracy(feoXF, veoX, feoYF, veoY))
+                int8Report = False
+                
+            ### Compare with the visibilities from the full precision F-engine
+            ### output
+            if args.validate_precision:
+                rvis = multirate.xengine_full(feoXF, veoX, feoYF, veoY)
+                precErrors = [get_visibility_error(v, r) for v,r in zip((svisXX, svisXY, svisYX, svisYY), rvis)]
+                print("Precision check: max. rel. error %.2e, RMS rel. error %.2e" % (max([e[0] for e in precErrors]), max([e[1] for e in precErrors])))
             
             ## Accumulate
             if subIntCount == 0:
@@ -770,45 +1125,115 @@ def main(args):
                 visXY  = svisXY / nDump
                 visYX  = svisYX / nDump
                 visYY  = svisYY / nDump
+                if args.rfi_clip > 0:
+                    weights = sweights / nDump
             else:
                 subIntTimes.append( tSubInt )
                 visXX += svisXX / nDump
                 visXY += svisXY / nDump
                 visYX += svisYX / nDump
                 visYY += svisYY / nDump
+                if args.rfi_clip > 0:
+                    weights += sweights / nDump
             subIntCount += 1
+            timer.mark('accumulate')
             
             ## Save
             if subIntCount == nDump:
                 subIntCount = 0
                 fileCount += 1
                 
+                ### Undo the flagged sub-integrations in the average
+                if args.rfi_clip > 0:
+                    norm = numpy.where(weights > 0, weights, 1.0)
+                    visXX /= norm
+                    visXY /= norm
+                    visYX /= norm
+                    visYY /= norm
+                    
+                    #### RF = RFI flagging
+                    print("RF - %.1f%% of the baseline channels flagged, %.1f%% completely" % (100.0*(1-weights.mean()), 100.0*(weights == 0).mean()))
+                else:
+                    weights = None
+                    
+                ### Baseline-dependent averaging
+                if args.bda > 0:
+                    if bda is None:
+                        chanBlock = None
+                        if config.get('zoom', None) is not None:
+                            chanBlock = freqXX.size // len(config['zoom'])
+                        bdaTime, bdaChan = get_bda_factors([ant for ant in antennas if ant.pol == 0], freqXX, tDump, args.bda,
+                                                           max_factor=args.bda_max_factor, chan_block=chanBlock)
+                        bda = BaselineAverager(bdaTime, bdaChan)
+                        
+                        #### BA = baseline-dependent averaging
+                        print("BA - Averaging %i baselines by %i to %i dumps and %i to %i channels" % (bdaTime.size, bdaTime.min(), bdaTime.max(), bdaChan.min(), bdaChan.max()))
+                        print("BA - Output is reduced by a factor of %.1f" % (1.0*bdaTime.size / (1.0/bdaTime/bdaChan).sum(),))
+                    visData = bda.add(fileCount, visXX, visXY, visYX, visYY, weights=weights)
+                else:
+                    visData = {'vis1XX': visXX, 'vis1XY': visXY, 'vis1YX': visYX, 'vis1YY': visYY}
+                    if weights is not None:
+                        visData['weights1'] = weights
+                    
                 ### CD = correlator dump
                 outfile = "%s-vis2-%05i.npz" % (outbase, fileCount)
-                numpy.savez(outfile, config=rawConfig, srate=srate[0]/2.0, freq1=freqXX, 
-                            vis1XX=visXX, vis1XY=visXY, vis1YX=visYX, vis1YY=visYY, 
-                            tStart=numpy.mean(numpy.array(subIntTimes, dtype=numpy.float64)), tInt=tDump)
+                save_visibilities(outfile, precision=args.precision, compression=args.compression,
+                                  config=rawConfig, srate=srate[0]/2.0, freq1=freqXX, 
+                                  tStart=numpy.mean(numpy.array(subIntTimes, dtype=numpy.float64)), tInt=tDump,
+                                  **visData)
                 print("CD - writing integration %i to disk, timestamp is %.3f s" % (fileCount, numpy.mean(numpy.array(subIntTimes, dtype=numpy.float64))))
                 if fileCount == 1:
                     print("CD - each integration is %.1f MB on disk" % (os.path.getsize(outfile)/1024.0**2,))
                 if (fileCount-1) % 25 == 0:
-                    print("CD - average processing time per integration is %.3f s" % ((time.time() - wallStart)/fileCount,))
-                    etc = (nInt - fileCount) * (time.time() - wallStart)/fileCount
+                    print("CD - average processing time per integration is %.3f s" % ((time.time() - wallStart)/(fileCount-fileStart),))
+                    etc = (nInt - fileCount) * (time.time() - wallStart)/(fileCount-fileStart)
                     eth = int(etc/60.0) // 60
                     etm = int(etc/60.0) % 60
                     ets = etc % 60
                     print("CD - estimated time to completion is %i:%02i:%04.1f" % (eth, etm, ets))
-                    
+                timer.mark('write', nbytes=os.path.getsize(outfile))
+                timer.report(chunk=i+1, integrations=fileCount)
+                
+        # Save a checkpoint if we have just finished an integration and there
+        # is nothing left in the accumulators
+        if subIntCount == 0 and fileCount > fileStart and not done \
+           and (bda is None or fileCount % bda.period == 0):
+            ## Back up over any frames that are still sitting in the frame 
+            ## buffers so that they are read again on resume
+            offsets = []
+            for j,f in enumerate(fh):
+                try:
+                    nBuffered = sum([len(frames) for frames in buffers[j].buffer.values()])
+                except AttributeError:
+                    nBuffered = 0
+                offsets.append( f.tell() - nBuffered*readers[j].FRAME_SIZE )
+                
+            try:
+                cGoodV = goodV
+            except NameError:
+                cGoodV = None
+            try:
+                cGoodD = goodD
+            except NameError:
+                cGoodD = None
+            save_checkpoint(checkname, {'setup': checkSetup, 'chunk': i+1, 'fileCount': fileCount,
+                                        'offsets': offsets, 'oldStartRel': oldStartRel,
+                                        'clockOffsets': [ant.cable.clock_offset for ant in antennas],
+                                        'goodV': cGoodV, 'goodD': cGoodD})
+            timer.mark('checkpoint')
+            
         if done:
             break
-            
+    profiler.stop()
+    
     # Cleanup
     etc = time.time() - wallStart
     eth = int(etc/60.0) // 60
     etm = int(etc/60.0) % 60
     ets = etc % 60
     print("Processing finished after %i:%02i:%04.1f" % (eth, etm, ets))
-    print("Average time per integration was %.3f s" % (etc/fileCount,))
+    print("Average time per integration was %.3f s" % (etc/max([1, fileCount-fileStart]),))
+    timer.report(force=True, integrations=fileCount, final=True)
     for f in fh:
         f.close()
 
@@ -836,10 +1261,49 @@ if __name__ == "__main__":
                         help='tag to use for the output file')
     parser.add_argument('-j', '--jit', action='store_true', 
                         help='enable experimental just-in-time optimizations')
+    parser.add_argument('--fftw-rigor', type=str, choices=('estimate', 'measure', 'patient', 'exhaustive'),
+                        help='FFTW planning rigor for the just-in-time optimizations; default is "measure"')
     parser.add_argument('--gpu', type=int,
                         help='enable the experimental GPU X-engine')
+    parser.add_argument('--pfb', action='store_true',
+                        help='use a polyphase filter bank F-engine for better channel isolation; implies -j')
+    parser.add_argument('--pfb-taps', type=int, default=4,
+                        help='number of taps for the polyphase filter bank F-engine')
+    parser.add_argument('--pfb-window', type=str, choices=('hanning', 'hamming', 'blackman'), default='hanning',
+                        help='window to apply to the polyphase filter bank')
+    parser.add_argument('--xengine', type=str, choices=('default', 'blas', 'int8'), default='default',
+                        help='CPU X-engine to use; "blas" computes the visibilities as a matrix product per channel and "int8" requantizes the data to 8-bit integers')
+    parser.add_argument('--xengine-workers', type=int, default=0,
+                        help='number of worker processes to split the X-engine channels across; 0 runs the X-engine in the main process')
+    parser.add_argument('--bda', type=float, default=0.0,
+                        help='field of view in degrees to use for baseline-dependent averaging of the output; 0 = disabled')
+    parser.add_argument('--bda-max-factor', type=int, default=16,
+                        help='largest time and channel averaging factor for baseline-dependent averaging')
+    parser.add_argument('--rfi-clip', type=float, default=0.0,
+                        help='clip level in sigma for flagging RFI in the F-engine output using the power in each window and the spectral kurtosis of each channel; 0 = disabled')
+    parser.add_argument('--autos-only', action='store_true',
+                        help='only compute the autocorrelation spectra for each station and polarization, skipping the X-engine')
+    parser.add_argument('--fengine-precision', type=str, choices=('complex64', 'cfloat16'), default='complex64',
+                        help='precision of the F-engine output passed to the X-engine')
+    parser.add_argument('--validate-precision', action='store_true',
+                        help='compare the visibilities to those from the full precision F-engine output for every sub-integration')
     parser.add_argument('-w', '--which', type=int, default=0, 
                         help='for LWA-only observations, which tuning to use for correlation; 0 = auto-select')
+    parser.add_argument('--read-time', type=float, default=1.0,
+                        help='amount of data in seconds to read in at a time')
+    parser.add_argument('--autotune', action='store_true',
+                        help='run a short trial to find and save the fastest settings for this host and array size')
+    parser.add_argument('--ignore-tuning', action='store_true',
+                        help='do not apply any saved tuning for this host and array size')
+    parser.add_argument('--metrics-interval', type=float, default=30.0,
+                        help='interval in seconds between stage timing records written to the metrics file')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='resume a previous run from its last checkpoint')
+    parser.add_argument('--precision', type=str, choices=VIS_PRECISIONS, default='complex64',
+                        help='storage precision for the visibility data')
+    parser.add_argument('--compression', type=str, choices=VIS_COMPRESSIONS, default='none',
+                        help='compression method for the visibility data')
+    add_profile_option(parser)
     args = parser.parse_args()
     main(args)
     
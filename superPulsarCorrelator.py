@@ -80,6 +80,8 @@ def bestFreqUnits(freq):
 def main(args):
     # Select the multirate module to use
     if args.jit:
+        if args.fftw_rigor is not None:
+            os.environ['ELWA_JIT_FFTW_RIGOR'] = args.fftw_rigor
         from jit import multirate
     else:
         import multirate
@@ -385,6 +387,26 @@ def main(args):
     print("Integration (dump) time is: %.3f s" % tDump)
     print(" ")
     
+    if args.xengine == 'blas':
+        from jit import xblas
+        multirate.xengine = xblas.xengine
+        multirate.xengine_full = xblas.xengine_full
+        print("Loaded BLAS X-engine support%s" % (' using cherk' if xblas.HAS_CHERK else ''))
+    elif args.xengine == 'int8':
+        from jit import xint8
+        multirate.xengine = xint8.xengine
+        multirate.xengine_full = xint8.xengine_full
+        print("Loaded int8 X-engine support")
+    int8Report = (args.xengine == 'int8')
+    int8Data = (args.xengine == 'int8')
+    
+    if args.xengine_workers > 0:
+        from cornerturn import CornerTurnXEngine
+        xengineModule = {'blas': 'jit.xblas', 'int8': 'jit.xint8'}.get(args.xengine, multirate.__name__)
+        xct = CornerTurnXEngine(args.xengine_workers, engine=xengineModule)
+        multirate.xengine_full = xct.xengine_full
+        print("Started %i X-engine worker processes with %i threads each" % (args.xengine_workers, xct.threads))
+        
     if args.gpu is not None:
         try:
             from jit import xcupy
@@ -392,6 +414,7 @@ def main(args):
             xcupy.set_memory_usage_limit(1.5*1024**3)
             multirate.xengine = xcupy.xengine
             multirate.xengine_full = xcupy.xengine_full
+            int8Data = False
             print("Loaded GPU X-engine support on GPU #%i with %.2f GB of device memory" % (args.gpu, xcupy.get_memory_usage_limit()/1024.0**3))
         except ImportError as e:
             pass
@@ -440,6 +463,8 @@ def main(args):
     oldStartRel = [0 for i in xrange(nVDIFInputs+nDRXInputs)]
     currentDM, currentDoppler = -1.0, -1.0
     username = getpass.getuser()
+    profiler = Profiler(args.profile, rate=args.profile_rate, default="%s-profile" % outbase)
+    profiler.start()
     for i in xrange(nChunks):
         wallTime = time.time()
         
@@ -636,18 +661,24 @@ def main(args):
             observer.date = astro.unix_to_utcjd(tSubInt) - astro.DJD_OFFSET
             refSrc.compute(observer)
             
-            ## Correct for the LWA dipole power pattern
+            ## Correct for the LWA dipole power pattern - this, the Jones
+            ## matrix, and the fringe rotation are all applied by the F-engine
+            drxGains, drxJones, drxFringeRate = None, None, 0.0
             if nDRXInputs > 0:
                 dipoleX, dipoleY = jones.get_lwa_antenna_gain(observer, refSrc, freq=cFreqs[-1][vdifPivot-1])
-                dataDSub[0::2,:] /= numpy.sqrt(dipoleX)
-                dataDSub[1::2,:] /= numpy.sqrt(dipoleY)
+                drxGains = numpy.ones(dataDSub.shape[0])
+                drxGains[0::2] /= numpy.sqrt(dipoleX)
+                drxGains[1::2] /= numpy.sqrt(dipoleY)
                 
-            ## Get the Jones matrices and apply
+            ## Get the Jones matrices
             ## NOTE: This moves the LWA into the frame of the VLA
             if nVDIFInputs*nDRXInputs > 0:
                 lwaToSky = jones.get_matrix_lwa(observer, refSrc)
                 skyToVLA = jones.get_matrix_vla(observer, refSrc, inverse=True)
-                dataDSub = jones.apply_matrix(dataDSub, numpy.matrix(skyToVLA)*numpy.matrix(lwaToSky))
+                drxJones = numpy.asarray(numpy.matrix(skyToVLA)*numpy.matrix(lwaToSky))
+                
+                ## Rotate the phase in time to deal with frequency offset between the VLA and LWA
+                drxFringeRate = (cFreqs[0][0]-cFreqs[-1][vdifPivot-1]) % (srate[-1]/drxLFFT)
                 
             ## Correlate
             delayPadding = multirate.get_optimal_delay_padding(antennas[:2*nVDIFInputs], antennas[2*nVDIFInputs:],
@@ -664,29 +695,29 @@ def main(args):
                 freqD, feoD, veoD, deoD = multirate.fengine(dataDSub, antennas[2*nVDIFInputs:], LFFT=drxLFFT,
                                                             sample_rate=srate[-1], central_freq=cFreqs[-1][vdifPivot-1], 
                                                             pol='*', phase_center=refSrc, 
-                                                            delayPadding=delayPadding)
+                                                            delayPadding=delayPadding,
+                                                            gains=drxGains, jones=drxJones,
+                                                            fringe_rate=drxFringeRate, fringe_time=tDSub[0])
                 
-            ## Rotate the phase in time to deal with frequency offset between the VLA and LWA
+            ## Account for the fringe rotation applied in the F-engine
             if nDRXInputs*nVDIFInputs > 0:
-                subChanFreqOffset = (cFreqs[0][0]-cFreqs[-1][vdifPivot-1]) % (freqD[1]-freqD[0])
+                subChanFreqOffset = drxFringeRate
                 
                 if i == 0 and j == 0:
                     ## FC = frequency correction
                     tv,tu = bestFreqUnits(subChanFreqOffset)
-                    print("FC - Applying fringe rotation rate of %.3f %s to the DRX data" % (tv,tu))
+                    print("FC - Applied fringe rotation rate of %.3f %s to the DRX data" % (tv,tu))
                     
                 freqD += subChanFreqOffset
-                for w in xrange(feoD.shape[2]):
-                    feoD[:,:,w] *= numpy.exp(-2j*numpy.pi*subChanFreqOffset*tDSub[w*drxLFFT])
                     
             ## Sort out what goes where (channels and antennas) if we don't already know
             try:
                 if nVDIFInputs > 0:
                     freqV = freqV[goodV]
-                    feoV = numpy.roll(feoV, -goodV[0], axis=1)[:,:len(goodV),:]
+                    feoV = feoV[:,goodV,:]
                 if nDRXInputs > 0:
                     freqD = freqD[goodD]
-                    feoD = numpy.roll(feoD, -goodD[0], axis=1)[:,:len(goodD),:]
+                    feoD = feoD[:,goodD,:]
                     
             except NameError:
                 ### Frequency overlap
@@ -744,13 +775,29 @@ def main(args):
                     except AssertionError:
                         raise RuntimeError("Cannot find a common frequency set between the input data: offsets range between %.3f Hz and %.3f Hz, expected %.3f Hz" % (fd.min(), fd.max(), subChanFreqOffset))
                         
+                ### Zoom bands
+                if config.get('zoom', None) is not None:
+                    ## The VDIF and DRX selections are already aligned so
+                    ## the same channels can be used for both
+                    if nVDIFInputs > 0:
+                        zoom = get_zoom_channels(freqV[goodV], config['zoom'])
+                    else:
+                        zoom = get_zoom_channels(freqD[goodD], config['zoom'])
+                    if nVDIFInputs > 0:
+                        goodV = goodV[zoom]
+                    if nDRXInputs > 0:
+                        goodD = goodD[zoom]
+                        
+                    ## ZB = zoom bands
+                    print("ZB - Correlating %i channels in %i zoom band(s)" % (len(zoom), len(config['zoom'])))
+                    
                 ### Apply
                 if nVDIFInputs > 0:
                     freqV = freqV[goodV]
-                    feoV = numpy.roll(feoV, -goodV[0], axis=1)[:,:len(goodV),:]
+                    feoV = feoV[:,goodV,:]
                 if nDRXInputs > 0:
                     freqD = freqD[goodD]
-                    feoD = numpy.roll(feoD, -goodD[0], axis=1)[:,:len(goodD),:]
+                    feoD = feoD[:,goodD,:]
             try:
                 nchan = freqV.size
                 fdt = feoV.dtype
@@ -771,10 +818,20 @@ def main(args):
                 
             ### Initialize the intermediate arrays
             try:
-                assert(feoX.shape[2] == nWin)
+                assert(veoX.shape[1] == nWin)
             except (NameError, AssertionError):
-                feoX = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
-                feoY = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
+                if int8Data:
+                    feoX = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin+2, 2), dtype=numpy.int8)
+                    feoY = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin+2, 2), dtype=numpy.int8)
+                elif args.fengine_precision == 'cfloat16':
+                    feoX = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin, 2), dtype=numpy.float16)
+                    feoY = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin, 2), dtype=numpy.float16)
+                else:
+                    feoX = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
+                    feoY = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
+                if args.validate_precision or int8Report:
+                    feoXF = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
+                    feoYF = numpy.zeros((nVDIFInputs+nDRXInputs, nchan, nWin), dtype=fdt)
                 veoX = numpy.zeros((nVDIFInputs+nDRXInputs, nWin), dtype=vdt)
                 veoY = numpy.zeros((nVDIFInputs+nDRXInputs, nWin), dtype=vdt)
                 
@@ -788,13 +845,33 @@ def main(args):
                 
             ## Sort it all out by polarization
             for k in xrange(nVDIFInputs):
-                feoX[k,:,:] = feoV[aXV[k],:,:]
-                feoY[k,:,:] = feoV[aYV[k],:,:]
+                if int8Data:
+                    xint8.quantize(feoV[aXV[k],:,:], out=feoX[k,:,:,:])
+                    xint8.quantize(feoV[aYV[k],:,:], out=feoY[k,:,:,:])
+                elif args.fengine_precision == 'cfloat16':
+                    multirate.to_half(feoV[aXV[k],:,:], out=feoX[k,:,:,:])
+                    multirate.to_half(feoV[aYV[k],:,:], out=feoY[k,:,:,:])
+                else:
+                    feoX[k,:,:] = feoV[aXV[k],:,:]
+                    feoY[k,:,:] = feoV[aYV[k],:,:]
+                if args.validate_precision or int8Report:
+                    feoXF[k,:,:] = feoV[aXV[k],:,:]
+                    feoYF[k,:,:] = feoV[aYV[k],:,:]
                 veoX[k,:] = veoV[aXV[k],:]
                 veoY[k,:] = veoV[aYV[k],:]
             for k in xrange(nDRXInputs):
-                feoX[k+nVDIFInputs,:,:] = feoD[aXD[k],:,:]
-                feoY[k+nVDIFInputs,:,:] = feoD[aYD[k],:,:]
+                if int8Data:
+                    xint8.quantize(feoD[aXD[k],:,:], out=feoX[k+nVDIFInputs,:,:,:])
+                    xint8.quantize(feoD[aYD[k],:,:], out=feoY[k+nVDIFInputs,:,:,:])
+                elif args.fengine_precision == 'cfloat16':
+                    multirate.to_half(feoD[aXD[k],:,:], out=feoX[k+nVDIFInputs,:,:,:])
+                    multirate.to_half(feoD[aYD[k],:,:], out=feoY[k+nVDIFInputs,:,:,:])
+                else:
+                    feoX[k+nVDIFInputs,:,:] = feoD[aXD[k],:,:]
+                    feoY[k+nVDIFInputs,:,:] = feoD[aYD[k],:,:]
+                if args.validate_precision or int8Report:
+                    feoXF[k+nVDIFInputs,:,:] = feoD[aXD[k],:,:]
+                    feoYF[k+nVDIFInputs,:,:] = feoD[aYD[k],:,:]
                 veoX[k+nVDIFInputs,:] = veoD[aXD[k],:]
                 veoY[k+nVDIFInputs,:] = veoD[aYD[k],:]
                 
@@ -807,6 +884,19 @@ def main(args):
                 sfreqYY = freqD
             svisXX, svisXY, svisYX, svisYY = multirate.xengine_full(feoX, veoX, feoY, veoY)
             
+            ### Report on the accuracy of the int8 X-engine for the first 
+            ### sub-integration using the full precision F-engine output
+            if int8Report:
+                xint8.print_accuracy(xint8.get_accuracy(feoXF, veoX, feoYF, veoY))
+                int8Report = False
+                
+            ### Compare with the visibilities from the full precision F-engine
+            ### output
+            if args.validate_precision:
+                rvis = multirate.xengine_full(feoXF, veoX, feoYF, veoY)
+                precErrors = [get_visibility_error(v, r) for v,r in zip((svisXX, svisXY, svisYX, svisYY), rvis)]
+                print("Precision check: max. rel. error %.2e, RMS rel. error %.2e" % (max([e[0] for e in precErrors]), max([e[1] for e in precErrors])))
+                
             # Get a most precise representation of the current time
             mjdi, mjdf, mjdsf = FrameTimestamp(*tSubIntB).pulsar_mjd
             mjdf += mjdsf/86400.0
@@ -889,11 +979,12 @@ def main(args):
                         
                     ### CD = correlator dump
                     outfile = "%s-vis2-bin%03i-%05i.npz" % (outbase, bestBin, fileCount[bestBin])
-                    numpy.savez(outfile, config=rawConfig, polycos=rawPolycos, 
-                                srate=srate[0]/2.0, freq1=freqXX, 
-                                vis1XX=visXX[bestBin], vis1XY=visXY[bestBin], 
-                                vis1YX=visYX[bestBin], vis1YY=visYY[bestBin], 
-                                tStart=numpy.mean(numpy.array(subIntTimes[bestBin], dtype=numpy.float64)), tInt=tDumpAct)
+                    save_visibilities(outfile, precision=args.precision, compression=args.compression,
+                                      config=rawConfig, polycos=rawPolycos, 
+                                      srate=srate[0]/2.0, freq1=freqXX, 
+                                      vis1XX=visXX[bestBin], vis1XY=visXY[bestBin], 
+                                      vis1YX=visYX[bestBin], vis1YY=visYY[bestBin], 
+                                      tStart=numpy.mean(numpy.array(subIntTimes[bestBin], dtype=numpy.float64)), tInt=tDumpAct)
                     anyFilesSaved = True
                     print("CD - writing integration %i, bin %i to disk, timestamp is %.3f s" % (fileCount[bestBin], bestBin, numpy.mean(numpy.array(subIntTimes[bestBin], dtype=numpy.float64))))
                     if bestBin == 0:
@@ -910,7 +1001,8 @@ def main(args):
                             
         if done:
             break
-            
+    profiler.stop()
+    
     # Cleanup
     etc = time.time() - wallStart
     eth = int(etc/60.0) // 60
@@ -948,10 +1040,25 @@ if __name__ == "__main__":
                         help='tag to use for the output file')
     parser.add_argument('-j', '--jit', action='store_true', 
                         help='enable experimental just-in-time optimizations')
+    parser.add_argument('--fftw-rigor', type=str, choices=('estimate', 'measure', 'patient', 'exhaustive'),
+                        help='FFTW planning rigor for the just-in-time optimizations; default is "measure"')
     parser.add_argument('--gpu', type=int,
                         help='enable the experimental GPU X-engine')
+    parser.add_argument('--xengine', type=str, choices=('default', 'blas', 'int8'), default='default',
+                        help='CPU X-engine to use; "blas" computes the visibilities as a matrix product per channel and "int8" requantizes the data to 8-bit integers')
+    parser.add_argument('--xengine-workers', type=int, default=0,
+                        help='number of worker processes to split the X-engine channels across; 0 runs the X-engine in the main process')
+    parser.add_argument('--fengine-precision', type=str, choices=('complex64', 'cfloat16'), default='complex64',
+                        help='precision of the F-engine output passed to the X-engine')
+    parser.add_argument('--validate-precision', action='store_true',
+                        help='compare the visibilities to those from the full precision F-engine output for every sub-integration')
     parser.add_argument('-w', '--which', type=int, default=0, 
                         help='for LWA-only observations, which tuning to use for correlation; 0 = auto-select')
+    parser.add_argument('--precision', type=str, choices=VIS_PRECISIONS, default='complex64',
+                        help='storage precision for the visibility data')
+    parser.add_argument('--compression', type=str, choices=VIS_COMPRESSIONS, default='none',
+                        help='compression method for the visibility data')
+    add_profile_option(parser)
     args = parser.parse_args()
     main(args)
     
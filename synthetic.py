@@ -0,0 +1,449 @@
+"""
+Module for generating synthetic VDIF and DRX observations of a point source
+that can be used to test and benchmark the correlator without needing real
+data.
+"""
+
+# Python2 compatibility
+from __future__ import print_function, division, absolute_import
+
+import os
+import ephem
+import numpy
+import struct
+import calendar
+from datetime import datetime
+
+from astropy.constants import c as vLight
+
+from lsl.common.dp import fS
+
+
+__version__ = '0.1'
+__all__ = ['VDIFWriter', 'DRXWriter', 'SyntheticInput', 'get_lwa_station',
+           'get_vla_layout', 'get_transiting_source', 'simulate_observation',
+           'write_configuration']
+
+
+vLight = vLight.to('m/s').value
+
+
+# Location of the reference point (LWA1) used for the source positions
+_SITE_LAT = '34.068956328'
+_SITE_LON = '-107.628103026'
+_SITE_ELEV = 2132.96837346
+
+# Location of the VLA and LWA-SV relative to LWA1 in meters (east, north, up)
+_VLA_ENZ = (901.956, 1093.827, -18.247)
+_LWASV_ENZ = (68308.099, 31253.846, -1098.405)
+
+# VLA arm azimuths in degrees
+_VLA_ARMS = (-5.0, 115.0, 235.0)
+
+
+def _get_vdif_epoch(tStart):
+    """
+    Given a UNIX timestamp, return a two-element tuple of the VDIF reference
+    epoch number and the UNIX timestamp for the start of that epoch.
+    """
+    
+    dt = datetime.utcfromtimestamp(tStart)
+    epoch = 2*(dt.year - 2000) + (1 if dt.month >= 7 else 0)
+    epochStart = datetime(dt.year, 7 if dt.month >= 7 else 1, 1)
+    return epoch, calendar.timegm(epochStart.timetuple())
+
+
+class VDIFWriter(object):
+    """
+    Class for writing two-thread, 8-bit, real-valued VDIF data with a GUPPI
+    header like the files recorded at the VLA.
+    """
+    
+    def __init__(self, filename, station, tStart, sample_rate, central_freq, header=None, payload_size=5000):
+        if int(sample_rate) % payload_size != 0:
+            raise ValueError("Sample rate of %.1f Hz is not an integer number of %i sample frames" % (sample_rate, payload_size))
+        if int(tStart) != tStart:
+            raise ValueError("Start time must be an integer number of seconds")
+            
+        self.filename = filename
+        self.station = station
+        self.sample_rate = sample_rate
+        self.central_freq = central_freq
+        self.payload_size = payload_size
+        self.frames_per_second = int(sample_rate) // payload_size
+        
+        self.epoch, epochStart = _get_vdif_epoch(tStart)
+        self.seconds = int(tStart) - epochStart
+        self.frame = 0
+        self._buffers = [numpy.zeros(0, dtype=numpy.uint8), numpy.zeros(0, dtype=numpy.uint8)]
+        
+        # GUPPI header - frequencies are in MHz
+        cards = {'TELESCOP': 'VLA', 'OBSERVER': 'Synthetic', 'BASENAME': 'SYN_sb1.eb1.1.AC-synthetic',
+                 'SRC_NAME': 'Synthetic', 'RA_STR': '00:00:00.000', 'DEC_STR': '+00:00:00.00',
+                 'OBSFREQ': central_freq/1e6, 'OBSBW': sample_rate/2.0/1e6, 'NBITS': 8, 'NPOL': 2,
+                 'OBSNCHAN': 1, 'PKTSIZE': payload_size}
+        if header is not None:
+            cards.update(header)
+            
+        self.fh = open(self.filename, 'wb')
+        for key in sorted(cards.keys()):
+            value = cards[key]
+            if isinstance(value, str):
+                value = "'%s'" % value
+            else:
+                value = str(value)
+            self.fh.write(("%-8s= %s" % (key, value)).ljust(80).encode())
+        self.fh.write('END'.ljust(80).encode())
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, tb):
+        self.close()
+        
+    def _write_frame(self, thread, payload):
+        words = numpy.zeros(8, dtype='<u4')
+        words[0] = self.seconds & 0x3FFFFFFF
+        words[1] = ((self.epoch & 0x3F) << 24) | (self.frame & 0xFFFFFF)
+        words[2] = ((32 + self.payload_size) // 8) & 0xFFFFFF
+        words[3] = ((8 - 1) << 26) | ((thread & 0x3FF) << 16) | (self.station & 0xFFFF)
+        self.fh.write(words.tobytes())
+        self.fh.write(payload.tobytes())
+        
+    def write(self, thread0, thread1):
+        """
+        Quantize and buffer the real-valued samples for each thread, writing
+        out as many complete frames as possible.
+        """
+        
+        for i,data in enumerate((thread0, thread1)):
+            data = numpy.clip(numpy.round(data), -128, 127).astype(numpy.int16) + 128
+            self._buffers[i] = numpy.concatenate([self._buffers[i], data.astype(numpy.uint8)])
+            
+        nFrames = min([buf.size for buf in self._buffers]) // self.payload_size
+        for f in range(nFrames):
+            for thread,buf in enumerate(self._buffers):
+                self._write_frame(thread, buf[f*self.payload_size:(f+1)*self.payload_size])
+            self.frame += 1
+            if self.frame == self.frames_per_second:
+                self.frame = 0
+                self.seconds += 1
+        self._buffers = [buf[nFrames*self.payload_size:] for buf in self._buffers]
+        
+    def close(self):
+        self.fh.close()
+
+
+class DRXWriter(object):
+    """
+    Class for writing two-tuning, dual polarization DRX data.
+    """
+    
+    _SYNC_WORD = b'\xde\xc0\xde\x5c'
+    
+    def __init__(self, filename, beam, tStart, sample_rate, central_freqs):
+        decimation = fS / sample_rate
+        if decimation != int(decimation):
+            raise ValueError("Sample rate of %.1f Hz is not a valid DRX sample rate" % sample_rate)
+            
+        self.filename = filename
+        self.beam = beam
+        self.sample_rate = sample_rate
+        self.decimation = int(decimation)
+        self.tuning_words = [int(round(f / fS * 2**32)) for f in central_freqs]
+        self.central_freqs = [w * fS / 2**32 for w in self.tuning_words]
+        
+        self.timetag = int(round(tStart*fS))
+        self._buffers = {}
+        for tune in (1,2):
+            for pol in (0,1):
+                self._buffers[(tune,pol)] = numpy.zeros(0, dtype=numpy.complex64)
+                
+        self.fh = open(self.filename, 'wb')
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, tb):
+        self.close()
+        
+    def _write_frame(self, tune, pol, payload):
+        drxID = (self.beam & 0x7) | ((tune & 0x7) << 3) | ((pol & 0x1) << 7)
+        self.fh.write(self._SYNC_WORD)
+        self.fh.write(struct.pack('>IIHHQII', drxID << 24, 0, self.decimation, 0,
+                                  self.timetag, self.tuning_words[tune-1], 0))
+                                  
+        real = numpy.clip(numpy.round(payload.real), -7, 7).astype(numpy.int8)
+        imag = numpy.clip(numpy.round(payload.imag), -7, 7).astype(numpy.int8)
+        packed = ((real.astype(numpy.uint8) & 0xF) << 4) | (imag.astype(numpy.uint8) & 0xF)
+        self.fh.write(packed.astype(numpy.uint8).tobytes())
+        
+    def write(self, data):
+        """
+        Buffer the complex samples in the dictionary data, keyed by (tuning,
+        polarization), writing out as many complete frames as possible.
+        """
+        
+        for key in data:
+            self._buffers[key] = numpy.concatenate([self._buffers[key], data[key].astype(numpy.complex64)])
+            
+        nFrames = min([buf.size for buf in self._buffers.values()]) // 4096
+        for f in range(nFrames):
+            for tune in (1,2):
+                for pol in (0,1):
+                    self._write_frame(tune, pol, self._buffers[(tune,pol)][f*4096:(f+1)*4096])
+            self.timetag += 4096*self.decimation
+        for key in self._buffers:
+            self._buffers[key] = self._buffers[key][nFrames*4096:]
+            
+    def close(self):
+        self.fh.close()
+
+
+class SyntheticInput(object):
+    """
+    Class to hold the description of a single station in a synthetic
+    observation.
+    """
+    
+    def __init__(self, name, type, location, clock_offset=0.0, filename=None):
+        self.name = name
+        self.type = type.lower()
+        self.location = numpy.array(location, dtype=numpy.float64)
+        self.clock_offset = clock_offset
+        if filename is None:
+            filename = name.replace('-', '')
+            if self.type == 'vdif':
+                filename += '.vdif'
+        self.filename = filename
+        
+    @property
+    def pols(self):
+        """
+        Polarization order of the input, following createConfigFile.py.
+        """
+        
+        return ('Y', 'X') if self.type == 'vdif' else ('X', 'Y')
+
+
+def get_lwa_station(name, clock_offset=0.0):
+    """
+    Return a SyntheticInput instance for the named LWA station, either LWA1
+    or LWA-SV.
+    """
+    
+    if name.upper() in ('LWA1', 'LWA-1'):
+        return SyntheticInput('LWA1', 'drx', (0.0, 0.0, 0.0), clock_offset=clock_offset)
+    elif name.upper() in ('LWASV', 'LWA-SV'):
+        return SyntheticInput('LWA-SV', 'drx', _LWASV_ENZ, clock_offset=clock_offset)
+    else:
+        raise RuntimeError("Unknown LWA station '%s'" % name)
+
+
+def get_vla_layout(nAnt, clock_offsets=0.0):
+    """
+    Return a list of SyntheticInput instances for nAnt VLA antennas placed
+    along the three arms of the array.
+    """
+    
+    try:
+        len(clock_offsets)
+    except TypeError:
+        clock_offsets = [clock_offsets for i in range(nAnt)]
+        
+    inputs = []
+    for i in range(nAnt):
+        arm = _VLA_ARMS[i % 3] * numpy.pi/180
+        dist = 90.0 * (i // 3 + 1)**1.7
+        location = (_VLA_ENZ[0] + dist*numpy.sin(arm), _VLA_ENZ[1] + dist*numpy.cos(arm), _VLA_ENZ[2])
+        inputs.append( SyntheticInput('EA%02i' % (i+1,), 'vdif', location, clock_offset=clock_offsets[i]) )
+    return inputs
+
+
+def _get_observer():
+    """
+    Return an ephem.Observer for the reference location.
+    """
+    
+    observer = ephem.Observer()
+    observer.lat = _SITE_LAT
+    observer.lon = _SITE_LON
+    observer.elevation = _SITE_ELEV
+    return observer
+
+
+def get_transiting_source(tStart, dec, name='Synthetic'):
+    """
+    Return an ephem.FixedBody instance at the given J2000 declination that 
+    transits at the UNIX time tStart.
+    """
+    
+    observer = _get_observer()
+    observer.date = ephem.Date(datetime.utcfromtimestamp(tStart))
+    
+    source = ephem.FixedBody()
+    source.name = name
+    source._ra = observer.sidereal_time()
+    source._dec = dec
+    source._epoch = ephem.J2000
+    return source
+
+
+def _get_source_vector(observer, source, t):
+    """
+    Return the unit pointing vector (east, north, up) to the source at the
+    given UNIX time.
+    """
+    
+    observer.date = ephem.Date(datetime.utcfromtimestamp(t))
+    source.compute(observer)
+    az, el = float(source.az), float(source.alt)
+    return numpy.array([numpy.cos(el)*numpy.sin(az),
+                        numpy.cos(el)*numpy.cos(az),
+                        numpy.sin(el)])
+
+
+def simulate_observation(inputs, source, tStart, duration, vdif_freq=60e6, vdif_rate=32e6,
+                         drx_freqs=(60e6, 74e6), drx_rate=19.6e6, snr=0.1, block_time=0.01,
+                         seed=None, verbose=True):
+    """
+    Generate VDIF and DRX files for a point source observed by the list of
+    SyntheticInput instances.  The source is an ephem.FixedBody instance and
+    the observation starts at the integer UNIX time tStart and runs for the
+    specified duration in seconds.
+    
+    The sky signal is generated in blocks of block_time seconds as unpolarized
+    Gaussian noise on a common frequency grid.  For each block the geometric
+    delay of the source at each station, plus the station's clock offset, is
+    applied to the signal in the frequency domain before independent receiver
+    noise is added with the specified source-to-noise power ratio.  This
+    gives data with known delays and delay rates.  The instrumental responses
+    of the stations are not included.
+    """
+    
+    rng = numpy.random.RandomState(seed)
+    
+    # DRX tunings are quantized by the tuning word
+    drx_freqs = [round(f / fS * 2**32) * fS / 2**32 for f in drx_freqs]
+    
+    # Setup the observer for the source positions
+    observer = _get_observer()
+    
+    # Figure out the sample counts and sky frequency grid for each input
+    nSampV = int(round(block_time*vdif_rate))
+    nSampD = int(round(block_time*drx_rate))
+    if abs(nSampV - block_time*vdif_rate) > 1e-6 or abs(nSampD - block_time*drx_rate) > 1e-6:
+        raise ValueError("Block time of %.6f s is not an integer number of samples" % block_time)
+        
+    ## VDIF - real sampling with the band centered on vdif_freq
+    freqV = vdif_freq - vdif_rate/4.0 + numpy.fft.rfftfreq(nSampV, d=1.0/vdif_rate)
+    ## DRX - complex sampling
+    freqD = [f + numpy.fft.fftfreq(nSampD, d=1.0/drx_rate) for f in drx_freqs]
+    
+    binsV = numpy.round(freqV*block_time).astype(numpy.int64)
+    binsD = [numpy.round(f*block_time).astype(numpy.int64) for f in freqD]
+    binMin = min([binsV.min(),] + [b.min() for b in binsD])
+    binMax = max([binsV.max(),] + [b.max() for b in binsD])
+    nBins = binMax - binMin + 1
+    binsV -= binMin
+    binsD = [b - binMin for b in binsD]
+    
+    # Open the output files
+    writers = []
+    for i,inp in enumerate(inputs):
+        if inp.type == 'vdif':
+            station = 12300 + int(inp.name[2:], 10)
+            writers.append( VDIFWriter(inp.filename, station, tStart, vdif_rate, vdif_freq) )
+        else:
+            writers.append( DRXWriter(inp.filename, 1, tStart, drx_rate, drx_freqs) )
+            
+    # Go
+    nBlocks = int(round(duration / block_time))
+    sigS, sigN = numpy.sqrt(snr), 1.0
+    try:
+        for b in range(nBlocks):
+            tBlock = tStart + (b + 0.5)*block_time
+            pointing = _get_source_vector(observer, source, tBlock)
+            
+            ## Sky signal for each polarization - unit variance per bin
+            sky = {}
+            for pol in ('X', 'Y'):
+                sky[pol] = (rng.randn(nBins) + 1j*rng.randn(nBins)) / numpy.sqrt(2)
+                
+            for inp,writer in zip(inputs, writers):
+                delay = inp.clock_offset - numpy.dot(pointing, inp.location) / vLight
+                
+                if inp.type == 'vdif':
+                    phase = numpy.exp(-2j*numpy.pi*freqV*delay)
+                    threads = []
+                    for pol in inp.pols:
+                        spec = sky[pol][binsV] * phase
+                        sig = numpy.fft.irfft(spec, n=nSampV) * numpy.sqrt(nSampV)
+                        sig = sigS*sig + sigN*rng.randn(nSampV)
+                        threads.append( 10.0*sig )
+                    writer.write(*threads)
+                    
+                else:
+                    data = {}
+                    for t,(f,bins) in enumerate(zip(freqD, binsD)):
+                        phase = numpy.exp(-2j*numpy.pi*f*delay)
+                        for p,pol in enumerate(inp.pols):
+                            spec = sky[pol][bins] * phase
+                            sig = numpy.fft.ifft(spec) * numpy.sqrt(nSampD)
+                            sig = sigS*sig + sigN*(rng.randn(nSampD) + 1j*rng.randn(nSampD))/numpy.sqrt(2)
+                            data[(t+1,p)] = 2.5*sig
+                    writer.write(data)
+                    
+            if verbose and (b+1) % max([1, nBlocks//10]) == 0:
+                print("Generated %.3f of %.3f s" % ((b+1)*block_time, duration))
+                
+    finally:
+        for writer in writers:
+            writer.close()
+            
+    return [inp.filename for inp in inputs]
+
+
+def write_configuration(filename, inputs, source, duration, write_clock_offsets=True):
+    """
+    Write a superCorrelator.py configuration file for a set of SyntheticInput
+    instances and an ephem.FixedBody source.  If write_clock_offsets is False
+    the clock offsets are set to zero so that they need to be recovered with
+    a fringe search.
+    """
+    
+    with open(filename, 'w') as fh:
+        fh.write("# Created\n")
+        fh.write("#  on %s\n" % datetime.now())
+        fh.write("#  using %s\n" % os.path.basename(__file__))
+        fh.write("\n")
+        
+        fh.write("Context\n")
+        fh.write("  Observer  Synthetic\n")
+        fh.write("  Project   SYN\n")
+        fh.write("  Session   1\n")
+        fh.write("EndContext\n")
+        fh.write("\n")
+        
+        fh.write("Source\n")
+        fh.write("  Name     %s\n" % source.name)
+        fh.write("  Intent   target\n")
+        fh.write("  RA2000   %s\n" % source._ra)
+        fh.write("  Dec2000  %s\n" % source._dec)
+        fh.write("  Duration %.3f\n" % duration)
+        fh.write("SourceDone\n")
+        fh.write("\n")
+        
+        for inp in inputs:
+            offset = inp.clock_offset*1e6 if write_clock_offsets else 0.0
+            fh.write("Input\n")
+            fh.write("# True clock offset is %.3f us\n" % (inp.clock_offset*1e6,))
+            fh.write("  File             %s\n" % os.path.abspath(inp.filename))
+            fh.write("  Type             %s\n" % inp.type.upper())
+            fh.write("  Antenna          %s\n" % inp.name)
+            fh.write("  Pols             %s\n" % ', '.join(inp.pols))
+            fh.write("  Location         %.6f, %.6f, %.6f\n" % tuple(inp.location))
+            fh.write("  ClockOffset      %.3fus, %.3fus\n" % (offset, offset))
+            fh.write("  FileOffset       %.3f\n" % 0.0)
+            fh.write("InputDone\n")
+            fh.write("\n")
@@ -13,9 +13,13 @@ import os
 import re
 import glob
 import numpy
+import shutil
+import tempfile
 from astropy.io import fits as astrofits
 import subprocess
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
 _RAW = 'eLWA_test_small_raw.tar.gz'
 _REF = 'eLWA_test_ref.tar.gz'
 
@@ -184,6 +188,296 @@ class database(object):
         hdulist2.close()
 
 
+class elwa_unit_tests(unittest.TestCase):
+    """Unit tests for the pieces of the correlator that do not need the
+    eLWA test data."""
+    
+    def setUp(self):
+        """Seed the random number generator so the tests are repeatable."""
+        
+        numpy.random.seed(1234)
+        
+    def _get_fengine_output(self, nInput, nChan, nWin):
+        signalsF = numpy.random.randn(nInput, nChan, nWin) + 1j*numpy.random.randn(nInput, nChan, nWin)
+        validF = numpy.ones((nInput, nWin), dtype=numpy.uint8)
+        return signalsF.astype(numpy.complex64), validF
+        
+    def test_flag_fengine(self):
+        """Check that broadband RFI in a single window is removed before the X-engine."""
+        
+        from flagger import flag_fengine
+        from jit import multirate
+        
+        signalsF, validF = self._get_fengine_output(2, 64, 200)
+        signalsF[:,:,50] *= 30
+        
+        good = flag_fengine(signalsF, validF, clip=5.0)
+        self.assertTrue(numpy.all(validF[:,50] == 0))
+        self.assertTrue(numpy.all(signalsF[:,:,50] == 0))
+        self.assertEqual(validF.sum(), 2*199)
+        
+        visXX, visXY, visYX, visYY = multirate.xengine_full(signalsF[:1,:,:], validF[:1,:],
+                                                           signalsF[1:,:,:], validF[1:,:])
+        for vis,g in zip((visXX, visYY), good):
+            self.assertAlmostEqual(vis[0,g].real.mean(), 2.0, delta=0.1)
+            
+    def test_checkpoint(self):
+        """Check that a correlator checkpoint survives a save/load round trip."""
+        
+        from utils import save_checkpoint, load_checkpoint
+        
+        state = {'setup': {'filename': 'elwa.config', 'skip': 0.0, 'vdifLFFT': 512, 'drxLFFT': 256,
+                           'tSub': 0.1, 'tDump': 1.0, 'vdifPivot': 1},
+                 'chunk': numpy.int64(5), 'fileCount': 2,
+                 'offsets': [numpy.int64(1024), 2048], 'oldStartRel': (0, numpy.int32(3)),
+                 'clockOffsets': numpy.array([0.0, 1.5e-6]),
+                 'goodV': numpy.arange(10, 20), 'goodD': None}
+                 
+        tempDir = tempfile.mkdtemp(prefix='elwa-checkpoint-')
+        try:
+            checkname = os.path.join(tempDir, 'elwa.checkpoint')
+            self.assertTrue(load_checkpoint(checkname) is None)
+            
+            save_checkpoint(checkname, state)
+            self.assertEqual(os.listdir(tempDir), ['elwa.checkpoint'])
+            
+            checkpoint = load_checkpoint(checkname)
+            self.assertEqual(checkpoint['setup'], state['setup'])
+            self.assertEqual(checkpoint['chunk'], 5)
+            self.assertEqual(checkpoint['fileCount'], 2)
+            self.assertEqual(checkpoint['offsets'], [1024, 2048])
+            self.assertEqual(checkpoint['oldStartRel'], [0, 3])
+            self.assertEqual(checkpoint['clockOffsets'], [0.0, 1.5e-6])
+            self.assertEqual(checkpoint['goodV'], list(range(10, 20)))
+            self.assertTrue(checkpoint['goodD'] is None)
+            
+            ## A new checkpoint replaces the old one
+            state['chunk'] = 6
+            save_checkpoint(checkname, state)
+            self.assertEqual(os.listdir(tempDir), ['elwa.checkpoint'])
+            self.assertEqual(load_checkpoint(checkname)['chunk'], 6)
+        finally:
+            shutil.rmtree(tempDir)
+            
+    def test_zoom_channels(self):
+        """Check the channel selection for spectral zoom bands."""
+        
+        from utils import get_zoom_channels
+        
+        freq = 60e6 + numpy.arange(256)*10e3
+        
+        ## Bands are sorted and all get the channel count of the widest band
+        chans = get_zoom_channels(freq, [(61.0e6, 61.1e6), (60.2e6, 60.26e6)])
+        self.assertTrue(numpy.array_equal(chans, numpy.concatenate([numpy.arange(18, 29), numpy.arange(100, 111)])))
+        self.assertAlmostEqual(freq[chans[11]], 61.0e6)
+        self.assertAlmostEqual(freq[chans[-1]], 61.1e6)
+        
+        ## Bands at the edge are shifted so that they stay inside the data
+        chans = get_zoom_channels(freq, [(62.5e6, 62.6e6)])
+        self.assertTrue(numpy.array_equal(chans, numpy.arange(245, 256)))
+        chans = get_zoom_channels(freq, [(50e6, 70e6)])
+        self.assertTrue(numpy.array_equal(chans, numpy.arange(256)))
+        
+        self.assertRaises(RuntimeError, get_zoom_channels, freq, [(70e6, 71e6)])
+        
+    def test_bda_factors(self):
+        """Check the baseline-dependent averaging factors."""
+        
+        from lsl.common import stations
+        from utils import get_bda_factors
+        
+        antennas = []
+        for i,x in enumerate((0.0, 3000.0, 100000.0)):
+            antennas.append( stations.Antenna(2*i+1, stand=stations.Stand(i+1, x, 0.0, 0.0), pol=0) )
+        freq = 60e6 + numpy.arange(80)*50e3
+        
+        timeFactors, chanFactors = get_bda_factors(antennas, freq, 1.0, 2.0)
+        self.assertEqual(list(timeFactors), [16, 16, 2, 16, 2, 16])
+        self.assertEqual(list(chanFactors), [16, 8, 1, 16, 1, 16])
+        
+        timeFactors, chanFactors = get_bda_factors(antennas, freq, 1.0, 2.0, max_factor=4, chan_block=12)
+        self.assertEqual(list(timeFactors), [4, 4, 2, 4, 2, 4])
+        self.assertEqual(list(chanFactors), [4, 4, 1, 4, 1, 4])
+        
+    def test_bda_averaging(self):
+        """Check that BaselineAverager and get_bda_visibilities average each 
+        baseline over its own number of dumps and channels."""
+        
+        from utils import BaselineAverager, get_bda_visibilities
+        
+        nChan = 8
+        freq = 60e6 + numpy.arange(nChan)*50e3
+        chans = 10.0*numpy.arange(nChan)
+        
+        ## Baseline b is averaged over 2**b dumps and 2**b channels
+        bda = BaselineAverager([1, 2, 4], [1, 2, 4])
+        for dump in xrange(1, 5):
+            visXX = numpy.zeros((3, nChan), dtype=numpy.complex64) + dump + chans
+            output = bda.add(dump, visXX, 2*visXX, 3*visXX, 1j*visXX)
+            output['freq1'] = freq
+            
+            groups, visXX, visXY, visYX, visYY, weights = get_bda_visibilities(output)
+            self.assertTrue(weights is None)
+            baselines = numpy.concatenate([g[2] for g in groups])
+            self.assertEqual(sorted(baselines), [b for b in xrange(3) if dump % 2**b == 0])
+            for timeFactor,rows,bls in groups:
+                self.assertTrue(numpy.all(timeFactor == 2**bls))
+                
+            for row,b in enumerate(baselines):
+                n = 2**b
+                expected = (dump - (n-1)/2.0) + chans.reshape(-1, n).mean(axis=1).repeat(n)
+                self.assertTrue(numpy.allclose(visXX[row,:], expected))
+                self.assertTrue(numpy.allclose(visXY[row,:], 2*expected))
+                self.assertTrue(numpy.allclose(visYX[row,:], 3*expected))
+                self.assertTrue(numpy.allclose(visYY[row,:], 1j*expected))
+                
+        ## Weighted averages skip data with no weight
+        bda = BaselineAverager([2, 2], [2, 1])
+        for dump in xrange(1, 3):
+            visXX = numpy.zeros((2, nChan), dtype=numpy.complex64) + dump + chans
+            w = numpy.ones((2, nChan), dtype=numpy.float32)
+            if dump == 1:
+                w[0,:] = 0.0
+            output = bda.add(dump, visXX, visXX, visXX, visXX, weights=w)
+        output['freq1'] = freq
+        
+        groups, visXX, visXY, visYX, visYY, weights = get_bda_visibilities(output)
+        baselines = numpy.concatenate([g[2] for g in groups])
+        self.assertEqual(sorted(baselines), [0, 1])
+        row0, row1 = list(baselines).index(0), list(baselines).index(1)
+        self.assertTrue(numpy.allclose(visXX[row0,:], 2.0 + chans.reshape(-1, 2).mean(axis=1).repeat(2)))
+        self.assertTrue(numpy.allclose(weights[row0,:], 0.5))
+        self.assertTrue(numpy.allclose(visXX[row1,:], 1.5 + chans))
+        self.assertTrue(numpy.allclose(weights[row1,:], 1.0))
+        
+    def _get_compressions(self):
+        from utils import VIS_COMPRESSIONS
+        
+        compressions = ['none', 'zip']
+        for compression,module in (('zstd', 'zstandard'), ('lz4', 'lz4.frame')):
+            try:
+                __import__(module)
+                compressions.append(compression)
+            except ImportError:
+                pass
+        self.assertTrue(all([c in VIS_COMPRESSIONS for c in compressions]))
+        return compressions
+        
+    def test_visibility_codecs(self):
+        """Check that correlator dumps survive a save/load round trip for each codec."""
+        
+        from utils import VIS_PRECISIONS, save_visibilities, load_visibilities
+        
+        nBL, nChan = 6, 64
+        vis = numpy.random.randn(nBL, nChan) + 1j*numpy.random.randn(nBL, nChan)
+        vis[2,:] *= 1000
+        vis[4,:] = 0.0
+        freq = numpy.linspace(60e6, 64e6, nChan)
+        
+        tolerances = {'complex64': 1e-6, 'cfloat16': 1e-3, 'cint16': 1e-4}
+        tempDir = tempfile.mkdtemp(prefix='elwa-codec-')
+        try:
+            for precision in VIS_PRECISIONS:
+                for compression in self._get_compressions():
+                    filename = os.path.join(tempDir, 'test-vis2-%s-%s.npz' % (precision, compression))
+                    save_visibilities(filename, precision=precision, compression=compression,
+                                      freq1=freq, vis1XX=vis, tStart=1.0)
+                                      
+                    data = load_visibilities(filename)
+                    self.assertEqual(data.precision, precision)
+                    self.assertEqual(data.compression, compression)
+                    self.assertEqual(sorted(data.files), ['freq1', 'tStart', 'vis1XX'])
+                    self.assertTrue(numpy.array_equal(data['freq1'], freq))
+                    
+                    vis1 = data['vis1XX']
+                    self.assertEqual(vis1.shape, vis.shape)
+                    self.assertEqual(vis1.dtype, numpy.complex64)
+                    for b in range(nBL):
+                        scale = max([numpy.abs(vis[b,:]).max(), 1e-30])
+                        self.assertTrue(numpy.abs(vis1[b,:] - vis[b,:]).max() <= tolerances[precision]*scale)
+                    data.close()
+        finally:
+            shutil.rmtree(tempDir)
+            
+    def test_match_npz(self):
+        """Check that matchNPZ.py trims encoded dumps and keeps their codec."""
+        
+        from utils import save_visibilities, load_visibilities
+        
+        script = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'matchNPZ.py'))
+        
+        nBL, nChan = 3, 64
+        freq = numpy.linspace(60e6, 64e6, nChan)
+        vis = (numpy.random.randn(nBL, nChan) + 1j*numpy.random.randn(nBL, nChan)).astype(numpy.complex64)
+        weights = numpy.random.rand(nBL, nChan).astype(numpy.float32)
+        
+        tempDir = tempfile.mkdtemp(prefix='elwa-match-')
+        try:
+            save_visibilities(os.path.join(tempDir, 'template-vis2-00001.npz'),
+                              freq1=freq[16:48], vis1XX=vis[:,16:48])
+            save_visibilities(os.path.join(tempDir, 'scan-vis2-00001.npz'),
+                              precision='cint16', compression='zip',
+                              freq1=freq, vis1XX=vis, weights1=weights)
+                              
+            with open(os.path.join(tempDir, 'match.log'), 'w') as logfile:
+                subprocess.check_call([sys.executable, script, 'template-vis2-00001.npz', 'scan-vis2-00001.npz'],
+                                      stdout=logfile, stderr=subprocess.STDOUT, cwd=tempDir)
+                                      
+            data = load_visibilities(os.path.join(tempDir, 'scan-vis2T-00001.npz'))
+            self.assertEqual(data.precision, 'cint16')
+            self.assertEqual(data.compression, 'zip')
+            self.assertTrue(numpy.array_equal(data['freq1'], freq[16:48]))
+            self.assertTrue(numpy.allclose(data['weights1'], weights[:,16:48]))
+            self.assertEqual(data['vis1XX'].shape, (nBL, 32))
+            self.assertTrue(numpy.abs(data['vis1XX'] - vis[:,16:48]).max() < 1e-3*numpy.abs(vis).max())
+            data.close()
+        finally:
+            shutil.rmtree(tempDir)
+            
+    def test_validate_precision_eof(self):
+        """Check that superCorrelator.py validates the F-engine precision and stops cleanly at the end of the data."""
+        
+        from synthetic import get_lwa_station, get_transiting_source, simulate_observation, write_configuration
+        
+        script = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'superCorrelator.py'))
+        
+        tempDir = tempfile.mkdtemp(prefix='elwa-precision-')
+        try:
+            ## A short DRX-only observation with a configuration that asks for
+            ## more data than there is so that the readers hit the end of the
+            ## files
+            tStart = 1500000000
+            source = get_transiting_source(tStart, '+34:00:00')
+            inputs = [get_lwa_station('LWA1'), get_lwa_station('LWASV')]
+            for inp in inputs:
+                inp.filename = os.path.join(tempDir, inp.filename)
+            simulate_observation(inputs, source, tStart, 1.5, drx_rate=1e6, seed=1234, verbose=False)
+            write_configuration(os.path.join(tempDir, 'precision.config'), inputs, source, 4.0)
+            
+            cmd = [sys.executable, script, '--ignore-tuning', '-t', '1', '-l', '64',
+                   '--fengine-precision', 'cfloat16', '--validate-precision',
+                   '-g', 'precision', 'precision.config']
+            with open(os.path.join(tempDir, 'precision.log'), 'w') as logfile:
+                try:
+                    status = subprocess.check_call(cmd, stdout=logfile, stderr=subprocess.STDOUT, cwd=tempDir)
+                except subprocess.CalledProcessError:
+                    status = 1
+            with open(os.path.join(tempDir, 'precision.log'), 'r') as logfile:
+                log = logfile.read()
+            if status == 1:
+                print(log)
+            self.assertEqual(status, 0)
+            
+            checks = re.findall('Precision check: max. rel. error (.*), RMS rel. error (.*)', log)
+            self.assertTrue(len(checks) > 0)
+            for maxError,rmsError in checks:
+                self.assertTrue(float(maxError) < 1e-2)
+                self.assertTrue(float(rmsError) < 1e-2)
+            self.assertTrue(len(glob.glob(os.path.join(tempDir, 'precision-vis2-*.npz'))) > 0)
+        finally:
+            shutil.rmtree(tempDir)
+
+
 class elwa_test_suite(unittest.TestSuite):
     """A unittest.TestSuite class which contains all of the eLWA correlation tests."""
     
@@ -192,6 +486,7 @@ class elwa_test_suite(unittest.TestSuite):
         
         loader = unittest.TestLoader()
         self.addTests(loader.loadTestsFromTestCase(elwa_tests)) 
+        self.addTests(loader.loadTestsFromTestCase(elwa_unit_tests))
 
 
 if __name__ == '__main__':
@@ -13,10 +13,15 @@ import unittest
 import os
 import re
 import glob
+import json
 import numpy
+import shutil
+import tempfile
 from astropy.io import fits as astrofits
 import subprocess
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
 _RAW = 'eLWA_test_small_raw.tar.gz'
 _REF = 'eLWA_test_ref.tar.gz'
 
@@ -185,6 +190,347 @@ class database(object):
         hdulist2.close()
 
 
+class jit_kernel_tests(unittest.TestCase):
+    """Check the individual just-in-time kernels against numpy versions."""
+    
+    def setUp(self):
+        """Seed the random number generator so the tests are repeatable."""
+        
+        numpy.random.seed(1234)
+        
+    def _get_signals(self, dtype, nStand, nSamps):
+        signals = numpy.random.randn(nStand, nSamps)
+        if dtype == 'complex':
+            signals = signals + 1j*numpy.random.randn(nStand, nSamps)
+            signals = signals.astype(numpy.complex64)
+        else:
+            signals = signals.astype(numpy.float32)
+        return signals
+        
+    def _pfb_reference(self, signals, LFFT, ntap):
+        """Polyphase filter bank with a Hanning-windowed sinc for data that
+        have no delays applied."""
+        
+        nFFTpt = LFFT if signals.dtype.kind == 'c' else 2*LFFT
+        
+        n = numpy.arange(nFFTpt*ntap)
+        coeffs = numpy.sinc((n - nFFTpt*ntap/2.0 + 0.5)/nFFTpt)
+        coeffs *= 0.5 - 0.5*numpy.cos(2*numpy.pi*n/(nFFTpt*ntap-1))
+        
+        nStand, nSamps = signals.shape
+        nFFT = nSamps // nFFTpt
+        padded = numpy.zeros((nStand, nFFTpt*(ntap-1)+nSamps), dtype=signals.dtype)
+        padded[:,nFFTpt*(ntap-1):] = signals
+        
+        output = numpy.zeros((nStand, LFFT, nFFT), dtype=numpy.complex128)
+        for j in xrange(nFFT):
+            seg = padded[:,nFFTpt*j:nFFTpt*(j+ntap)] * coeffs
+            seg = seg.reshape(nStand, ntap, nFFTpt).sum(axis=1)
+            if signals.dtype.kind == 'c':
+                output[:,:,j] = numpy.fft.fftshift(numpy.fft.fft(seg, axis=1), axes=1)
+            else:
+                output[:,:,j] = numpy.fft.rfft(seg, axis=1)[:,:LFFT]
+        output /= numpy.sqrt(nFFTpt)
+        return output
+        
+    def test_pfbengine(self):
+        """Compare the PFB F-engine to a numpy polyphase filter bank."""
+        
+        from jit import multirate
+        
+        nStand, LFFT, ntap = 2, 64, 4
+        for dtype in ('complex', 'real'):
+            signals = self._get_signals(dtype, nStand, LFFT*200)
+            freq = numpy.fft.fftfreq(LFFT, d=1/19.6e6) + 10e6
+            delays = numpy.zeros((nStand, LFFT))
+            
+            PFBEngine = multirate.get_optimizer().get_function('PFBEngine', signals, freq, delays, LFFT=LFFT, overlap=1, sample_rate=19.6e6, clip_level=0, ntap=ntap, pfb_window='hanning')
+            signalsF, validF = PFBEngine(signals, freq, delays, sample_rate=19.6e6)
+            
+            ref = self._pfb_reference(signals, LFFT, ntap)
+            self.assertEqual(signalsF.shape, ref.shape)
+            self.assertTrue(numpy.all(validF == 1))
+            self.assertTrue(numpy.abs(signalsF - ref).max() < 1e-5*numpy.abs(ref).max())
+            
+    def test_fengine_fused(self):
+        """Compare the fused F-engine to applying the gains, Jones matrix, and
+        fringe rotation as separate steps."""
+        
+        from jit import multirate
+        from jones import apply_matrix
+        
+        nStand, LFFT, nWin = 4, 64, 100
+        sampleRate, fringeRate, fringeTime = 19.6e6, 12.5, 0.3
+        signals = self._get_signals('complex', nStand, LFFT*nWin)
+        freq = numpy.fft.fftshift(numpy.fft.fftfreq(LFFT, d=1/sampleRate)) + 60e6
+        
+        ## The X and Y inputs of a station share the same delay
+        delays = numpy.zeros((nStand, LFFT))
+        for i in xrange(nStand):
+            delays[i,:] = 40e-6 + (i//2)*1.234e-7
+        gains = numpy.array([1.0, 0.5, 2.0, 0.8])
+        jones = numpy.array([[0.9, 0.1-0.2j], [0.3+0.1j, 1.1]], dtype=numpy.complex64)
+        
+        FEngine = multirate.get_optimizer().get_function('FEngineFused', signals, freq, delays, jones, gains, LFFT=LFFT, overlap=1, sample_rate=sampleRate, clip_level=0, fringe_rate=fringeRate, fringe_time=fringeTime)
+        signalsF, validF = FEngine(signals, freq, delays, jones, gains, sample_rate=sampleRate, fringe_rate=fringeRate, fringe_time=fringeTime)
+        
+        ref = signals * gains[:,numpy.newaxis].astype(numpy.float32)
+        ref = apply_matrix(ref, jones)
+        FEngine = multirate.get_optimizer().get_function('FEngine', ref, freq, delays, LFFT=LFFT, overlap=1, sample_rate=sampleRate, clip_level=0)
+        refF, refValid = FEngine(ref, freq, delays, sample_rate=sampleRate)
+        for w in xrange(refF.shape[2]):
+            refF[:,:,w] *= numpy.exp(-2j*numpy.pi*fringeRate*(fringeTime + w*LFFT/sampleRate))
+            
+        self.assertEqual(signalsF.shape, refF.shape)
+        self.assertTrue(numpy.all(validF == refValid))
+        self.assertTrue(numpy.abs(signalsF - refF).max() < 1e-5*numpy.abs(refF).max())
+        
+    def test_spectrometer(self):
+        """Compare the autocorrelation-only spectrometer to numpy power spectra."""
+        
+        from jit import multirate
+        
+        nStand, LFFT, nWin = 3, 64, 50
+        for dtype in ('complex', 'real'):
+            signals = self._get_signals(dtype, nStand, (2 if dtype == 'real' else 1)*LFFT*nWin)
+            
+            if dtype == 'complex':
+                segs = signals.reshape(nStand, nWin, LFFT)
+                ref = (numpy.abs(numpy.fft.fft(segs, axis=2))**2).mean(axis=1) / LFFT
+                ref = numpy.fft.fftshift(ref, axes=1)
+            else:
+                segs = signals.reshape(nStand, nWin, 2*LFFT)
+                ref = (numpy.abs(numpy.fft.rfft(segs, axis=2)[:,:,:LFFT])**2).mean(axis=1) / (2*LFFT)
+                
+            freq, psd = multirate.spectrometer(signals, LFFT=LFFT, sample_rate=19.6e6, central_freq=60e6)
+            self.assertEqual(freq.size, LFFT)
+            self.assertEqual(psd.shape, ref.shape)
+            self.assertTrue(numpy.abs(psd - ref).max() < 1e-5*ref.max())
+            
+            ## Check each of the variants
+            mod = multirate.get_optimizer().get_module(signals.dtype.type.__name__, nStand, signals.shape[1], LFFT, 1, 0)
+            for name in ('specS', 'specF', 'specL'):
+                psd = getattr(mod, name)(signals)
+                self.assertTrue(numpy.abs(psd - ref).max() < 1e-5*ref.max())
+                
+    def _get_xengine_input(self, nStand, nChan, nWin):
+        signalsX = numpy.random.randn(nStand, nChan, nWin) + 1j*numpy.random.randn(nStand, nChan, nWin)
+        signalsY = numpy.random.randn(nStand, nChan, nWin) + 1j*numpy.random.randn(nStand, nChan, nWin)
+        validX = numpy.ones((nStand, nWin), dtype=numpy.uint8)
+        validY = numpy.ones((nStand, nWin), dtype=numpy.uint8)
+        validX[1,5:9] = 0
+        validY[2,20:] = 0
+        
+        ## The F-engine zeros any window that is not valid
+        signalsX *= validX[:,numpy.newaxis,:]
+        signalsY *= validY[:,numpy.newaxis,:]
+        return signalsX.astype(numpy.complex64), validX, signalsY.astype(numpy.complex64), validY
+        
+    def _xengine_reference(self, signalsX, validX, signalsY, validY):
+        from jit import multirate
+        
+        XEngine = multirate.get_optimizer().get_function('XEngine3', signalsX, signalsY, validX, validY)
+        return XEngine(signalsX, signalsY, validX, validY)
+        
+    def test_xengine_int8(self):
+        """Compare the int8 X-engine on quantized F-engine output to XEngine3."""
+        
+        from jit import xint8
+        
+        signalsX, validX, signalsY, validY = self._get_xengine_input(4, 16, 64)
+        ref = self._xengine_reference(signalsX, validX, signalsY, validY)
+        
+        qX, qY = xint8.quantize(signalsX), xint8.quantize(signalsY)
+        self.assertEqual(qX.dtype, numpy.int8)
+        self.assertEqual(qX.shape, (4, 16, 64+2, 2))
+        self.assertTrue(numpy.abs(xint8.dequantize(qX) - signalsX).max() < 1.0/127*numpy.abs(signalsX).max())
+        
+        vis = xint8.xengine_full(qX, validX, qY, validY)
+        for v,r in zip(vis, ref):
+            self.assertEqual(v.shape, r.shape)
+            self.assertTrue(numpy.abs(v - r).max() < 2e-2*numpy.abs(r).max())
+            
+        ## Quantizing a channel sub-band gives the same answer
+        vis = xint8.xengine_full(numpy.ascontiguousarray(qX[:,4:9,...]), validX, 
+                                 numpy.ascontiguousarray(qY[:,4:9,...]), validY)
+        vis2 = xint8.xengine_full(signalsX, validX, signalsY, validY)
+        for v,r in zip(vis, vis2):
+            self.assertTrue(numpy.allclose(v, r[:,4:9]))
+            
+        accuracy = xint8.get_accuracy(signalsX, validX, signalsY, validY)
+        for name in ('XX', 'XY', 'YX', 'YY'):
+            self.assertTrue(accuracy[name][0] < 2e-2)
+            self.assertTrue(accuracy[name][1] < 1e-2)
+            
+    def test_xengine_half(self):
+        """Compare the half precision X-engine to XEngine3."""
+        
+        from jit import multirate
+        
+        signalsX, validX, signalsY, validY = self._get_xengine_input(4, 16, 64)
+        ref = self._xengine_reference(signalsX, validX, signalsY, validY)
+        
+        hX, hY = multirate.to_half(signalsX), multirate.to_half(signalsY)
+        self.assertEqual(hX.dtype, numpy.float16)
+        self.assertEqual(hX.shape, (4, 16, 64, 2))
+        self.assertTrue(numpy.abs(multirate.from_half(hX) - signalsX).max() < 1e-3*numpy.abs(signalsX).max())
+        
+        out = numpy.zeros((4, 16, 64, 2), dtype=numpy.float16)
+        for k in xrange(4):
+            multirate.to_half(signalsX[k,:,:], out=out[k,:,:,:])
+        self.assertTrue(numpy.array_equal(out, hX))
+        
+        vis = multirate.xengine_full(hX, validX, hY, validY)
+        for v,r in zip(vis, ref):
+            self.assertEqual(v.shape, r.shape)
+            self.assertEqual(v.dtype, numpy.complex64)
+            self.assertTrue(numpy.abs(v - r).max() < 1e-3*numpy.abs(r).max())
+            
+    def _check_xblas(self):
+        from jit import xblas
+        
+        signalsX, validX, signalsY, validY = self._get_xengine_input(4, 16, 64)
+        ref = self._xengine_reference(signalsX, validX, signalsY, validY)
+        
+        vis = xblas.xengine_full(signalsX, validX, signalsY, validY)
+        for v,r in zip(vis, ref):
+            self.assertEqual(v.shape, r.shape)
+            self.assertTrue(numpy.abs(v - r).max() < 1e-5*numpy.abs(r).max())
+            
+        ## xengine() is the XY product
+        vis = xblas.xengine(signalsX, validX, signalsY, validY)
+        self.assertTrue(numpy.abs(vis - ref[1]).max() < 1e-5*numpy.abs(ref[1]).max())
+        
+    def test_xengine_blas_numpy(self):
+        """Compare the BLAS X-engine using numpy.matmul to XEngine3."""
+        
+        from jit import xblas
+        
+        hasCherk = xblas.HAS_CHERK
+        xblas.HAS_CHERK = False
+        try:
+            self._check_xblas()
+        finally:
+            xblas.HAS_CHERK = hasCherk
+            
+    def test_xengine_blas_cherk(self):
+        """Compare the BLAS X-engine using cherk to XEngine3."""
+        
+        from jit import xblas
+        
+        if not xblas.HAS_CHERK:
+            self.skipTest("SciPy cherk is not available")
+        self._check_xblas()
+        
+    def test_cornerturn(self):
+        """Compare the frequency-parallel X-engine workers to a single X-engine."""
+        
+        import pickle
+        import cornerturn
+        from jit import multirate, xint8
+        
+        self.assertEqual(cornerturn.get_subbands(10, 3), [(0, 3), (3, 6), (6, 10)])
+        self.assertEqual(cornerturn.get_subbands(2, 4), [(0, 1), (1, 2)])
+        
+        if cornerturn.shared_memory is None:
+            self.skipTest("shared memory is not available")
+            
+        ## Arrays should look the same on both sides of the transport
+        transport = cornerturn.SharedMemoryTransport()
+        try:
+            data = transport.empty((3, 4), numpy.complex64)
+            data[...] = numpy.arange(12).reshape(3, 4)
+            handle = transport.get_handle(data)
+            remote = pickle.loads(pickle.dumps(transport))
+            self.assertTrue(numpy.array_equal(remote.attach(handle), data))
+            remote.detach()
+            self.assertRaises(ValueError, transport.get_handle, numpy.zeros(3))
+        finally:
+            data = None
+            transport.close()
+            
+        signalsX, validX, signalsY, validY = self._get_xengine_input(4, 16, 64)
+        for engine in ('jit.multirate', 'jit.xint8'):
+            if engine == 'jit.xint8':
+                signalsX, signalsY = xint8.quantize(signalsX), xint8.quantize(signalsY)
+                ref = xint8.xengine_full(signalsX, validX, signalsY, validY)
+            else:
+                ref = multirate.xengine_full(signalsX, validX, signalsY, validY)
+                
+            xct = cornerturn.CornerTurnXEngine(3, engine=engine, threads=1, pin=False)
+            try:
+                for i in xrange(2):
+                    vis = xct.xengine_full(signalsX, validX, signalsY, validY)
+                    for v,r in zip(vis, ref):
+                        self.assertEqual(v.shape, r.shape)
+                        self.assertTrue(numpy.allclose(v, r, rtol=1e-5, atol=1e-6*numpy.abs(r).max()))
+            finally:
+                xct.close()
+                
+    def test_cache_eviction(self):
+        """Check that evicting modules from the JIT cache removes their lock files."""
+        
+        from jit.jit import JustInTimeOptimizer, _EXTENSION_SUFFIXES
+        
+        cacheDir = tempfile.mkdtemp(prefix='jit-cache-')
+        try:
+            opt = JustInTimeOptimizer(cache_dir=cacheDir, cache_size=0, verbose=False)
+            
+            for module in ('jit_test_evict', 'jit_test_orphan'):
+                for ext in (_EXTENSION_SUFFIXES[0], '.c', '.lock'):
+                    if module == 'jit_test_orphan' and ext != '.lock':
+                        continue
+                    with open(os.path.join(cacheDir, module+ext), 'w') as fh:
+                        fh.write('test')
+                        
+            opt._evict_cache()
+            self.assertEqual(glob.glob(os.path.join(cacheDir, 'jit_test_*')), [])
+        finally:
+            shutil.rmtree(cacheDir)
+            
+    def test_compiler_probe(self):
+        """Check that only complete compiler probes are saved to the JIT cache."""
+        
+        from jit.jit import JustInTimeOptimizer, _PROBE_FILE
+        
+        class NoOpenMPOptimizer(JustInTimeOptimizer):
+            def get_flags(self, cc=None, return_missing=False):
+                cflags, ldflags, missing = JustInTimeOptimizer.get_flags(self, cc=cc, return_missing=True)
+                cflags = [flag for flag in cflags if flag != '-fopenmp']
+                ldflags = [flag for flag in ldflags if flag != '-lgomp']
+                missing.append('openmp')
+                if return_missing:
+                    return cflags, ldflags, missing
+                else:
+                    return cflags, ldflags
+                    
+        cacheDir = tempfile.mkdtemp(prefix='jit-cache-')
+        try:
+            probename = os.path.join(cacheDir, _PROBE_FILE)
+            
+            ## A probe that fell back to defaults is used but not saved
+            opt = NoOpenMPOptimizer(cache_dir=cacheDir, verbose=False)
+            self.assertFalse('-fopenmp' in opt.cflags)
+            self.assertFalse(os.path.exists(probename))
+            
+            ## A complete probe is saved and then reused
+            opt = JustInTimeOptimizer(cache_dir=cacheDir, verbose=False)
+            cflags, ldflags, missing = opt.get_flags(return_missing=True)
+            if missing:
+                self.skipTest("Compiler probe did not find %s" % ', '.join(missing))
+            cc, key = opt._get_compiler_key()
+            with open(probename, 'r') as fh:
+                probes = json.load(fh)
+            self.assertEqual(list(probes.keys()), [key,])
+            self.assertEqual(probes[key]['cflags'], cflags)
+            self.assertEqual(probes[key]['ldflags'], ldflags)
+            
+            opt = NoOpenMPOptimizer(cache_dir=cacheDir, verbose=False)
+            self.assertTrue('-fopenmp' in opt.cflags)
+        finally:
+            shutil.rmtree(cacheDir)
+
+
 class jit_test_suite(unittest.TestSuite):
     """A unittest.TestSuite class which contains all of the eLWA correlation tests
     for the just-in-time version of the correlator."""
@@ -194,6 +540,7 @@ class jit_test_suite(unittest.TestSuite):
         
         loader = unittest.TestLoader()
         self.addTests(loader.loadTestsFromTestCase(jit_tests)) 
+        self.addTests(loader.loadTestsFromTestCase(jit_kernel_tests))
 
 
 if __name__ == '__main__':
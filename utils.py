@@ -8,14 +8,20 @@ from __future__ import print_function, division, absolute_import
 
 import os
 import re
+import sys
+import json
 import time
 import ephem
 import errno
 import fcntl
 import numpy
 import shutil
+import socket
+import cProfile
 import tempfile
+import threading
 import subprocess
+import zipfile
 from datetime import datetime
 
 from lsl import astro
@@ -33,7 +39,12 @@ __all__ = ['get_numa_node_count', 'get_numa_support', 'get_gpu_count',
            'get_gpu_support', 'InterProcessLock', 'EnhancedFixedBody',
            'EnhancedSun', 'EnhancedJupiter', 'multi_column_print',
            'parse_time_string', 'nsround', 'read_correlator_configuration',
-           'get_better_time', 'PolyCos']
+           'get_better_time', 'VIS_PRECISIONS', 'VIS_COMPRESSIONS',
+           'save_visibilities', 'load_visibilities', 'save_checkpoint',
+           'load_checkpoint', 'load_tuning', 'save_tuning', 'StageTimer',
+           'add_profile_option', 'Profiler', 'PolyCos', 'get_visibility_error',
+           'get_zoom_channels', 'get_bda_factors', 'BaselineAverager',
+           'get_bda_visibilities']
 
 
 # List of bright radio sources and pulsars in PyEphem format
@@ -398,13 +409,19 @@ def _read_correlator_configuration(filename):
             context = temp_context
             
         elif line == 'Configuration':
-            temp_config = {'inttime':None, 'channels':None, 'basis':None}
+            temp_config = {'inttime':None, 'channels':None, 'basis':None, 'zoom':None}
         elif line[:8] == 'Channels':
             temp_config['channels'] = int(line.split(None, 1)[1], 10)
         elif line[:7] == 'IntTime':
             temp_config['inttime'] = float(line.split(None, 1)[1])
         elif line[:8] == 'PolBasis':
             temp_config['basis'] = line.split(None, 1)[1]
+        elif line[:8] == 'ZoomBand':
+            ## Start and stop frequencies in MHz
+            start, stop = [float(v)*1e6 for v in line.split(None, 1)[1].split(',')]
+            if temp_config['zoom'] is None:
+                temp_config['zoom'] = []
+            temp_config['zoom'].append( (min([start, stop]), max([start, stop])) )
         elif line == 'EndConfiguration':
             config = temp_config
             
@@ -574,13 +591,13 @@ def read_correlator_configuration(filename_or_npz):
     """
     
     # Sort out what to do depending on what we were given
-    if isinstance(filename_or_npz, numpy.lib.npyio.NpzFile):
+    if isinstance(filename_or_npz, (numpy.lib.npyio.NpzFile, VisibilityFile)):
         ## An open .npz file, just work with it
         dataDict = filename_or_npz
         to_close = False
     elif os.path.splitext(filename_or_npz)[1] == '.npz':
         ## A .npz file, open and and then work with it
-        dataDict = numpy.load(filename_or_npz)
+        dataDict = load_visibilities(filename_or_npz)
         to_close = True
     else:
         ## Something else, just try some stuff
@@ -636,6 +653,48 @@ def read_correlator_configuration(filename_or_npz):
     return full_config
 
 
+def get_visibility_error(visibilities, reference):
+    """
+    Given a 2-D (baselines by channels) array of visibilities and a reference
+    array of the same shape, return a two-element tuple of the maximum and RMS
+    errors relative to the largest reference amplitude in each baseline.
+    """
+    
+    scale = numpy.abs(reference).max(axis=1)[:,numpy.newaxis]
+    scale[scale == 0] = 1.0
+    error = numpy.abs(visibilities - reference) / scale
+    return error.max(), numpy.sqrt((error**2).mean())
+
+
+def get_zoom_channels(freq, bands):
+    """
+    Given a 1-D array of channel frequencies in Hz and a list of (start, stop)
+    zoom bands in Hz, return a 1-D array of the channel indices to keep.  All
+    of the bands are given the same number of channels, the number needed to
+    cover the widest band, so that each one can be written out as an IF in a
+    FITS-IDI file.  The bands are returned in order of increasing frequency.
+    """
+    
+    df = abs(freq[1] - freq[0])
+    bands = sorted(bands)
+    
+    # Channels per band
+    nZoom = max([int(round((stop-start)/df)) + 1 for start,stop in bands])
+    nZoom = min([nZoom, freq.size])
+    
+    # Channel selection
+    chans = []
+    for start,stop in bands:
+        if stop < freq.min() or start > freq.max():
+            raise RuntimeError("Zoom band %.3f to %.3f MHz is outside of the correlated frequency range" % (start/1e6, stop/1e6))
+            
+        center = numpy.argmin(numpy.abs(freq - (start+stop)/2.0))
+        first = center - nZoom//2
+        first = max([0, min([first, freq.size-nZoom])])
+        chans.append( numpy.arange(first, first+nZoom) )
+    return numpy.concatenate(chans)
+
+
 def get_better_time(frame):
     """
     Given a lsl.reader.vdif.Frame or lsl.reader.drx.Frame instance, return a
@@ -654,6 +713,710 @@ def get_better_time(frame):
         return list(frame.time)
 
 
+# Storage options for the visibility data in the correlator dumps
+VIS_PRECISIONS = ('complex64', 'cfloat16', 'cint16')
+VIS_COMPRESSIONS = ('none', 'zip', 'zstd', 'lz4')
+
+
+def _get_compressor(compression):
+    """
+    Given a compression name of 'zstd' or 'lz4', return a two-element tuple of
+    compress and decompress functions for that method.
+    """
+    
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("Compression method 'zstd' requires the 'zstandard' module")
+        compress = lambda x: zstandard.ZstdCompressor(level=3).compress(x)
+        decompress = lambda x: zstandard.ZstdDecompressor().decompress(x)
+    elif compression == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise RuntimeError("Compression method 'lz4' requires the 'lz4' module")
+        compress = lz4.frame.compress
+        decompress = lz4.frame.decompress
+    else:
+        raise ValueError("Unknown compression method '%s'" % compression)
+    
+    return compress, decompress
+
+
+def _encode_vis(data, precision):
+    """
+    Convert a complex visibility array to a reduced precision representation.
+    Returns a two-element tuple of the encoded data as a real array with an
+    extra trailing axis for the real/imaginary parts and the per-row scale
+    factors needed to recover the original values.
+    """
+    
+    data = numpy.asarray(data)
+    shape = data.shape
+    data = data.reshape(-1, shape[-1])
+    parts = numpy.stack([data.real, data.imag], axis=-1)
+    
+    # One scale factor per row (typically a baseline) so that the full dynamic
+    # range is used for each one
+    scale = numpy.abs(parts).max(axis=(1,2))
+    scale = numpy.where(scale == 0, 1.0, scale).astype(numpy.float32)
+    
+    if precision == 'cfloat16':
+        parts = (parts / scale[:,None,None]).astype(numpy.float16)
+    elif precision == 'cint16':
+        scale /= 32767.0
+        parts = numpy.round(parts / scale[:,None,None]).astype(numpy.int16)
+    else:
+        raise ValueError("Unknown visibility precision '%s'" % precision)
+    
+    parts.shape = shape+(2,)
+    scale.shape = shape[:-1]
+    return parts, scale
+
+
+def _decode_vis(parts, scale):
+    """
+    Inverse of _encode_vis that returns a numpy.complex64 array.
+    """
+    
+    parts = parts.astype(numpy.float32)
+    parts *= scale[...,None,None]
+    return (parts[...,0] + 1j*parts[...,1]).astype(numpy.complex64)
+
+
+def _shuffle_compress(data, compression):
+    """
+    Byte-shuffle an array and compress it.  Returns the compressed data as a
+    1-D numpy.uint8 array.
+    """
+    
+    compress, _ = _get_compressor(compression)
+    
+    data = numpy.ascontiguousarray(data)
+    shuffled = data.view(numpy.uint8).reshape(-1, data.dtype.itemsize).T
+    blob = compress(numpy.ascontiguousarray(shuffled).tobytes())
+    return numpy.frombuffer(blob, dtype=numpy.uint8)
+
+
+def _unshuffle_decompress(blob, shape, dtype, compression):
+    """
+    Inverse of _shuffle_compress.
+    """
+    
+    _, decompress = _get_compressor(compression)
+    
+    dtype = numpy.dtype(dtype)
+    data = numpy.frombuffer(decompress(blob.tobytes()), dtype=numpy.uint8)
+    data = data.reshape(dtype.itemsize, -1).T
+    data = numpy.ascontiguousarray(data).view(dtype)
+    return data.reshape(shape)
+
+
+def save_visibilities(filename, precision='complex64', compression='none', **kwds):
+    """
+    Save a correlator dump to a .npz file.  All keywords are stored as they
+    would be with numpy.savez except for the visibility data (any keyword that
+    starts with 'vis').  These are stored using the requested precision:
+      * complex64 - full precision,
+      * cfloat16 - pairs of numpy.float16 values with a scale factor per
+                   baseline, or
+      * cint16 - pairs of numpy.int16 values with a scale factor per baseline
+    and then compressed with the requested method:
+      * none - no compression,
+      * zip - zip compression of the .npz file via numpy.savez_compressed,
+      * zstd - byte-shuffle and then compress with zstd, or
+      * lz4 - byte-shuffle and then compress with lz4.
+    
+    The resulting file can be read back in with load_visibilities.
+    """
+    
+    if precision not in VIS_PRECISIONS:
+        raise ValueError("Unknown visibility precision '%s'" % precision)
+    if compression not in VIS_COMPRESSIONS:
+        raise ValueError("Unknown compression method '%s'" % compression)
+    
+    arrays = {}
+    for key,value in kwds.items():
+        if key[:3] != 'vis':
+            arrays[key] = value
+            continue
+        
+        ## Precision
+        if precision == 'complex64':
+            value = numpy.asarray(value).astype(numpy.complex64)
+        else:
+            value, scale = _encode_vis(value, precision)
+            arrays['%s_scale' % key] = scale
+        
+        ## Compression
+        if compression in ('zstd', 'lz4'):
+            arrays['%s_shape' % key] = numpy.array(value.shape, dtype=numpy.int64)
+            arrays['%s_dtype' % key] = numpy.array(value.dtype.str)
+            value = _shuffle_compress(value, compression)
+        arrays[key] = value
+    
+    # Only tag the file if it needs decoding so that the default output can
+    # still be read with numpy.load
+    if precision != 'complex64' or compression in ('zstd', 'lz4'):
+        arrays['codec'] = numpy.array([precision, compression])
+    
+    if compression == 'zip':
+        numpy.savez_compressed(filename, **arrays)
+    else:
+        numpy.savez(filename, **arrays)
+
+
+class VisibilityFile(object):
+    """
+    Wrapper around numpy.lib.npyio.NpzFile that transparently decodes
+    visibility data written by save_visibilities.
+    """
+    
+    def __init__(self, filename):
+        self._npz = numpy.load(filename)
+        self.filename = filename
+        
+        self.precision, self.compression = 'complex64', 'none'
+        if 'codec' in self._npz.files:
+            self.precision, self.compression = [str(v) for v in self._npz['codec']]
+        elif any([info.compress_type == zipfile.ZIP_DEFLATED for info in self._npz.zip.infolist()]):
+            self.compression = 'zip'
+        
+        self.files = [f for f in self._npz.files if f != 'codec' \
+                                                    and f.rsplit('_', 1)[-1] not in ('scale', 'shape', 'dtype')]
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, tb):
+        self.close()
+    
+    def __contains__(self, key):
+        return key in self.files
+    
+    def __iter__(self):
+        return iter(self.files)
+    
+    def keys(self):
+        return list(self.files)
+    
+    def __getitem__(self, key):
+        value = self._npz[key]
+        if key[:3] != 'vis' or 'codec' not in self._npz.files:
+            return value
+        
+        if self.compression in ('zstd', 'lz4'):
+            value = _unshuffle_decompress(value, self._npz['%s_shape' % key],
+                                          str(self._npz['%s_dtype' % key]),
+                                          self.compression)
+        if self.precision != 'complex64':
+            value = _decode_vis(value, self._npz['%s_scale' % key])
+        return value
+    
+    def close(self):
+        self._npz.close()
+
+
+def load_visibilities(filename):
+    """
+    Load a correlator dump written by save_visibilities (or numpy.savez) and
+    return a VisibilityFile instance that behaves like the NpzFile returned by
+    numpy.load.  Any reduced precision or compressed visibility data are
+    converted back to numpy.complex64 when accessed.
+    """
+    
+    return VisibilityFile(filename)
+
+
+# Baseline-dependent averaging - the largest phase change in radians allowed
+# across an averaged interval or set of channels at the edge of the field of
+# view.  0.5 radians corresponds to about a 1% loss in amplitude.
+_BDA_PHASE_LIMIT = 0.5
+_BDA_OMEGA_EARTH = 7.2921150e-5     # rad/s
+_BDA_SPEED_OF_LIGHT = 299792458.0   # m/s
+
+
+def _get_power_of_two(value, max_value):
+    """
+    Return the largest power of two that is no larger than both value and
+    max_value, with a minimum of one.
+    """
+    
+    value = min([value, max_value])
+    factor = 1
+    while 2*factor <= value:
+        factor *= 2
+    return factor
+
+
+def get_bda_factors(antennas, freq, tInt, fov, max_factor=16, chan_block=None):
+    """
+    Given a list of lsl.common.stations.Antenna instances (one per station),
+    the channel frequencies in Hz, the dump time in seconds, and the field of
+    view in degrees, return a two-element tuple of the time and channel 
+    averaging factors for each baseline.  The baselines are in the same order
+    as the X-engine output and the factors are powers of two no larger than
+    max_factor.  The channel factors also evenly divide chan_block channels,
+    the zoom band size, if it is given.
+    
+    The factors are chosen so that the fringe at the edge of the field of view
+    changes by no more than _BDA_PHASE_LIMIT radians over the averaged 
+    interval or channels.  The baseline length used is the full 3-D length, 
+    which is an upper limit on the length in the uv plane.
+    """
+    
+    xyz = numpy.array([(a.stand.x, a.stand.y, a.stand.z) for a in antennas])
+    s1, s2 = numpy.triu_indices(len(antennas))
+    length = numpy.sqrt(((xyz[s1,:] - xyz[s2,:])**2).sum(axis=1))
+    
+    lam = _BDA_SPEED_OF_LIGHT / numpy.abs(freq).max()
+    chanWidth = abs(freq[1] - freq[0])
+    theta = fov/2.0 * numpy.pi/180
+    if chan_block is None:
+        chan_block = freq.size
+        
+    timeFactors = numpy.ones(length.size, dtype=numpy.int32)
+    chanFactors = numpy.ones(length.size, dtype=numpy.int32)
+    for b,l in enumerate(length):
+        if l == 0:
+            tMax = fMax = numpy.inf
+        else:
+            tMax = _BDA_PHASE_LIMIT / (2*numpy.pi*_BDA_OMEGA_EARTH*(l/lam)*theta)
+            fMax = _BDA_PHASE_LIMIT * _BDA_SPEED_OF_LIGHT / (2*numpy.pi*l*theta)
+        timeFactors[b] = _get_power_of_two(tMax/tInt, max_factor)
+        chanFactors[b] = _get_power_of_two(fMax/chanWidth, max_factor)
+        while chan_block % chanFactors[b] != 0:
+            chanFactors[b] //= 2
+    return timeFactors, chanFactors
+
+
+class BaselineAverager(object):
+    """
+    Class for applying baseline-dependent averaging to the correlator dumps.
+    Each baseline is averaged over its own number of dumps and channels, as 
+    given by get_bda_factors().  A baseline is written out in the dump where
+    its averaging interval finishes, i.e., the dump number is a multiple of 
+    its time factor, along with the other baselines that share its channel
+    factor.
+    """
+    
+    def __init__(self, time_factors, chan_factors):
+        self.time_factors = numpy.asarray(time_factors, dtype=numpy.int32)
+        self.chan_factors = numpy.asarray(chan_factors, dtype=numpy.int32)
+        self.period = int(self.time_factors.max())
+        
+        self._accum = None
+        self._weights = None
+        
+    def add(self, dump, visXX, visXY, visYX, visYY, weights=None):
+        """
+        Add the visibilities for the specified dump number (starting at one)
+        and return a dictionary of the arrays to save for this dump.  The 
+        averaged visibilities are stored as 'vis1XX_c<N>', etc., for each 
+        channel factor N with the matching baseline indices in 
+        'bdaBaselines_c<N>'.  If a 2-D (baselines by channels) array of 
+        weights is given the averages are weighted and the averaged weights 
+        are stored as 'weights1_c<N>'.
+        """
+        
+        vis = (visXX, visXY, visYX, visYY)
+        if self._accum is None:
+            self._accum = [numpy.zeros(v.shape, dtype=numpy.complex64) for v in vis]
+            if weights is not None:
+                self._weights = numpy.zeros(weights.shape, dtype=numpy.float32)
+        if weights is not None:
+            for a,v in zip(self._accum, vis):
+                a += v*weights
+            self._weights += weights
+        else:
+            for a,v in zip(self._accum, vis):
+                a += v
+                
+        output = {'bdaTime': self.time_factors, 'bdaChan': self.chan_factors}
+        done = numpy.where(dump % self.time_factors == 0)[0]
+        for chanFactor in numpy.unique(self.chan_factors[done]):
+            rows = done[numpy.where(self.chan_factors[done] == chanFactor)[0]]
+            output['bdaBaselines_c%i' % chanFactor] = rows
+            if weights is not None:
+                w = self._weights[rows,:]
+                w = w.reshape(w.shape[0], w.shape[1]//chanFactor, chanFactor).sum(axis=2)
+                norm = numpy.where(w > 0, w, 1.0)
+                output['weights1_c%i' % chanFactor] = w / (self.time_factors[rows][:,numpy.newaxis]*chanFactor)
+            else:
+                norm = self.time_factors[rows][:,numpy.newaxis]*chanFactor
+            for name,a in zip(('XX', 'XY', 'YX', 'YY'), self._accum):
+                v = a[rows,:]
+                v = v.reshape(v.shape[0], v.shape[1]//chanFactor, chanFactor).sum(axis=2) / norm
+                output['vis1%s_c%i' % (name, chanFactor)] = v
+                
+        for a in self._accum:
+            a[done,:] = 0.0
+        if weights is not None:
+            self._weights[done,:] = 0.0
+        return output
+
+
+def get_bda_visibilities(dataDict):
+    """
+    Given a correlator dump written with baseline-dependent averaging, return
+    a six-element tuple of:
+      * a list of (time factor, row indices, baseline indices) for the 
+        groups of baselines that share a time factor,
+      * the XX visibilities,
+      * the XY visibilities,
+      * the YX visibilities,
+      * the YY visibilities, and
+      * the visibility weights or None if the dump does not have weights.
+    The visibilities for all of the baselines in the dump are stacked into a 
+    2-D (rows by channels) array at the full channel resolution with each
+    channel-averaged value repeated.
+    """
+    
+    nchan = dataDict['freq1'].size
+    timeFactors = dataDict['bdaTime']
+    
+    baselines = []
+    vis = [[], [], [], []]
+    weights = []
+    for key in sorted(dataDict.keys()):
+        if key[:14] != 'bdaBaselines_c':
+            continue
+        chanFactor = int(key[14:], 10)
+        
+        baselines.append( dataDict[key] )
+        for i,name in enumerate(('XX', 'XY', 'YX', 'YY')):
+            v = dataDict['vis1%s_c%i' % (name, chanFactor)].astype(numpy.complex64)
+            vis[i].append( numpy.repeat(v, nchan//v.shape[1], axis=1) )
+        try:
+            w = dataDict['weights1_c%i' % chanFactor].astype(numpy.float32)
+            weights.append( numpy.repeat(w, nchan//w.shape[1], axis=1) )
+        except KeyError:
+            pass
+    if len(baselines) == 0:
+        empty = numpy.zeros((0,nchan), dtype=numpy.complex64)
+        return [], empty, empty.copy(), empty.copy(), empty.copy(), None
+        
+    baselines = numpy.concatenate(baselines)
+    vis = [numpy.concatenate(v, axis=0) for v in vis]
+    weights = numpy.concatenate(weights, axis=0) if len(weights) else None
+    
+    groups = []
+    for timeFactor in numpy.unique(timeFactors[baselines]):
+        rows = numpy.where(timeFactors[baselines] == timeFactor)[0]
+        groups.append( (int(timeFactor), rows, baselines[rows]) )
+    return groups, vis[0], vis[1], vis[2], vis[3], weights
+
+
+def save_checkpoint(filename, state):
+    """
+    Save a dictionary describing the state of a correlator run to a JSON file
+    so that the run can be resumed later.  The file is written to a temporary
+    name first and then renamed so that a partially written checkpoint is 
+    never left behind.
+    """
+    
+    # Convert any numpy types to something that JSON understands
+    def _clean(value):
+        if isinstance(value, dict):
+            return {k:_clean(v) for k,v in value.items()}
+        elif isinstance(value, numpy.ndarray):
+            return value.tolist()
+        elif isinstance(value, (list, tuple)):
+            return [_clean(v) for v in value]
+        elif isinstance(value, numpy.generic):
+            return value.item()
+        return value
+    cleaned = _clean(state)
+    
+    tempname = '%s.tmp' % filename
+    with open(tempname, 'w') as fh:
+        json.dump(cleaned, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tempname, filename)
+
+
+def load_checkpoint(filename):
+    """
+    Load a checkpoint written by save_checkpoint and return it as a dictionary.
+    Returns None if the checkpoint does not exist.
+    """
+    
+    if not os.path.exists(filename):
+        return None
+        
+    with open(filename, 'r') as fh:
+        state = json.load(fh)
+    return state
+
+
+# Location of the saved autotuning results
+_TUNING_FILE = os.path.join(os.path.expanduser('~'), '.elwa', 'autotune.json')
+
+
+def _get_tuning_key(nInput):
+    """
+    Return the key used to store tuning results for the current host and the
+    given number of correlator inputs.
+    """
+    
+    return "%s-%i" % (socket.gethostname(), nInput)
+
+
+def load_tuning(nInput, filename=_TUNING_FILE):
+    """
+    Load the tuning saved by save_tuning for the current host and the given 
+    number of correlator inputs.  Returns None if no tuning has been saved.
+    """
+    
+    tuning = load_checkpoint(filename)
+    if tuning is None:
+        return None
+    return tuning.get(_get_tuning_key(nInput), None)
+
+
+def save_tuning(nInput, params, filename=_TUNING_FILE):
+    """
+    Save a dictionary of tuned correlator parameters for the current host and
+    the given number of correlator inputs.  Any tuning for other hosts or 
+    array sizes that is already in the file is preserved.
+    """
+    
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+                
+    lock = InterProcessLock(filename)
+    with lock:
+        tuning = load_checkpoint(filename)
+        if tuning is None:
+            tuning = {}
+        tuning[_get_tuning_key(nInput)] = params
+        save_checkpoint(filename, tuning)
+
+
+class StageTimer(object):
+    """
+    Class for lightweight lap timing of the stages in a processing loop.  Each
+    call to mark() attributes the time since the previous mark (or reset) to 
+    the named stage, along with an optional number of bytes and samples 
+    processed.  Periodically, report() appends a JSON record with the per-stage
+    totals, timing percentiles, and throughputs to a JSON lines file.
+    """
+    
+    def __init__(self, filename, interval=30.0):
+        self.filename = filename
+        self.interval = float(interval)
+        
+        self.stages = []
+        self._totals = {}
+        self._laps = {}
+        
+        self.tStart = time.time()
+        self.tReport = self.tStart
+        self.tLast = self.tStart
+        
+    def reset(self):
+        """
+        Start a new lap without attributing the elapsed time to any stage.
+        """
+        
+        self.tLast = time.time()
+        
+    def mark(self, stage, nbytes=0, nsamples=0):
+        """
+        Attribute the time since the last mark to the specified stage.
+        """
+        
+        tNow = time.time()
+        try:
+            entry = self._totals[stage]
+        except KeyError:
+            self.stages.append(stage)
+            entry = self._totals[stage] = {'count': 0, 'total': 0.0, 'bytes': 0, 'samples': 0}
+            self._laps[stage] = []
+        entry['count'] += 1
+        entry['total'] += tNow - self.tLast
+        entry['bytes'] += int(nbytes)
+        entry['samples'] += int(nsamples)
+        self._laps[stage].append(tNow - self.tLast)
+        self.tLast = tNow
+        
+    def report(self, force=False, **kwds):
+        """
+        Write a record to the JSON lines file if the reporting interval has
+        passed or force is True.  Any keywords are included in the record.  
+        Returns True if a record was written.
+        """
+        
+        tNow = time.time()
+        if not force and tNow - self.tReport < self.interval:
+            return False
+            
+        stages = {}
+        for stage in self.stages:
+            entry = self._totals[stage]
+            laps = numpy.array(self._laps[stage])
+            if laps.size == 0:
+                laps = numpy.zeros(1)
+            p50, p90, p99 = numpy.percentile(laps, [50, 90, 99])
+            stages[stage] = {'count': entry['count'], 
+                             'total': entry['total'],
+                             'p50': p50, 'p90': p90, 'p99': p99,
+                             'bytes': entry['bytes'],
+                             'bytes_per_s': entry['bytes'] / max([entry['total'], 1e-9]),
+                             'samples_per_s': entry['samples'] / max([entry['total'], 1e-9])}
+            self._laps[stage] = []
+            
+        record = {'time': tNow, 'elapsed': tNow - self.tStart, 'stages': stages}
+        record.update(kwds)
+        with open(self.filename, 'a') as fh:
+            fh.write(json.dumps(record))
+            fh.write('\n')
+            
+        self.tReport = tNow
+        return True
+
+
+def add_profile_option(parser):
+    """
+    Add the common --profile and --profile-rate options to an 
+    argparse.ArgumentParser instance.
+    """
+    
+    parser.add_argument('--profile', type=str, nargs='?', const='', metavar='PREFIX',
+                        help='profile the main processing loop and write the results to files starting with PREFIX; if PREFIX is not given a default based on the output is used')
+    parser.add_argument('--profile-rate', type=float, default=50.0,
+                        help='stack sampling rate in Hz to use when profiling')
+    return parser
+
+
+class Profiler(object):
+    """
+    Class for profiling the main processing loop of a script.  Profiling 
+    writes three files:
+     * <prefix>.prof - a cProfile dump that can be read with pstats,
+     * <prefix>.folded - sampled stacks of the main thread in the "folded" 
+       format used by flamegraph.pl and speedscope, and
+     * <prefix>.rss.json - the resident set size at the start and end of the
+       loop along with the peak seen while sampling.
+    If the prefix is None the profiler does nothing so that it can be left 
+    in place for runs without profiling.  If the prefix is an empty string, 
+    as it is when --profile is given without a value, the default prefix is 
+    used instead.
+    """
+    
+    def __init__(self, prefix, rate=50.0, default='profile'):
+        if prefix == '':
+            prefix = default
+        self.prefix = prefix
+        self.rate = float(rate)
+        
+        self._profile = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._stacks = {}
+        self._rss = {'start': 0, 'peak': 0, 'end': 0}
+        
+    def __enter__(self):
+        self.start()
+        return self
+        
+    def __exit__(self, type, value, tb):
+        self.stop()
+        
+    @property
+    def enabled(self):
+        return self.prefix is not None
+        
+    @staticmethod
+    def _get_rss():
+        """
+        Return the current resident set size in bytes.
+        """
+        
+        try:
+            with open('/proc/self/statm', 'r') as fh:
+                rss = int(fh.read().split()[1], 10)
+            return rss*os.sysconf('SC_PAGE_SIZE')
+        except (IOError, OSError, IndexError, ValueError):
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+            
+    def _sample(self, ident):
+        """
+        Periodically sample the stack of the thread with the given identifier
+        and the current resident set size.
+        """
+        
+        while not self._stop.wait(1.0/self.rate):
+            try:
+                frame = sys._current_frames()[ident]
+            except KeyError:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%i)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack = ';'.join(reversed(stack))
+            self._stacks[stack] = self._stacks.get(stack, 0) + 1
+            
+            self._rss['peak'] = max([self._rss['peak'], self._get_rss()])
+            
+    def start(self):
+        """
+        Start profiling.
+        """
+        
+        if not self.enabled or self._profile is not None:
+            return False
+            
+        self._rss['start'] = self._rss['peak'] = self._get_rss()
+        
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, args=(threading.current_thread().ident,))
+        self._thread.daemon = True
+        self._thread.start()
+        
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return True
+        
+    def stop(self):
+        """
+        Stop profiling and write out the results.
+        """
+        
+        if not self.enabled or self._profile is None:
+            return False
+            
+        self._profile.disable()
+        self._stop.set()
+        self._thread.join()
+        self._rss['end'] = self._get_rss()
+        self._rss['peak'] = max([self._rss['peak'], self._rss['end']])
+        
+        self._profile.dump_stats("%s.prof" % self.prefix)
+        with open("%s.folded" % self.prefix, 'w') as fh:
+            for stack in sorted(self._stacks.keys()):
+                fh.write("%s %i\n" % (stack, self._stacks[stack]))
+        with open("%s.rss.json" % self.prefix, 'w') as fh:
+            json.dump(self._rss, fh)
+            
+        ### PF = profile
+        print("PF - profile written to '%s.*', peak RSS was %.1f MB" % (self.prefix, self._rss['peak']/1024.0**2))
+        
+        self._profile = None
+        self._thread = None
+        return True
+
+
 class PolyCos(object):
     """
     Class for working with pulsar PolyCos files.
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""
+Build the JIT modules that superCorrelator.py -j will need ahead of time so
+that correlation runs start at full speed.
+"""
+
+# Python3 compatibility
+from __future__ import print_function, division, absolute_import
+import sys
+if sys.version_info > (3,):
+    xrange = range
+    
+import os
+import sys
+import math
+import time
+import numpy
+import argparse
+
+from astropy.constants import c as vLight
+
+from lsl.reader import drx, vdif
+from lsl.misc import parser as aph
+
+from utils import read_correlator_configuration, load_tuning
+from jit.jit import warmup
+
+
+vLight = vLight.to('m/s').value
+
+
+def get_stream_info(filename, reader):
+    """
+    Given a filename and the lsl.reader module used to read it, return a two-
+    element tuple of the sample rate and the number of samples per frame.
+    """
+    
+    with open(filename, 'rb') as fh:
+        if reader is vdif:
+            header = vdif.read_guppi_header(fh)
+            junkFrame = vdif.read_frame(fh, central_freq=header['OBSFREQ'], sample_rate=header['OBSBW']*2.0)
+        else:
+            junkFrame = drx.read_frame(fh)
+            while junkFrame.header.decimation == 0:
+                junkFrame = drx.read_frame(fh)
+    return junkFrame.sample_rate, junkFrame.payload.data.size
+
+
+def get_max_delay(antennas):
+    """
+    Given a list of lsl.common.stations.Antenna instances, return the largest
+    relative delay in seconds between any two of them from their separation
+    and clock offsets.
+    """
+    
+    xyz = numpy.array([(a.stand.x, a.stand.y, a.stand.z) for a in antennas])
+    dist = numpy.sqrt(((xyz[:,numpy.newaxis,:] - xyz[numpy.newaxis,:,:])**2).sum(axis=2))
+    clocks = numpy.array([a.cable.clock_offset for a in antennas])
+    return dist.max()/vLight + (clocks.max() - clocks.min())
+
+
+def get_jit_modules(nVDIF, nDRX, LFFT, read_time=1.0, subint_time=0.010, vdif_rate=32e6, drx_rate=19.6e6,
+                    vdif_frame=5000, drx_frame=4096, max_delay=0.0):
+    """
+    Return a list of the (dtype, nStand, nSamps, nChan, nOverlap, ClipLevel)
+    parameters of the JIT modules that superCorrelator.py will request for the
+    specified setup.  The F-engine modules are exact but the X-engine modules
+    depend on the channel overlap and how many windows are lost to the delays,
+    so a module is included for each window count that is possible given the
+    maximum relative delay.
+    """
+    
+    # Sample rates and frame sizes in the order superCorrelator.py uses them:
+    # VDIF first and DRX last
+    srate0, len0 = (vdif_rate, vdif_frame) if nVDIF else (drx_rate, drx_frame)
+    srate1, len1 = (drx_rate, drx_frame) if nDRX else (vdif_rate, vdif_frame)
+    
+    # Read and sub-integration times
+    nFrames = int(round(read_time*srate1/len1))
+    tRead = nFrames*len1/srate1
+    while tRead*srate0/len0 != int(tRead*srate0/len0):
+        nFrames += 1
+        tRead = nFrames*len1/srate1
+    tSub = tRead / int(round(tRead/subint_time))
+    nSampV = int(srate0*tSub)
+    nSampD = int(srate1*tSub)
+    
+    # Transform sizes
+    vdifLFFT = LFFT * (2 if nVDIF else 1)
+    drxLFFT = vdifLFFT * srate1 / srate0
+    while drxLFFT != int(drxLFFT):
+        vdifLFFT += 1
+        drxLFFT = vdifLFFT * srate1 / srate0
+    vdifLFFT = vdifLFFT // (2 if nVDIF else 1)
+    drxLFFT = int(drxLFFT)
+    
+    # F-engines
+    modules = []
+    nWin = []
+    if nVDIF:
+        modules.append( ('float32', 2*nVDIF, nSampV, vdifLFFT, 1, 0) )
+        nWin.append( nSampV // (2*vdifLFFT) )
+    if nDRX:
+        modules.append( ('complex64', 2*nDRX, nSampD, drxLFFT, 1, 0) )
+        nWin.append( nSampD // drxLFFT )
+        
+    # X-engines - the 5 us is from the rounding in get_optimal_delay_padding()
+    nWin = min(nWin)
+    tWin = (drxLFFT if nDRX else 2*vdifLFFT) / srate1
+    nLost = int(math.ceil((max_delay + 5e-6) / tWin)) + 1
+    nChans = [drxLFFT if nDRX else vdifLFFT,]
+    if nVDIF and nDRX:
+        ## The channel alignment may drop a channel
+        nChans.append( drxLFFT - 1 )
+    for nChan in nChans:
+        for w in xrange(max([1, nWin-nLost]), nWin+1):
+            modules.append( ('complex64', nVDIF+nDRX, nChan*w, nChan, 1, 0) )
+            
+    return modules
+
+
+def main(args):
+    # Build up the setups to warm up for
+    setups = []
+    for filename in args.filename:
+        config, refSrc, filenames, metanames, foffsets, readers, antennas = read_correlator_configuration(filename)
+        LFFTs = args.fft_length
+        try:
+            LFFTs = [config['channels'],]
+        except (TypeError, KeyError):
+            pass
+            
+        nVDIF = sum([1 for reader in readers if reader is vdif])
+        nDRX = sum([1 for reader in readers if reader is drx])
+        vdif_rate, vdif_frame = args.vdif_rate*1e6, 5000
+        drx_rate, drx_frame = args.drx_rate*1e6, 4096
+        for name,reader in zip(filenames, readers):
+            if reader is vdif:
+                vdif_rate, vdif_frame = get_stream_info(name, reader)
+            else:
+                drx_rate, drx_frame = get_stream_info(name, reader)
+                
+        for LFFT in LFFTs:
+            setups.append( (os.path.basename(filename), nVDIF, nDRX, LFFT, vdif_rate, vdif_frame, drx_rate, drx_frame,
+                            get_max_delay(antennas)) )
+                            
+    if args.vdif_inputs is not None or args.drx_inputs is not None:
+        for nVDIF in (args.vdif_inputs or [0,]):
+            for nDRX in (args.drx_inputs or [0,]):
+                if nVDIF + nDRX < 2:
+                    continue
+                for LFFT in args.fft_length:
+                    setups.append( ('%i VDIF + %i DRX' % (nVDIF, nDRX), nVDIF, nDRX, LFFT, args.vdif_rate*1e6, 5000,
+                                    args.drx_rate*1e6, 4096, args.max_baseline*1e3/vLight) )
+    if len(setups) == 0:
+        raise RuntimeError("Nothing to warm up, provide configuration files or input counts")
+        
+    # Figure out the modules
+    modules = []
+    for name,nVDIF,nDRX,LFFT,vdif_rate,vdif_frame,drx_rate,drx_frame,max_delay in setups:
+        ## Apply any saved tuning for this host and array size the same way
+        ## superCorrelator.py does
+        read_time, subint_time = args.read_time, args.subint_time
+        if not args.ignore_tuning:
+            tuning = load_tuning(nVDIF+nDRX)
+            if tuning is not None:
+                if read_time == 1.0:
+                    read_time = tuning['read_time']
+                if subint_time == 0.010:
+                    subint_time = tuning['subint_time']
+                    
+        setup_modules = get_jit_modules(nVDIF, nDRX, LFFT, read_time=read_time, subint_time=subint_time,
+                                        vdif_rate=vdif_rate, drx_rate=drx_rate, vdif_frame=vdif_frame,
+                                        drx_frame=drx_frame, max_delay=max_delay)
+        print("%s: %i modules for a %i channel FFT" % (name, len(setup_modules), LFFT))
+        for params in setup_modules:
+            if params not in modules:
+                modules.append(params)
+                
+    # Build
+    print("Building %i unique modules with %s processes" % (len(modules), args.processes or 'all'))
+    t0 = time.time()
+    warmup(modules, processes=args.processes)
+    print("Finished in %.1f s" % (time.time() - t0,))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='build the JIT modules needed by superCorrelator.py ahead of time',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    parser.add_argument('filename', type=str, nargs='*',
+                        help='configuration file(s) to build the modules for')
+    parser.add_argument('--vdif-inputs', type=aph.csv_int_list,
+                        help='comma separated list of VDIF input counts to build the modules for')
+    parser.add_argument('--drx-inputs', type=aph.csv_int_list,
+                        help='comma separated list of DRX input counts to build the modules for')
+    parser.add_argument('-l', '--fft-length', type=aph.csv_int_list, default='512',
+                        help='comma separated list of FFT lengths')
+    parser.add_argument('-u', '--subint-time', type=float, default=0.010,
+                        help='sub-integration time in seconds')
+    parser.add_argument('--read-time', type=float, default=1.0,
+                        help='data read time in seconds')
+    parser.add_argument('--vdif-rate', type=float, default=32.0,
+                        help='VDIF sample rate in MHz when not using a configuration file')
+    parser.add_argument('--drx-rate', type=float, default=19.6,
+                        help='DRX sample rate in MHz when not using a configuration file')
+    parser.add_argument('-b', '--max-baseline', type=float, default=100.0,
+                        help='longest baseline in km when not using a configuration file')
+    parser.add_argument('--ignore-tuning', action='store_true',
+                        help='ignore any saved tuning when figuring out the read and sub-integration times')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='number of build processes to use; default is one per CPU')
+    args = parser.parse_args()
+    main(args)
+    